@@ -0,0 +1,193 @@
+# Lightweight timers and byte counters for the stages of compression and decompression
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+# The active Profile, None when profiling is off
+PROFILE = None
+
+# The stages being timed, innermost last, see _Stage
+_OPEN = []
+
+
+class Profile():
+    '''Calls, time and bytes of each stage, by datagram type and channel.  The stages are timed
+       separately, e.g. the wavelet transform is not part of the time of the conversion calling it,
+       and the time of a stage nested in another, e.g. the decompression when hashing the samples,
+       is not part of the time of the outer one.'''
+
+    def __init__(self):
+        self.stats = {}               # (stage, type, channel): [calls, seconds, bytes]
+        self.current = (None, None)   # the datagram type and channel being processed
+
+    def add(self, stage, seconds, nbytes=0, key=None):
+        '''Add a call of a stage, by default for the current datagram type and channel'''
+        dtype, channel = self.current if key is None else key
+        s = self.stats.setdefault((stage, dtype, channel), [0, 0.0, 0])
+        s[0] += 1
+        s[1] += seconds
+        s[2] += nbytes
+
+    def take(self):
+        '''Return the statistics collected so far, and start over'''
+        stats, self.stats = self.stats, {}
+        return stats
+
+    def merge(self, stats):
+        '''Add statistics from take, e.g. of a worker process'''
+        for key, (calls, seconds, nbytes) in stats.items():
+            s = self.stats.setdefault(key, [0, 0.0, 0])
+            s[0] += calls
+            s[1] += seconds
+            s[2] += nbytes
+
+    def by_stage(self):
+        '''The calls, seconds and bytes of each stage, summed over datagram types and channels'''
+        totals = {}
+        for (stage, _, _), (calls, seconds, nbytes) in self.stats.items():
+            s = totals.setdefault(stage, [0, 0.0, 0])
+            s[0] += calls
+            s[1] += seconds
+            s[2] += nbytes
+        return totals
+
+    def to_dict(self):
+        '''The statistics as a dict for JSON output'''
+        return {'stages': [{'stage': stage, 'type': dtype, 'channel': channel,
+                            'calls': calls, 'seconds': seconds, 'bytes': nbytes}
+                           for (stage, dtype, channel), (calls, seconds, nbytes) in sorted(self.stats.items(), key=str)]}
+
+    def write(self, fname):
+        '''Write the statistics as JSON'''
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def report(self, file=sys.stderr):
+        '''Print a summary table of the stages, and of the time per datagram type and channel'''
+        stages = self.by_stage()
+        total = stages.pop('total', [0, 0.0, 0])[1]
+        print(f'{"stage":<12}  {"calls":>8}  {"seconds":>9}  {"share":>6}  {"MB":>9}  {"MB/s":>8}', file=file)
+        for stage, (calls, seconds, nbytes) in sorted(stages.items(), key=lambda s: -s[1][1]):
+            share = f'{100 * seconds / total:5.1f}%' if total else ''
+            rate = f'{nbytes / seconds / 1e6:8.1f}' if nbytes and seconds else ''
+            print(f'{stage:<12}  {calls:8d}  {seconds:9.3f}  {share:>6}  {nbytes / 1e6:9.2f}  {rate:>8}', file=file)
+        if total:
+            print(f'{"total":<12}  {"":>8}  {total:9.3f}', file=file)
+
+        channels = {}
+        for (stage, dtype, channel), (calls, seconds, nbytes) in self.stats.items():
+            if stage != 'total' and dtype is not None:
+                s = channels.setdefault((dtype, channel or ''), [0, 0.0])
+                s[0] += calls if stage == 'read' else 0
+                s[1] += seconds
+        print(f'\n{"type":<5} {"channel":<40}  {"datagrams":>9}  {"seconds":>9}', file=file)
+        for (dtype, channel), (count, seconds) in sorted(channels.items()):
+            print(f'{dtype:<5} {channel:<40}  {count:9d}  {seconds:9.3f}', file=file)
+
+
+class _Stage():
+    '''Times a stage, less the time of the stages nested in it, unless outer (e.g. the total of a run)'''
+
+    def __init__(self, name, nbytes, key=None, outer=False):
+        self.name = name
+        self.nbytes = nbytes
+        self.key = key
+        self.outer = outer
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.nested = 0.0
+        if not self.outer:
+            _OPEN.append(self)
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        if not self.outer:
+            _OPEN.pop()
+            if _OPEN:
+                _OPEN[-1].nested += seconds
+        if PROFILE is not None:
+            PROFILE.add(self.name, seconds - self.nested, self.nbytes, self.key)
+
+
+class _NoStage():
+    '''Stands in for _Stage when profiling is off, nbytes can be set and is ignored'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name, nbytes=0):
+    '''Context manager timing a stage of the current datagram, the bytes processed can
+       be given here or set as the nbytes attribute of the value it returns'''
+    if PROFILE is None:
+        return _NO_STAGE
+    return _Stage(name, nbytes)
+
+
+def run():
+    '''Context manager timing the whole of a run, as the total the stages are compared to'''
+    if PROFILE is None:
+        return _NO_STAGE
+    return _Stage('total', 0, key=(None, None), outer=True)
+
+
+def datagram(msg):
+    '''Attribute the following stages to the datagram with the given contents'''
+    if PROFILE is not None:
+        dtype = bytes(msg[:4]).decode('latin_1')
+        channel = None
+        if dtype[3:] in ('3', '4'):  # the sample datagrams with a channel_id
+            channel = bytes(msg[12:140]).rstrip(b'\x00').decode('latin_1')
+        PROFILE.current = (dtype, channel)
+
+
+def timed_datagrams(dgrams, name='read'):
+    '''Pass on (type, length, timestamp, contents) datagrams, timing the reading of each'''
+    dgrams = iter(dgrams)
+    while True:
+        start = time.perf_counter()
+        dgram = next(dgrams, None)
+        if dgram is None:
+            return
+        if PROFILE is not None:
+            datagram(dgram[3])
+            PROFILE.add(name, time.perf_counter() - start, dgram[1] + 8)
+        yield dgram
+
+
+def enable(profile=None):
+    '''Start collecting statistics, in the given or a new Profile, which is returned'''
+    global PROFILE
+    PROFILE = profile if profile is not None else Profile()
+    return PROFILE
+
+
+def disable():
+    '''Stop collecting statistics, returns the Profile'''
+    global PROFILE
+    profile, PROFILE = PROFILE, None
+    return profile
+
+
+@contextmanager
+def profiling(profile=None):
+    '''Collect statistics within a with block, e.g. when embedding ekzip:
+
+       with ekprof.profiling() as profile:
+           ekzip.compress(fname)
+       print(profile.to_dict())'''
+    global PROFILE
+    previous = PROFILE
+    try:
+        yield enable(profile)
+    finally:
+        PROFILE = previous
@@ -0,0 +1,150 @@
+# Chunked arrays in a Zarr (version 2) directory store, written and read without depending on zarr
+import os
+import json
+import numpy as np
+import zstandard
+
+# Version of the Zarr format written
+ZARR_FORMAT = 2
+
+# zstd level of the chunks written, 0 stores them uncompressed so that they can be memory mapped
+ZSTD_LEVEL = 3
+
+
+def write_json(path, obj):
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=1)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def create_group(path, attrs=None):
+    '''Create a group directory, with the given attributes'''
+    os.makedirs(path, exist_ok=True)
+    write_json(os.path.join(path, '.zgroup'), {'zarr_format': ZARR_FORMAT})
+    if attrs:
+        write_json(os.path.join(path, '.zattrs'), attrs)
+
+
+def encode_fill(value, dtype):
+    '''The fill value as it is written in .zarray'''
+    if value is None:
+        return None
+    if dtype.kind == 'c':
+        return [encode_fill(value.real, dtype.type(0).real.dtype), encode_fill(value.imag, dtype.type(0).real.dtype)]
+    if dtype.kind == 'f' and not np.isfinite(value):
+        return 'NaN' if np.isnan(value) else ('Infinity' if value > 0 else '-Infinity')
+    if dtype.kind == 'f':
+        return float(value)
+    return int(value)
+
+
+def decode_fill(value, dtype):
+    '''The fill value written by encode_fill'''
+    if value is None:
+        return None
+    if dtype.kind == 'c':
+        real = dtype.type(0).real.dtype
+        return dtype.type(complex(decode_fill(value[0], real), decode_fill(value[1], real)))
+    return dtype.type(float(value) if isinstance(value, str) else value)
+
+
+class Array():
+    '''An array stored as one file per chunk, named by the chunk indices separated by dots, with the
+       layout of .zarray as written by create.  The chunks are compressed with zstd (the 'zstd' codec
+       of numcodecs) after shuffling the bytes of the elements (its 'shuffle' filter), or with level 0
+       stored as they are.  Each chunk is written and read independently, so that processes can
+       work on disjoint chunks concurrently.'''
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.fill_value = decode_fill(meta['fill_value'], self.dtype)
+        compressor = meta['compressor']
+        if compressor is not None and compressor['id'] != 'zstd':
+            raise ValueError(f'Unsupported compressor {compressor["id"]} in {path}')
+        self.level = 0 if compressor is None else compressor['level']
+        self.shuffle = None
+        for f in meta['filters'] or []:
+            if f['id'] != 'shuffle':
+                raise ValueError(f'Unsupported filter {f["id"]} in {path}')
+            self.shuffle = f['elementsize']
+
+    @classmethod
+    def create(cls, path, shape, chunks, dtype, fill_value=None, dims=None, attrs=None, level=ZSTD_LEVEL):
+        '''Create an array directory, with dims the names of the dimensions as xarray expects them'''
+        dtype = np.dtype(dtype)
+        meta = {'zarr_format': ZARR_FORMAT, 'shape': list(shape), 'chunks': list(chunks), 'dtype': dtype.str,
+                'fill_value': encode_fill(fill_value, dtype), 'order': 'C',
+                'compressor': {'id': 'zstd', 'level': level, 'checksum': False} if level > 0 else None,
+                'filters': None}
+        if level > 0 and dtype.itemsize > 1:
+            # the real and imaginary parts of complex values are shuffled as separate elements
+            meta['filters'] = [{'id': 'shuffle', 'elementsize': dtype.itemsize // (2 if dtype.kind == 'c' else 1)}]
+        os.makedirs(path, exist_ok=True)
+        write_json(os.path.join(path, '.zarray'), meta)
+        attrs = dict(attrs or {})
+        if dims is not None:
+            attrs['_ARRAY_DIMENSIONS'] = list(dims)
+        if attrs:
+            write_json(os.path.join(path, '.zattrs'), attrs)
+        return cls(path, meta)
+
+    @classmethod
+    def open(cls, path):
+        return cls(path, read_json(os.path.join(path, '.zarray')))
+
+    def attrs(self):
+        fname = os.path.join(self.path, '.zattrs')
+        return read_json(fname) if os.path.exists(fname) else {}
+
+    def nchunks(self, axis=0):
+        return -(-self.shape[axis] // self.chunks[axis])
+
+    def chunk_file(self, index):
+        return os.path.join(self.path, '.'.join(str(i) for i in index))
+
+    def write_chunk(self, index, data):
+        '''Write the chunk with the given indices, data is padded with the fill value to the chunk shape'''
+        data = np.asarray(data, dtype=self.dtype)
+        if data.shape != self.chunks:
+            full = np.full(self.chunks, self.fill_value if self.fill_value is not None else 0, dtype=self.dtype)
+            full[tuple(slice(0, n) for n in data.shape)] = data
+            data = full
+        buf = np.ascontiguousarray(data).view(np.uint8).reshape(-1)
+        if self.shuffle:
+            buf = np.ascontiguousarray(buf.reshape(-1, self.shuffle).T)
+        if self.level > 0:
+            buf = zstandard.ZstdCompressor(level=self.level).compress(buf)
+        with open(self.chunk_file(index), 'wb') as f:
+            f.write(buf)
+
+    def read_chunk(self, index):
+        '''Read the chunk with the given indices, memory mapped if it is stored uncompressed'''
+        fname = self.chunk_file(index)
+        if not os.path.exists(fname):
+            return np.full(self.chunks, self.fill_value if self.fill_value is not None else 0, dtype=self.dtype)
+        if self.level == 0:
+            return np.memmap(fname, dtype=self.dtype, mode='r', shape=self.chunks)
+        with open(fname, 'rb') as f:
+            buf = np.frombuffer(zstandard.ZstdDecompressor().decompress(f.read()), dtype=np.uint8)
+        if self.shuffle:
+            buf = buf.reshape(self.shuffle, -1).T.reshape(-1)
+        return buf.view(self.dtype).reshape(self.chunks)
+
+    def read(self, start=0, stop=None):
+        '''Read rows start to stop along the first axis, only from the chunks holding them.
+           The other axes must have a single chunk each, as in the stores written by ekzip.'''
+        stop = self.shape[0] if stop is None else min(stop, self.shape[0])
+        out = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=self.dtype)
+        rows = self.chunks[0]
+        for i in range(start // rows, -(-stop // rows)):
+            chunk = self.read_chunk((i,) + (0,) * (len(self.shape) - 1))
+            lo, hi = max(start, i * rows), min(stop, (i + 1) * rows)
+            out[lo - start:hi - start] = chunk[lo - i * rows:hi - i * rows]
+        return out
@@ -0,0 +1,194 @@
+# Reading and writing length framed datagrams
+import os
+import sys
+import mmap
+import struct
+import time
+from contextlib import contextmanager
+from ektools import warn
+from ektools.date_conversion import nt_to_unix
+
+# The length fields before and after each datagram, and the date following the type
+LENGTH = struct.Struct('<l')
+DATE = struct.Struct('<2L')
+
+# Suffix of the temporary file an output is written to before it is renamed, see open_output
+PART_SUFFIX = '.part'
+
+
+# or just use dgram_write from eksplit?  Or finalize_datagram?
+def dgram_write(f, dgram):
+    """Write a datagram to a file"""
+    hdr = struct.pack('<l', len(dgram))
+    f.write(hdr)
+    f.write(dgram)
+    f.write(hdr)
+
+
+def read_exactly(stream, size):
+    '''Read size bytes from a binary stream, returns fewer only at the end of the stream.
+       Pipes and sockets may return less than asked for from a single read.'''
+    buf = stream.read(size)
+    if buf is None or len(buf) == size:
+        return buf or b''
+    parts = [buf]
+    remaining = size - len(buf)
+    while remaining > 0:
+        buf = stream.read(remaining)
+        if not buf:
+            break
+        parts.append(buf)
+        remaining -= len(buf)
+    return b''.join(parts)
+
+
+def read_datagrams(stream):
+    '''Read datagrams incrementally from a binary stream, like ektools' ekfile, yielding
+       (type, length, timestamp, contents) for each datagram as soon as it is complete.'''
+    while True:
+        buf = read_exactly(stream, 4)
+        if len(buf) < 4:
+            if buf:
+                warn('Truncated datagram at end of input')
+            return
+        length, = struct.unpack('<l', buf)
+        msg = read_exactly(stream, length)
+        buf = read_exactly(stream, 4)
+        if len(buf) < 4:
+            warn('Truncated datagram at end of input')
+            return
+        yield make_datagram(msg, length, struct.unpack('<l', buf)[0])
+
+
+def mmap_datagrams(fname):
+    '''Read the datagrams of a file through mmap, yielding (type, length, timestamp, contents) like
+       read_datagrams, but with the contents as a memoryview of the map instead of a copy.  The map
+       stays valid for as long as any of the contents are referenced.'''
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    size = len(buf)
+    pos = 0
+    while pos < size:
+        length, = LENGTH.unpack_from(buf, pos) if size - pos >= 4 else (-1,)
+        if length < 0 or pos + length + 8 > size:
+            warn('Truncated datagram at end of input')
+            return
+        control, = LENGTH.unpack_from(buf, pos + 4 + length)
+        yield make_datagram(buf[pos + 4:pos + 4 + length], length, control)
+        pos += length + 8
+
+
+def make_datagram(msg, length, control):
+    '''Return the (type, length, timestamp, contents) tuple for a datagram read from a file'''
+    if control != length:
+        warn(f'Datagram control length mismatch ({length} vs {control}) - endianness error or corrupt file?')
+    msgtype = bytes(msg[:4]).decode('latin1')
+    mydate = nt_to_unix(DATE.unpack_from(msg, 4)).replace(tzinfo=None)
+    return (msgtype, length, mydate, msg)
+
+
+def datagrams(fname):
+    '''Read the datagrams of a file, memory mapped (see mmap_datagrams), or of stdin if fname is '-' '''
+    if fname == '-':
+        yield from read_datagrams(sys.stdin.buffer)
+    else:
+        yield from mmap_datagrams(fname)
+
+
+def first_bad_datagram(fname, check=None):
+    '''The offset of the first datagram of a file whose length fields do not match or that is cut
+       short, or None if the file consists of complete datagrams.  Only the length fields are read,
+       unless a check is given, which is then called with the contents of each datagram (as for
+       mmap_datagrams), and a datagram for which it returns false is also bad.'''
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    size = len(buf)
+    pos = 0
+    while pos < size:
+        length, = LENGTH.unpack_from(buf, pos) if size - pos >= 4 else (-1,)
+        if length < 0 or pos + length + 8 > size or LENGTH.unpack_from(buf, pos + 4 + length)[0] != length:
+            return pos
+        if check is not None and not check(buf[pos + 4:pos + 4 + length]):
+            return pos
+        pos += length + 8
+    return None
+
+
+def has_datagram(fname):
+    '''Whether a file begins with a complete datagram with matching length fields, i.e. whether
+       any of its datagrams can be read'''
+    with open(fname, 'rb') as f:
+        head = f.read(4)
+        if len(head) < 4:
+            return False
+        length, = LENGTH.unpack(head)
+        if length < 0 or length + 8 > os.fstat(f.fileno()).st_size:
+            return False
+        f.seek(length, os.SEEK_CUR)
+        return LENGTH.unpack(f.read(4))[0] == length
+
+
+def next_file(fname):
+    '''The first file after fname in name order, in the same directory and with the same suffix'''
+    dirname, base = os.path.split(fname)
+    suffix = os.path.splitext(base)[1]
+    later = sorted(f for f in os.listdir(dirname or '.') if f.endswith(suffix) and f > base)
+    return os.path.join(dirname, later[0]) if later else None
+
+
+def follow_datagrams(fname, poll=0.5):
+    '''Read the datagrams of a file that is still being written, yielding each datagram as soon as
+       its trailing length field has been written.  The file is considered complete when a later file
+       (see next_file) has appeared and no more data arrive for a whole poll interval, any partial
+       datagram is then discarded.'''
+    with open(fname, 'rb') as f:
+        pos = 0
+        idle = None  # the size of the file at the last poll with a later file present
+        while True:
+            size = os.fstat(f.fileno()).st_size
+            if size - pos >= 4:
+                f.seek(pos)
+                length, = struct.unpack('<l', f.read(4))
+                if size - pos >= length + 8:
+                    msg = f.read(length)
+                    control, = struct.unpack('<l', f.read(4))
+                    pos += length + 8
+                    yield make_datagram(msg, length, control)
+                    continue
+            # at the end of the data written so far
+            if next_file(fname) is None:
+                idle = None
+            elif idle == size:
+                if size > pos:
+                    warn(f'Discarding incomplete datagram at end of {fname}')
+                return
+            else:
+                idle = size
+            time.sleep(poll)
+
+
+@contextmanager
+def open_output(ofile, atomic=False):
+    '''Open ofile for writing, or use stdout if ofile is '-'.  With atomic, the output is written
+       to ofile + PART_SUFFIX, which replaces ofile only when the with block completes without error,
+       so that ofile is never left incomplete.'''
+    if ofile == '-':
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+    elif atomic:
+        part = ofile + PART_SUFFIX
+        try:
+            with open(part, 'wb') as f:
+                yield f
+            os.replace(part, ofile)
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+    else:
+        with open(ofile, 'wb') as f:
+            yield f
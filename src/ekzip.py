@@ -1,215 +1,1820 @@
 # import numpy as np
 import sys
+import csv
+import io
+import json
 import struct
-from ektools import ekfile  # , parse
-from ektools.simrad_parsers import SimradRawParser
-from simrad_compressed_parser import SimradRawZParser
+import zlib
+from simrad_compressed_parser import SimradRawZParser, SimradIndexZParser, SimradTrailerZParser, INDEX_ENTRY
+from simrad_compressed_parser import SimradDictionaryZParser, SimradConfigZParser, CONFIG_ENTRY
+from simrad_compressed_parser import ZF_BANDS, ZF_CONFIG, ZF_POWER_INT, ZF_ANGLE_INT, ZF_WAVELET, ZF_CHECKSUM, ZF_SAMPLES
+from simrad_compressed_parser import ZF_POWER_WIDE, ZF_COMPLEX_WIDE
+from simrad_compressed_parser import checksum_matches, ZFLAGS_OFFSETS
+from simrad_compressed_parser import SimradGroupZParser, GROUP_PING, PrecompiledRawParser
 import numpy as np
 import wavelets as W
+import ekprof as P
+import ekzarr as Z
+from ekzio import dgram_write, datagrams, open_output, follow_datagrams, next_file, first_bad_datagram, PART_SUFFIX
+from ekzio import has_datagram
 import argparse
 import os
+import re
+import shutil
+import time
+from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import partial
+from itertools import chain, islice
 
+# Parsers of each datagram type, reused for every datagram
+RAW_PARSER = PrecompiledRawParser()
+RAZ_PARSER = SimradRawZParser()
+RZG_PARSER = SimradGroupZParser()
+ZDI_PARSER = SimradDictionaryZParser()
+ZCF_PARSER = SimradConfigZParser()
+EKX_PARSER = SimradIndexZParser()
+EKT_PARSER = SimradTrailerZParser()
 
-# or just use dgram_write from eksplit?  Or finalize_datagram?
-def dgram_write(f, dgram):
-    """Write a datagram to a file"""
-    hdr = struct.pack('<l', len(dgram))
-    f.write(hdr)
-    f.write(dgram)
-    f.write(hdr)
+# Number of datagrams sent to a worker process at a time when running with jobs > 1
+BATCH_SIZE = 16
 
+# Datagram types that have a channel_id in the header, or for version 0 a channel number, see msg_channel_id
+CHANNEL_TYPES = ('RAW0', 'RAW3', 'RAW4', 'RAZ0', 'RAZ3', 'RAZ4', 'RZG3', 'RZP3')
 
-def raw2raz(data, wavelet='db4', level=3, threshold_ratio=0.2):  # (dgram):
-    '''Convert the dict representing a RAW type datagram into a RAZ compressed datatgram'''
+# Ping datagrams that are compressed, each into the RAZ datagram of the same version
+PING_TYPES = ('RAW0', 'RAW3', 'RAW4')
+RAZ_TYPES = ('RAZ0', 'RAZ3', 'RAZ4')
+
+# Datagrams added by ekzip, that are not part of the RAW data
+EKZ_TYPES = ('EKX0', 'EKT0', 'ZDI0', 'ZCF0')
+
+# Datagrams that must be loaded before decompressing the RAZ datagrams following them
+CONTEXT_TYPES = ('ZDI0', 'ZCF0')
+
+# Wavelet configurations of RAZ3 datagrams with the ZF_CONFIG flag, by ID, see load_config
+CONFIGS = {}
+
+# Pseudo datagram type for a group of RAW3 pings waiting to be compressed together, see group_pings
+GROUP = 'RAWG'
+
+# Size of the RZP3 placeholder of a ping in a group, with its length fields, see group_pings
+PLACEHOLDER_SIZE = 144
+
+# Suffix for the cached index of .ekz files without an index footer
+INDEX_SUFFIX = '.ekx'
+
+# Number of pings between latency reports when following a file
+REPORT_PINGS = 1000
+
+# Suffix of the Zarr stores written by export_zarr
+ZARR_SUFFIX = '.zarr'
+
+# Number of pings per chunk of the arrays written by export_zarr
+EXPORT_CHUNK = 64
+
+# Wavelet, level and threshold chosen by tune_channels, by (channel_id, data_type), for the file being compressed
+TUNED = {}
+
+# Wavelet levels tried by tune_channels
+TUNE_LEVELS = (2, 3, 4, 5)
+
+
+def make_config(channel_id, count, wavelet, level):
+    '''The CONFIG_ENTRY for the given wavelet configuration.  The ID is derived from the contents,
+       like zstd dictionary IDs, so that every process assigns the same ID to the same configuration,
+       and configurations from different files are unlikely to clash.'''
+    entry = np.zeros(1, dtype=CONFIG_ENTRY)[0]
+    entry['channel_id'] = channel_id.encode('latin_1')
+    entry['count'] = count
+    entry['wavelet'] = wavelet.encode('latin_1')
+    entry['level'] = level
+    entry['config_id'] = zlib.crc32(entry.tobytes()[4:])
+    return entry
+
+
+def load_config(entry):
+    '''Register a CONFIG_ENTRY, precomputing what decompression needs'''
+    wavelet = entry['wavelet'].decode('latin_1')
+    CONFIGS[int(entry['config_id'])] = {'wavelet': W.pywt.Wavelet(wavelet), 'level': int(entry['level']),
+                                        'shapes': W.band_sizes(int(entry['count']), wavelet, int(entry['level']))}
+
+
+def msg_channel_id(msg):
+    '''The channel_id of the contents of a datagram of one of the CHANNEL_TYPES, as the parser decodes it,
+       or for RAW0 and RAZ0 datagrams the channel number as a string'''
+    if msg[3:4] == b'0':
+        return str(struct.unpack_from('<h', msg, 12)[0])
+    channel_id = bytes(msg[12:140])
+    try:
+        channel_id = channel_id.decode('utf-8')
+    except UnicodeDecodeError:
+        channel_id = channel_id.decode('latin_1')
+    return channel_id.strip('\x00')
+
+
+def msg_channel(msg):
+    '''The channel_id and data_type of the contents of a ping datagram, as the parser decodes them,
+       for RAW0 the channel number (see msg_channel_id) and the mode instead'''
+    if msg[3:4] == b'0':
+        return msg_channel_id(msg), struct.unpack_from('<h', msg, 14)[0]
+    data_type, = struct.unpack_from('<H', msg, 140)
+    return msg_channel_id(msg), data_type
+
+
+def msg_count(msg):
+    '''The number of samples of the contents of a ping datagram'''
+    count, = struct.unpack_from('<l', msg, 80 if msg[3:4] == b'0' else 148)
+    return count
+
+
+def data_channel_id(data):
+    '''The channel_id of a dict representing a RAW or RAZ datagram, for version 0 as for msg_channel_id'''
+    return data['channel_id'] if 'channel_id' in data else str(data['channel'])
+
+
+def sample_type(data):
+    '''The data_type of a dict representing a RAW or RAZ datagram, for version 0 the mode,
+       which has the same bits for power and angle samples'''
+    return data['data_type'] if 'data_type' in data else data['mode']
+
+
+def ping_config(msg, wavelet='db4', level=3):
+    '''The CONFIG_ENTRY used when compressing the contents of a ping datagram, or None if it has no samples'''
+    count = msg_count(msg)
+    if count <= 0:
+        return None
+    return make_config(msg_channel(msg)[0], count, wavelet, level)
+
+
+def ping_params(msg, params, wavelet='db4', level=3, threshold=0.2):
+    '''The wavelet, level and threshold for the contents of a ping datagram, from params
+       by (channel_id, data_type) as in TUNED, or else as given'''
+    if not params:
+        return wavelet, level, threshold
+    return params.get(msg_channel(msg), (wavelet, level, threshold))
+
+
+def raw2raz(data, wavelet='db4', level=3, threshold_ratio=0.2, bands=False, config=True,
+            power_codec='wavelet', angle_codec='zstd', target=None):  # (dgram):
+    '''Convert the dict representing a RAW type datagram into a RAZ compressed datatgram.
+       With bands, each band of coefficients is compressed separately (ZF_BANDS), so that
+       the datagram can be decompressed at a lower resolution without decoding the finer bands.
+       With config, the datagram refers to a configuration entry (ZF_CONFIG, see make_config)
+       instead of storing the wavelet level and shapes itself, and otherwise a wavelet other
+       than db4 is stored in the datagram (ZF_WAVELET).
+       Power is compressed with the wavelet, or losslessly with the 'zstd' or 'delta' codec
+       (see wavelets.compress_int), and angles are stored as they are ('raw') or with these codecs.
+       With a target error (see wavelets.error_budget), the wavelet thresholds are chosen per ping
+       and channel to meet it, instead of by threshold_ratio.
+       RAW0 (EK60) and RAW4 datagrams are converted like RAW3, RAW0 having power and angle samples only.'''
     data = data.copy()
     match data['type']:
-        case 'RAW3':
+        case 'RAW0' | 'RAW3' | 'RAW4':
             data['type'] = 'RAZ' + data['type'][3]
+            data['zflags'] = ZF_BANDS if bands else 0
             data['zlevel'] = level
+            channel_id = data_channel_id(data)
+            data.setdefault('n_complex', 0)  # RAW0 has no complex samples, as RAZ0 is parsed
+            # pings without samples have empty arrays, which are not stored
+            wavelet_power = data['count'] > 0 and data['power'] is not None and power_codec == 'wavelet'
+            if config and data['count'] > 0 and (data['n_complex'] > 0 or wavelet_power):
+                entry = make_config(channel_id, data['count'], wavelet, level)
+                data['zconfig'] = int(entry['config_id'])
+                data['zflags'] |= ZF_CONFIG
+                if data['zconfig'] not in CONFIGS:
+                    load_config(entry)
+            elif wavelet != 'db4' and data['count'] > 0 and (data['n_complex'] > 0 or wavelet_power):
+                data['zwavelet'] = wavelet
+                data['zflags'] |= ZF_WAVELET
 
             if data['n_complex'] > 0:
-                zcomplex = []
-                for i in range(data['n_complex']):
-                    zd, wl, lv, sh = W.compress(data['complex'][:, i],
-                                                wavelet=wavelet, level=level, threshold_ratio=threshold_ratio)
-                    zcomplex.append(zd)  # oh fuck, it's a tuple, real/imag
-
+                zcomplex, wl, lv, sh = W.compress_batch(data['complex'], wavelet=wavelet, level=level, threshold_ratio=threshold_ratio,
+                                                        key=channel_id, bands=bands, target=target)
                 data['zlevel'] = lv
                 data['zshapes'] = [s[0] for s in sh]
                 data['zcomplex'] = zcomplex
                 del data['complex']
-            if data['power'] is not None:  # set to None if not present by the Simrad parser
-                zd, wl, lv, sh = W.compress1(data['power'], wavelet=wavelet, level=level, threshold_ratio=threshold_ratio)
+            if wavelet_power:  # power is set to None if not present by the Simrad parser
+                zd, wl, lv, sh = W.compress1(data['power'], wavelet=wavelet, level=level, threshold_ratio=threshold_ratio,
+                                             key=channel_id, bands=bands, target=target)
                 data['zpower'] = zd
                 data['zpshapes'] = [s[0] for s in sh]
                 del data['power']
-            if data['angle'] is not None:  # as above
-                for i in range(data['count']):
-                    pass
+            elif data['power'] is not None and data['count'] > 0:
+                data['zpower'] = W.compress_int(data['power'], delta=power_codec == 'delta',
+                                                key=(channel_id, 'ipower'))
+                data['zflags'] |= ZF_POWER_INT
+                del data['power']
+            if data['angle'] is not None and angle_codec != 'raw' and data['count'] > 0:  # as above
+                data['zangle'] = W.compress_int(data['angle'], delta=angle_codec == 'delta',
+                                                key=(channel_id, 'angle'))
+                data['zflags'] |= ZF_ANGLE_INT
+                del data['angle']
         case _:
             assert False, f'Datagram type {data['type']} not supported.'
 
     return data
 
 
-def raz2raw(data):  # dgram:
-    '''Convert the dict representing a RAZ compressed datagram into a RAW datatgram'''
+def lod_count(count, lod):
+    '''The number of samples in a ping of count samples decompressed at level of detail lod'''
+    return -(-count >> lod)
+
+
+def zconfig(data):
+    '''The wavelet, level, and band sizes of the complex and of the power samples,
+       of a dict representing a RAZ3 datagram'''
+    if data['zflags'] & ZF_CONFIG:
+        config = CONFIGS[data['zconfig']]
+        return config['wavelet'], config['level'], config['shapes'], config['shapes']
+    return data.get('zwavelet', 'db4'), data['zlevel'], data['zshapes'], data.get('zpshapes')
+
+
+def wavelet_level(data):
+    '''The number of levels of the wavelet transform of the samples of a dict representing a RAZ
+       datagram, or None if it has no wavelet compressed samples'''
+    if data['count'] <= 0:
+        return None
+    if data['zflags'] & ZF_CONFIG:
+        return CONFIGS[data['zconfig']]['level']
+    if data['zlevel'] is not None:
+        return data['zlevel']
+    if data.get('zpshapes') is not None:
+        return len(data['zpshapes']) - 1
+    return None
+
+
+def check_lod(data, lod, level):
+    '''Raise a ValueError unless the samples of the dict representing a RAZ or RZG3 datagram,
+       transformed with the given number of wavelet levels (or None), can be decompressed at lod'''
+    if lod < 0 or level is not None and lod > level:
+        raise ValueError(f'Level of detail {lod} is not between 0 and the {level} wavelet levels '
+                         f'of {data_channel_id(data)} at {data["timestamp"]}')
+
+
+def decode_complex(data, out=None, lod=0):
+    '''Decompress the complex samples of a dict representing a RAZ3 datagram,
+       as a count × sectors array or into out'''
+    wavelet, level, shapes, _ = zconfig(data)
+    shapes = [(s,) for s in shapes]
+    return W.decompress_batch(data['zcomplex'], wavelet, level=level, shapes=shapes, out=out,
+                              bands=bool(data['zflags'] & ZF_BANDS), lod=lod)[:lod_count(data['count'], lod)]
+
+
+def decode_power(data, out=None, lod=0):
+    '''Decompress the power samples of a dict representing a RAZ3 datagram, as an int16 array or into out'''
+    if data['zflags'] & ZF_POWER_INT:
+        return decode_int(data['zpower'], np.int16, (data['count'],), out, lod)
+    wavelet, level, _, shapes = zconfig(data)
+    bands = bool(data['zflags'] & ZF_BANDS)
+    if out is not None:
+        return W.decompress1(data['zpower'], wavelet, level=level, shapes=shapes, out=out, bands=bands, lod=lod)
+    power = W.decompress1(data['zpower'], wavelet, level=level, shapes=shapes, bands=bands, lod=lod)
+    return power[:lod_count(data['count'], lod)].astype(np.int16)
+
+
+def decode_angle(data, out=None, lod=0):
+    '''The angle samples of a dict representing a RAZ3 datagram, as a count × 2 int8 array or into out'''
+    if data.get('zangle') is not None:
+        return decode_int(data['zangle'], np.int8, (data['count'], 2), out, lod)
+    angle = data['angle'][::2 ** lod]
+    if out is not None:
+        out[...] = angle
+        return out
+    return np.ascontiguousarray(angle)
+
+
+def decode_int(zdata, dtype, shape, out=None, lod=0):
+    '''Decompress samples compressed with wavelets.compress_int, decimated to 1/2^lod of the resolution'''
+    samples = W.decompress_int(zdata, dtype, shape)
+    if lod > 0:
+        samples = np.ascontiguousarray(samples[::2 ** lod])
+    if out is not None:
+        out[...] = samples
+        return out
+    return samples
+
+
+def raz2raw(data, lod=0):  # dgram:
+    '''Convert the dict representing a RAZ compressed datagram into a RAW datatgram.
+       With lod > 0, the samples are reconstructed at 1/2^lod of the resolution (see
+       wavelets.reconstruct), and the angles decimated to match, reducing count accordingly.
+       The finer bands are then not decompressed if the datagram has them stored separately.'''
     data = data.copy()
     match data['type']:
-        case 'RAZ3':
+        case 'RAZ0' | 'RAZ3' | 'RAZ4':
+            check_lod(data, lod, wavelet_level(data))
             data['type'] = 'RAW' + data['type'][3]
-            level = data['zlevel']
 
             if data['n_complex'] > 0:
-                shapes = [(s,) for s in data['zshapes']]
-                complex = []
-                for i in range(data['n_complex']):
-                    zd = W.decompress(data['zcomplex'][i], 'db4', level=level, shapes=shapes)
-                    complex.append(zd[:data['count']])
-                data['complex'] = np.column_stack(complex)
+                data['complex'] = decode_complex(data, lod=lod)
             else:
                 data['complex'] = None
 
             if 'zpower' in data.keys() and data['zpower'] is not None:
-                data['power'] = W.decompress1(data['zpower'], 'db4', level=level, shapes=data['zpshapes'])[:data['count']].astype(np.int16)
-                del data['zpshapes']
+                data['power'] = decode_power(data, lod=lod)
+                data.pop('zpshapes', None)
                 del data['zpower']
 
-            del data['zlevel']
-            del data['zshapes']
-            del data['zcomplex']
+            if data['count'] > 0 and sample_type(data) & 0b10:
+                data['angle'] = decode_angle(data, lod=lod)
+                data.pop('zangle', None)
+
+            if lod > 0:
+                data['count'] = lod_count(data['count'], lod)
+
+            del data['zflags']
+            data.pop('zconfig', None)
+            data.pop('zwavelet', None)
+            data.pop('zsamples', None)
+            data.pop('zcrc', None)
+            data.pop('zlevel', None)
+            data.pop('zshapes', None)
+            data.pop('zcomplex', None)
         case _:
             assert False, f'Datagram type {data['type']} not supported.'
 
     return data
 
 
-def stats(dk, rk, eps=1e-8):
-    assert dk.dtype == dk.dtype, f'Type mismatch, original: {dk.dtype}, reconstructed: {rk.dtype}'
+def sample_hash(data):
+    '''The CRC32 of the complex, power and angle samples of the dict representing a RAW3 datagram,
+       as stored in RAZ3 datagrams with ZF_SAMPLES for those decompressed from them'''
+    crc = 0
+    for field in FIELDS:
+        if data.get(field) is not None:
+            crc = zlib.crc32(np.ascontiguousarray(data[field]), crc)
+    return crc
+
+
+def raw2rzg(datas, wavelet='db4', level=3, threshold_ratio=0.2, power_codec='wavelet', angle_codec='zstd',
+            target=None):
+    '''Convert the dicts representing RAW3 datagrams from one channel, with the same data type
+       and count, into the dict representing a RZG3 group datagram.  The codecs are as for raw2raz,
+       except that angles are always compressed.'''
+    first = datas[0]
+    channel_id = first['channel_id']
+    zdata = {'type': 'RZG3', 'low_date': first['low_date'], 'high_date': first['high_date'],
+             'channel_id': channel_id, 'data_type': first['data_type'], 'zflags': 0,
+             'count': first['count'], 'zlevel': level,
+             'pings': np.array([(d['low_date'], d['high_date'], d['offset']) for d in datas], dtype=GROUP_PING)}
+    if wavelet != 'db4':
+        zdata['zwavelet'] = wavelet
+        zdata['zflags'] |= ZF_WAVELET
+    if first['n_complex'] > 0:
+        zdata['zcomplex'], wl, lv, dtype = W.compress_group(np.stack([d['complex'] for d in datas]), wavelet=wavelet,
+                                                            level=level, threshold_ratio=threshold_ratio,
+                                                            key=channel_id, target=target)
+        if dtype != W.CAST:
+            zdata['zflags'] |= ZF_COMPLEX_WIDE
+    if first['power'] is not None and power_codec == 'wavelet':
+        zdata['zpower'], wl, lv, dtype = W.compress_group1(np.stack([d['power'] for d in datas]), wavelet=wavelet,
+                                                           level=level, threshold_ratio=threshold_ratio,
+                                                           key=channel_id, target=target)
+        if dtype != W.CAST:
+            zdata['zflags'] |= ZF_POWER_WIDE
+    elif first['power'] is not None:
+        # the pings as columns, compressed along range
+        zdata['zpower'] = W.compress_int(np.stack([d['power'] for d in datas], axis=1), delta=power_codec == 'delta',
+                                         key=(channel_id, 'ipower'))
+        zdata['zflags'] |= ZF_POWER_INT
+    if first['angle'] is not None:
+        zdata['zangle'] = W.compress_int(np.stack([d['angle'] for d in datas], axis=1), delta=angle_codec == 'delta',
+                                         key=(channel_id, 'angle'))
+    return zdata
+
+
+def rzg2raw(zdata, lod=0):
+    '''Convert the dict representing a RZG3 group datagram into a list of RAW3 datagrams,
+       with lod > 0 at reduced resolution as for raz2raw'''
+    pings, count, level = zdata['n_pings'], zdata['count'], zdata['zlevel']
+    wavelet = zdata.get('zwavelet', 'db4')
+    wavelets = zdata['zcomplex'] is not None or zdata['zpower'] is not None and not zdata['zflags'] & ZF_POWER_INT
+    check_lod(zdata, lod, level if wavelets else None)
+    complex_data = power = angle = None
+    if zdata['zcomplex'] is not None:
+        complex_data = W.decompress_group(zdata['zcomplex'], wavelet, level, pings, count, lod=lod,
+                                          dtype=np.float32 if zdata['zflags'] & ZF_COMPLEX_WIDE else W.CAST)
+    if zdata['zpower'] is not None and zdata['zflags'] & ZF_POWER_INT:
+        power = decode_int(zdata['zpower'], np.int16, (count, pings), lod=lod).T
+    elif zdata['zpower'] is not None:
+        power = W.decompress_group1(zdata['zpower'], wavelet, level, pings, count, lod=lod,
+                                    dtype=np.float32 if zdata['zflags'] & ZF_POWER_WIDE else W.CAST)
+        if not np.isfinite(power).all():
+            raise ValueError(f'Non-finite power samples in the group of {data_channel_id(zdata)} at {zdata["timestamp"]}')
+        power = power.astype(np.int16)
+    if zdata['zangle'] is not None:
+        angle = decode_int(zdata['zangle'], np.int8, (count, pings, 2), lod=lod).transpose(1, 0, 2)
+
+    datas = []
+    for i, ping in enumerate(zdata['pings']):
+        datas.append({'type': 'RAW3', 'low_date': int(ping['low_date']), 'high_date': int(ping['high_date']),
+                      'channel_id': zdata['channel_id'], 'data_type': zdata['data_type'],
+                      'offset': int(ping['offset']), 'count': lod_count(count, lod), 'n_complex': zdata['n_complex'],
+                      'complex': None if complex_data is None else complex_data[i],
+                      'power': None if power is None else np.ascontiguousarray(power[i]),
+                      'angle': None if angle is None else np.ascontiguousarray(angle[i])})
+    return datas
+
+
+# Fields of RAW3 datagrams covered by the statistics, and 'datagram' for the complete datagrams
+FIELDS = ('complex', 'power', 'angle')
+
+# Columns of the statistics, see ErrorStats
+STAT_COLUMNS = ('level', 'threshold', 'channel', 'field', 'pings', 'samples', 'size', 'zsize', 'ratio',
+                'mae', 'mse', 'mape', 'max_error')
+
+
+def field_stats(dk, rk, eps=1e-8):
+    '''The number of samples, the sums of the absolute, squared and relative errors, and the maximal
+       absolute error of the reconstructed samples rk of a field, as a list for ErrorStats.add'''
     assert dk.shape == rk.shape, f'Shape mismatch, original: {dk.shape}, reconstructed: {rk.shape}'
-    diff = dk - rk
-    abs_diff = np.abs(diff)
-    mae = np.mean(abs_diff)
-    mse = np.mean(abs_diff ** 2)
+    abs_diff = np.abs(dk.astype(rk.dtype if rk.dtype.kind in 'fc' else np.float64) - rk)
     denom = np.abs(dk)
     with np.errstate(divide='ignore', invalid='ignore'):
-        mape = np.mean(np.abs(diff / (dk + eps * (denom == 0))))
-        mape = np.nan_to_num(mape) * 100
-    return mae, mse, mape
-
-
-def comptest(fname, level, threshold_ratio):
-    '''Test compression functionality by compressing and decompressing all RAW datagrams'''
-    for dgram in ekfile(fname).datagrams():
-        if dgram[0] == 'RAW3':
-            data = SimradRawParser().from_string(dgram[3], len(dgram[3]))
-            zdata = raw2raz(data, level=level, threshold_ratio=threshold_ratio)
-            zd = SimradRawZParser().to_string(zdata)
-            zr = SimradRawZParser().from_string(zd[4:], len(zd) - 8)
-            rdata = raz2raw(zr)
-
-            # added_fields = []
-            # for k in zdata.keys():
-            #     if k not in data.keys():
-            #         added_fields.append(k)
-            # if added_fields: print(f'Compressed data contains new fields {added_fields}.')
-            # lost_fields = []
-            # for k in data.keys():
-            #     if k not in zdata.keys():
-            #         lost_fields.append(k)
-            # if lost_fields: print(f'Compressed data do not contain fields {lost_fields}.')
-
-            for k in rdata.keys():
-                if k not in data.keys():
-                    print(f'Warning: found field "{k}" in recovered data, not present in original')
-                elif type(data[k]) is not type(rdata[k]):
-                    print(f'Warning: field "{k}" does not have correct type: {type(data[k])} vs {type(rdata[k])}')
-            for k in data.keys():
-                if k not in rdata.keys():
-                    print(f'Warning: did not find field "{k}" in recovered data')
-            for k in ['complex', 'angles', 'power']:
-                if k in data.keys() and data[k] is not None:
-                    dsize = data[k].nbytes
-                    if k == 'complex':
-                        zsize = 0
-                        for z in zdata['z' + k]:
-                            zsize += sum(len(y) for y in z)
-                    else:
-                        zsize = zdata['z' + k].nbytes 
-                    mae, mse, mape = stats(data[k], rdata[k])
-                    print(f'Field:\t{k}\tUncomp:\t{dsize:6}\tComp:\t{zsize:6}\t'
-                          f'{100.0 * zsize / dsize:.1f}%\t', end='')
-                    print(f'MAE:\t{mae}\tMAPE:\t{mape}%\tMSE:\t{mse}')
-
-
-def compress(fname, ofile=None, level=3, threshold=0.2):
-    '''Process a RAW file and replace RAWx datagrams with RAZx compressed datagrams.'''
-    if ofile:
-        outfile = open(ofile, 'wb')
-    elif fname == '-' or ofile == '-':
-        outfile = sys.stdout.buffer
-    elif not os.path.exists(fname + '.ekz'):
-        outfile = open(fname + '.ekz', 'wb')
+        rel = np.nan_to_num(abs_diff / (denom + eps * (denom == 0)))
+    return [abs_diff.size, float(abs_diff.sum()), float(np.square(abs_diff, dtype=np.float64).sum()),
+            float(rel.sum()), float(abs_diff.max(initial=0))]
+
+
+class ErrorStats():
+    '''Running sums for the errors and sizes of one field of one channel, with one parameter setting'''
+
+    def __init__(self):
+        self.pings = 0
+        self.samples = 0
+        self.abs_error = 0.0
+        self.sq_error = 0.0
+        self.rel_error = 0.0
+        self.max_error = 0.0
+        self.size = 0
+        self.zsize = 0
+
+    def add(self, size, zsize, errors=None):
+        '''Add a ping, with the uncompressed and compressed sizes, and the errors from field_stats'''
+        self.pings += 1
+        self.size += size
+        self.zsize += zsize
+        if errors is not None:
+            samples, abs_error, sq_error, rel_error, max_error = errors
+            self.samples += samples
+            self.abs_error += abs_error
+            self.sq_error += sq_error
+            self.rel_error += rel_error
+            self.max_error = max(self.max_error, max_error)
+
+    def row(self):
+        '''The pings, samples, sizes, ratio, MAE, MSE, MAPE (%) and maximal error, as in STAT_COLUMNS'''
+        n = max(self.samples, 1)
+        return (self.pings, self.samples, self.size, self.zsize, self.size / max(self.zsize, 1),
+                self.abs_error / n, self.sq_error / n, 100 * self.rel_error / n, self.max_error)
+
+
+def dgram_stats(msg, grid=((3, 0.2),), **kwargs):
+    '''Compress and decompress the contents of a ping datagram with each (level, threshold) in grid,
+       returns the channel_id and a list of (level, threshold, field, size, zsize, errors) for ErrorStats.
+       Other keyword arguments are passed on to raw2raz.'''
+    P.datagram(msg)
+    with P.stage('parse', len(msg)):
+        data = RAW_PARSER.from_string(msg, len(msg))
+    results = []
+    for level, threshold in grid:
+        zdata = raw2raz(data, level=level, threshold_ratio=threshold, **kwargs)
+        with P.stage('pack') as stage:
+            zd = RAZ_PARSER.to_string(dict(zdata))
+            stage.nbytes = len(zd)
+        with P.stage('parse', len(zd)):
+            zr = RAZ_PARSER.from_string(zd[4:], len(zd) - 8)
+        rdata = raz2raw(zr)
+        results.append((level, threshold, 'datagram', len(msg) + 8, len(zd), None))
+        if data['count'] <= 0:
+            continue
+        for k in FIELDS:
+            if data.get(k) is None:
+                continue
+            if k == 'complex':
+                zsize = sum(len(z) for zc in zdata['zcomplex'] for z in zc)
+            elif 'z' + k in zdata:
+                zsize = len(zdata['z' + k])
+            else:  # stored as it is
+                zsize = data[k].nbytes
+            results.append((level, threshold, k, data[k].nbytes, zsize, field_stats(data[k], rdata[k])))
+    return data_channel_id(data), results
+
+
+def comptest(fnames, grid=((3, 0.2),), jobs=1, **kwargs):
+    '''Test compression by compressing and decompressing all ping datagrams of the files, with each
+       (level, threshold) in grid, in a single pass and with jobs worker processes.  Returns the
+       ErrorStats by (level, threshold, channel, field), other keyword arguments are as for raw2raz.'''
+    if isinstance(fnames, str):
+        fnames = [fnames]
+    dgrams = chain.from_iterable(datagrams(fname) for fname in fnames)
+    if P.PROFILE is not None:
+        dgrams = P.timed_datagrams(dgrams)
+    results = {}
+    convert = partial(dgram_stats, grid=tuple(grid), **kwargs)
+    for _, converted in convert_datagrams(dgrams, PING_TYPES, convert, jobs):
+        if converted is not None:
+            channel_id, fields = converted
+            for level, threshold, field, size, zsize, errors in fields:
+                results.setdefault((level, threshold, channel_id, field), ErrorStats()).add(size, zsize, errors)
+    return results
+
+
+def write_stats(results, ofile='-', fmt='table'):
+    '''Write the statistics from comptest as an aligned table, CSV or JSON'''
+    rows = [key + stats.row() for key, stats in sorted(results.items())]
+    out = io.StringIO()
+    if fmt == 'json':
+        json.dump([dict(zip(STAT_COLUMNS, row)) for row in rows], out, indent=1)
+        out.write('\n')
+    elif fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(STAT_COLUMNS)
+        writer.writerows(rows)
     else:
-        print('Output file exists?')
-        exit()
-    for dgram in ekfile(fname).datagrams():
-        if dgram[0] == 'RAW3':   # replace with compressed version
-            data = SimradRawParser().from_string(dgram[3], len(dgram[3]))
-            zdata = raw2raz(data, level=level, threshold_ratio=threshold)
-            zd = SimradRawZParser().to_string(zdata)
-            outfile.write(zd)
+        out.write(f'{"level":>5} {"thresh":>6}  {"channel":<36} {"field":<8} {"pings":>6} {"size":>11} '
+                  f'{"zsize":>10} {"ratio":>6}  {"MAE":>9} {"MSE":>9} {"MAPE%":>8} {"max":>9}\n')
+        for level, threshold, channel, field, pings, _, size, zsize, ratio, mae, mse, mape, max_error in rows:
+            out.write(f'{level:5d} {threshold:6.3f}  {channel:<36} {field:<8} {pings:6d} {size:11d} {zsize:10d} '
+                      f'{ratio:6.2f}  {mae:9.3g} {mse:9.3g} {mape:8.3g} {max_error:9.3g}\n')
+    with open_output(ofile) as f:
+        f.write(out.getvalue().encode('utf-8'))
+
+
+def compress_dgram(msg, level=3, threshold=0.2, bands=False, power_codec='wavelet', angle_codec='zstd', target=None,
+                   params=None, checksum=False, hash_samples=False):
+    '''Compress the contents of a RAW0, RAW3 or RAW4 datagram, returning the complete RAZ datagram
+       of the same version.
+       The parameters of channels in params (see tune_channels) replace level and threshold.
+       With checksum, the datagram ends with a CRC32 of its contents (ZF_CHECKSUM), and with
+       hash_samples it holds a CRC32 of the samples it decompresses to (ZF_SAMPLES, see sample_hash).'''
+    P.datagram(msg)
+    wavelet, level, threshold = ping_params(msg, params, level=level, threshold=threshold)
+    with P.stage('parse', len(msg)):
+        data = RAW_PARSER.from_string(msg, len(msg))
+    zdata = raw2raz(data, wavelet=wavelet, level=level, threshold_ratio=threshold, bands=bands,
+                    power_codec=power_codec, angle_codec=angle_codec, target=target)
+    if hash_samples and zdata['count'] > 0:
+        with P.stage('hash'):
+            zdata['zsamples'] = sample_hash(raz2raw(zdata))
+            zdata['zflags'] |= ZF_SAMPLES
+    if checksum:
+        zdata['zflags'] |= ZF_CHECKSUM
+    with P.stage('pack') as stage:
+        zd = RAZ_PARSER.to_string(zdata)
+        stage.nbytes = len(zd)
+    return zd
+
+
+def compress_group(msgs, level=3, threshold=0.2, power_codec='wavelet', angle_codec='zstd', target=None, params=None,
+                   checksum=False):
+    '''Compress the contents of RAW3 datagrams from one channel with the same data type and count,
+       returning the complete RZG3 datagram, with params and checksum as for compress_dgram'''
+    P.datagram(msgs[0])
+    wavelet, level, threshold = ping_params(msgs[0], params, level=level, threshold=threshold)
+    with P.stage('parse', sum(len(msg) for msg in msgs)):
+        datas = [RAW_PARSER.from_string(msg, len(msg)) for msg in msgs]
+    zdata = raw2rzg(datas, wavelet=wavelet, level=level, threshold_ratio=threshold, power_codec=power_codec, angle_codec=angle_codec,
+                    target=target)
+    if checksum:
+        zdata['zflags'] |= ZF_CHECKSUM
+    with P.stage('pack') as stage:
+        zd = RZG_PARSER.to_string(zdata)
+        stage.nbytes = len(zd)
+    return zd
+
+
+def decode_dgram(msg, lod=0):
+    '''Decompress the contents of a RAZ or RZG3 datagram, returning the list of the dicts representing
+       its RAW datagrams.  Raises ValueError if the checksum of the datagram, or at full resolution the
+       hash of its samples, does not match (see compress_dgram).'''
+    P.datagram(msg)
+    if checksum_matches(msg) is False:
+        raise ValueError(f'Checksum mismatch in {bytes(msg[:4]).decode("latin_1")} datagram')
+    if msg[:4] == b'RZG3':
+        with P.stage('parse', len(msg)):
+            zdata = RZG_PARSER.from_string(msg, len(msg))
+        return rzg2raw(zdata, lod=lod)
+    with P.stage('parse', len(msg)):
+        zdata = RAZ_PARSER.from_string(msg, len(msg))
+    rdata = raz2raw(zdata, lod=lod)
+    if zdata['zflags'] & ZF_SAMPLES and lod == 0 and sample_hash(rdata) != zdata['zsamples']:
+        raise ValueError(f'Decompressed samples of {data_channel_id(zdata)} at {zdata["timestamp"]} do not match their hash')
+    return [rdata]
+
+
+def decompress_dgram(msg, lod=0):
+    '''Decompress the contents of a RAZ datagram, returning the complete RAW datagram,
+       or of a RZG3 datagram, returning the list of its complete RAW3 datagrams, see decode_dgram'''
+    rdatas = decode_dgram(msg, lod=lod)
+    with P.stage('pack') as stage:
+        rdgrams = [RAW_PARSER.to_string(rdata) for rdata in rdatas]
+        stage.nbytes = sum(len(rdgram) for rdgram in rdgrams)
+    return rdgrams if msg[:4] == b'RZG3' else rdgrams[0]
+
+
+def load_context(msg):
+    '''Load a datagram needed for decompressing the RAZ datagrams following it'''
+    if msg[:4] == b'ZDI0':
+        zdict = ZDI_PARSER.from_string(msg, len(msg))
+        W.CODEC.add_dictionary((zdict['channel_id'], zdict['stream']), zdict['dictionary'])
+    elif msg[:4] == b'ZCF0':
+        for entry in ZCF_PARSER.from_string(msg, len(msg))['entries']:
+            load_config(entry)
+
+
+def _init_worker(context, profile=False):
+    if profile:
+        P.enable()
+    W.CODEC.clear()
+    CONFIGS.clear()
+    for msg in context:
+        load_context(msg)
+
+
+def _convert_batch(convert, msgs):
+    W.THRESHOLDS.clear()
+    converted = [convert(msg) for msg in msgs]
+    # the statistics of the worker are passed back with each batch
+    return converted, P.PROFILE.take() if P.PROFILE is not None else None
+
+
+def _merge_batch(kinds, batch, converted):
+    '''Pair each datagram in a batch with its converted version (or None), preserving order'''
+    converted, stats = converted.result()
+    if stats is not None and P.PROFILE is not None:
+        P.PROFILE.merge(stats)
+    converted = iter(converted)
+    for dgram in batch:
+        yield dgram, next(converted) if dgram[0] in kinds else None
+
+
+def _picklable(msg):
+    '''The contents of a datagram (or a list of them for a GROUP) as bytes, e.g. from memoryviews'''
+    return [bytes(m) for m in msg] if isinstance(msg, list) else bytes(msg)
+
+
+def convert_datagrams(dgrams, kind, convert, jobs=1, context=()):
+    '''Apply convert to the contents of all datagrams of the given kind (or kinds, as a tuple).
+       Yields (datagram, converted) pairs in input order, converted is None for other datagrams.
+       The contents in context, and datagrams of CONTEXT_TYPES in the input, are loaded before
+       converting the datagrams following them.
+       With jobs > 1, batches of datagrams are converted by a pool of worker processes, with at
+       most 2 * jobs batches in flight to keep memory use bounded.  The thresholds that error_threshold
+       starts from are forgotten at the start of each batch also with jobs <= 1, so that the output does
+       not depend on jobs.'''
+    kinds = (kind,) if isinstance(kind, str) else kind
+    context = list(context)
+    _init_worker(context)
+    if jobs <= 1:
+        for i, dgram in enumerate(dgrams):
+            if i % BATCH_SIZE == 0:
+                W.THRESHOLDS.clear()
+            if dgram[0] in CONTEXT_TYPES:
+                load_context(dgram[3])
+            yield dgram, convert(dgram[3]) if dgram[0] in kinds else None
+        return
+
+    dgrams = (dgram for dgram in dgrams)  # ekfile iterators reopen the file on each iter()
+    pending = deque()
+    pool = None
+    try:
+        while batch := list(islice(dgrams, BATCH_SIZE)):
+            new_context = [bytes(dgram[3]) for dgram in batch if dgram[0] in CONTEXT_TYPES]
+            if new_context or pool is None:
+                # (re)start the workers with all the context seen so far
+                context += new_context
+                while pending:
+                    yield from _merge_batch(kinds, *pending.popleft())
+                if pool is not None:
+                    pool.shutdown()
+                pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                           initargs=(context, P.PROFILE is not None))
+            msgs = [_picklable(dgram[3]) for dgram in batch if dgram[0] in kinds]
+            pending.append((batch, pool.submit(_convert_batch, convert, msgs)))
+            if len(pending) >= 2 * jobs:
+                yield from _merge_batch(kinds, *pending.popleft())
+        while pending:
+            yield from _merge_batch(kinds, *pending.popleft())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def compress_grouped(group, ping, msg):
+    '''Compress a GROUP item from group_pings with the group function, or a ping that it passed on
+       (RAW0 or RAW4) with the ping function, e.g. compress_group and compress_dgram.  A group whose
+       pings are smaller compressed one by one than together with their placeholders is returned as
+       the list of the datagrams of its pings, to be written in place of the placeholders.'''
+    if not isinstance(msg, list):
+        return ping(msg)
+    zd = group(msg)
+    zds = [ping(m) for m in msg]
+    if sum(len(z) for z in zds) <= len(zd) + PLACEHOLDER_SIZE * len(msg):
+        return zds
+    return zd
+
+
+def group_pings(dgrams, size):
+    '''Collect the RAW3 pings of each channel into groups of up to size pings with the same data type
+       and count, for compress_group.  Yields the datagrams in input order, with each ping replaced by
+       an RZP3 placeholder, and each group as a GROUP item, with the list of the contents of its pings,
+       before the placeholders of its pings.  Datagrams are held back until the groups before them are
+       complete, to bound this the oldest group is closed early when more than size pings per open
+       group are waiting.  Pings without samples, and RAW0 and RAW4 pings, are passed on as they are.'''
+    queue = deque()  # datagrams and groups (dicts) in output order
+    groups = {}      # the open group of each channel
+    waiting = 0      # placeholders in the queue
+    for dgram in chain(dgrams, [None]):
+        if dgram is None:  # end of input
+            for group in groups.values():
+                group['open'] = False
+            groups = {}
+        elif dgram[0] == 'RAW3' and struct.unpack_from('<l', dgram[3], 148)[0] > 0:
+            msg = dgram[3]
+            channel_id = bytes(msg[12:140])
+            layout = (bytes(msg[140:142]), bytes(msg[148:152]))  # data_type and count
+            group = groups.get(channel_id)
+            if group is not None and group['layout'] != layout:
+                group['open'] = False
+                group = None
+            if group is None:
+                group = groups[channel_id] = {'channel_id': channel_id, 'layout': layout, 'dgrams': [], 'open': True}
+                queue.append(group)
+            group['dgrams'].append(dgram)
+            # the RZP3 contents are the type followed by the date and channel_id of the ping
+            queue.append(('RZP3', 136, dgram[2], b'RZP3' + bytes(msg[4:140])))
+            waiting += 1
+            if len(group['dgrams']) >= size:
+                group['open'] = False
+                del groups[channel_id]
         else:
-            dgram_write(outfile, dgram[3])
-    if fname != '-': outfile.close()
-
-
-def decompress(fname, ofile=None):
-    '''Process a RAW file and replace RAZx datagrams with RAWx uncompressed datagrams.'''
-    if ofile:
-        outfile = open(ofile, 'wb')
-    elif fname == '-' or ofile == '-':
-        outfile = sys.stdout.buffer
-    elif fname.endswith('.ekz') and not os.path.exists(fname[:-4]):
-        outfile = open(fname[:-4], 'wb')
+            queue.append(dgram)
+
+        while queue:
+            if isinstance(queue[0], dict):
+                group = queue[0]
+                if group['open']:
+                    if waiting <= size * len(groups):
+                        break
+                    group['open'] = False
+                    del groups[group['channel_id']]
+                queue.popleft()
+                first = group['dgrams'][0]
+                yield (GROUP, sum(d[1] for d in group['dgrams']), first[2], [d[3] for d in group['dgrams']])
+            else:
+                item = queue.popleft()
+                if item[0] == 'RZP3':
+                    waiting -= 1
+                yield item
+
+
+def sample_datagrams(dgrams, pings):
+    '''Read datagrams until there are the given number of pings from every channel seen so far,
+       or ten times as many pings in total.  Returns the list of datagrams read.'''
+    head = []
+    counts = {}
+    for dgram in dgrams:
+        head.append(dgram)
+        if dgram[0] in PING_TYPES:
+            channel_id = msg_channel_id(dgram[3])
+            counts[channel_id] = counts.get(channel_id, 0) + 1
+            if min(counts.values()) >= pings or sum(counts.values()) >= 10 * pings:
+                break
+    return head
+
+
+def tune_channels(msgs, pings, level=3, threshold=0.2, target=None, power_codec='wavelet', group=0):
+    '''Choose the wavelet, level and threshold of each channel and data type from the contents of
+       up to the given number of ping datagrams per channel, for the smallest compressed size with
+       the error of db4 at the given level and threshold, or else the target error (see wavelets.tune).
+       With group > 1, the choices leave room for the transform across the pings of a group.
+       The choices are added to TUNED, and channels already there are not tuned again.  Returns TUNED.'''
+    samples = {}  # (channel_id, data_type): (first datagram, blocks)
+    for msg in msgs:
+        key = msg_channel(msg)
+        if key in TUNED or len(samples.get(key, (None, ()))[1]) >= pings:
+            continue
+        data = RAW_PARSER.from_string(msg, len(msg))
+        if data['count'] <= 0:
+            continue
+        if data.get('n_complex', 0) > 0:
+            # the real and imaginary parts of each sector as rows, with one threshold for both
+            samples.setdefault(key, (msg, []))[1].append(np.ascontiguousarray(data['complex'].view(np.float32).T))
+        elif data['power'] is not None and power_codec == 'wavelet':
+            samples.setdefault(key, (msg, []))[1].append(data['power'][None, :].astype(np.float32))
+
+    for key, (msg, blocks) in samples.items():
+        rows = 2 if key[1] >> 8 else 1
+        P.datagram(msg)
+        with P.stage('tune'):
+            wavelet, lv, ratio = W.tune(blocks, TUNE_LEVELS, 'db4', level, threshold, target, rows=rows,
+                                        headroom=np.sqrt(max(group, 1)))
+        TUNED[key] = (wavelet, lv, ratio)
+        print(f'{key[0]}: wavelet {wavelet}, level {lv}, threshold {ratio:.3f}', file=sys.stderr)
+    return TUNED
+
+
+def train_dictionaries(msgs, wavelet='db4', level=3, threshold=0.2, target=None, params=None, power_codec='wavelet'):
+    '''Train zstd dictionaries for each channel and stream from the contents of ping datagrams,
+       with params as for compress_dgram.  Power samples are only used with the wavelet power_codec.
+       Returns the contents of ZDI0 datagrams for the dictionaries that could be trained.'''
+    samples = {}
+    for msg in msgs:
+        w, lv, th = ping_params(msg, params, wavelet, level, threshold)
+        data = RAW_PARSER.from_string(msg, len(msg))
+        channel_id = data_channel_id(data)
+        if data.get('n_complex', 0) > 0:
+            comp, _ = W.transform_batch(data['complex'], wavelet=w, level=lv, threshold_ratio=th,
+                                        target=target, key=(channel_id, 'complex'))
+            samples.setdefault((channel_id, 'real'), []).extend(c.tobytes() for c in comp[0::2])
+            samples.setdefault((channel_id, 'imag'), []).extend(c.tobytes() for c in comp[1::2])
+        if data['power'] is not None and power_codec == 'wavelet':
+            comp, _ = W.transform1(data['power'], wavelet=w, level=lv, threshold_ratio=th,
+                                   target=target, key=(channel_id, 'power'))
+            samples.setdefault((channel_id, 'power'), []).append(comp.tobytes())
+
+    dictionaries = []
+    for (channel_id, stream), bufs in samples.items():
+        zdict = W.train_dictionary(bufs)
+        if zdict is not None:
+            low_date, high_date = struct.unpack_from('<LL', msgs[0], 4)
+            dgram = {'type': 'ZDI0', 'low_date': low_date, 'high_date': high_date,
+                     'dict_id': W.zstandard.ZstdCompressionDict(zdict).dict_id(),
+                     'channel_id': channel_id, 'stream': stream, 'dictionary': zdict}
+            dictionaries.append(ZDI_PARSER.to_string(dgram)[4:-4])
+    return dictionaries
+
+
+class Latency():
+    '''Statistics for the time from reading pings to writing their compressed datagrams'''
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if self.count == REPORT_PINGS:
+            self.report()
+
+    def report(self):
+        '''Print the statistics since the last report to stderr'''
+        if self.count > 0:
+            print(f'{self.fname}: {self.count} pings, latency mean {1000 * self.total / self.count:.1f} ms, '
+                  f'max {1000 * self.max:.1f} ms', file=sys.stderr)
+        self.__init__(self.fname)
+
+
+def _timed(dgrams, arrivals):
+    '''Pass on datagrams, recording the time each was read'''
+    for dgram in dgrams:
+        arrivals.append(time.perf_counter())
+        yield dgram
+
+
+def compress(fname, ofile=None, level=3, threshold=0.2, jobs=1, write_index=False, dictionary=0, follow=False,
+             progressive=False, group=0, power_codec='wavelet', angle_codec='zstd', target=None, auto=0,
+             checksum=False, hash_samples=False):
+    '''Process a RAW file and replace RAWx datagrams with RAZx compressed datagrams.
+       With write_index, an index of the datagrams is appended to the output.
+       With progressive, the bands of coefficients are stored separately, see raw2raz.
+       With group > 1, the RAW3 pings of each channel are compressed together in groups of up to that
+       many pings, see group_pings and compress_group, and other pings one by one.  Groups that would
+       not be smaller than their pings compressed one by one are written ping by ping, see compress_grouped.
+       The codecs for power and angle samples, and the target error, are as for raw2raz.
+       With dictionary > 0, zstd dictionaries are trained from that many pings of each channel,
+       and written before the first RAZ datagram.
+       With auto > 0, the wavelet, level and threshold of each channel are chosen from that many
+       pings, see tune_channels, and channels not seen in the first pings use level and threshold.
+       With checksum and hash_samples, the compressed datagrams carry checksums, see compress_dgram.
+       With follow, the file is read while it is being written, see follow_datagrams, and
+       the latency of the pings is reported.  Otherwise an output file only appears once complete.'''
+    if not ofile:
+        if fname == '-':
+            ofile = '-'
+        elif os.path.exists(fname + '.ekz'):
+            raise FileExistsError(f'Output file {fname}.ekz exists')
+        else:
+            ofile = fname + '.ekz'
+    streaming = ofile == '-' or follow  # pass each datagram on as soon as it is ready
+
+    if follow:
+        arrivals = deque()
+        latency = Latency(fname)
+        dgrams = _timed(follow_datagrams(fname), arrivals)
     else:
-        print('Output file exists, or input file has unknown suffix')
-        exit()
-    for dgram in ekfile(fname).datagrams():
-        if dgram[0] == 'RAZ3':
-            zdata = SimradRawZParser().from_string(dgram[3], len(dgram[3]))
-            rdata = raz2raw(zdata)
-            ndgram = SimradRawParser().to_string(rdata)
-            outfile.write(ndgram)
+        latency = None
+        dgrams = datagrams(fname)
+    if P.PROFILE is not None:
+        dgrams = P.timed_datagrams(dgrams)
+    dictionaries = []
+    params = None
+    if dictionary > 0 or auto > 0:
+        head = sample_datagrams(dgrams, max(dictionary, auto))
+        msgs = [dgram[3] for dgram in head if dgram[0] in PING_TYPES]
+        with P.run():
+            if auto > 0:
+                # the choices for another file do not carry over
+                TUNED.clear()
+                params = tune_channels(msgs, auto, level=level, threshold=threshold, target=target,
+                                       power_codec=power_codec, group=group)
+            if dictionary > 0:
+                dictionaries = train_dictionaries(msgs, level=level, threshold=threshold, target=target, params=params,
+                                                  power_codec=power_codec)
+        dgrams = chain(head, dgrams)
+
+    kind = PING_TYPES
+    convert = partial(compress_dgram, level=level, threshold=threshold, bands=progressive,
+                      power_codec=power_codec, angle_codec=angle_codec, target=target, params=params,
+                      checksum=checksum, hash_samples=hash_samples)
+    if group > 1:
+        dgrams = group_pings(dgrams, group)
+        kind = (GROUP, 'RAW0', 'RAW4')
+        convert = partial(compress_grouped, partial(compress_group, level=level, threshold=threshold,
+                                                    power_codec=power_codec, angle_codec=angle_codec, target=target,
+                                                    params=params, checksum=checksum), convert)
+
+    configs = set()  # IDs of the configuration entries written
+    index = DatagramIndex() if write_index else None
+    with open_output(ofile, atomic=not follow) as outfile, P.run():
+
+        def write(msg):
+            with P.stage('write', len(msg) + 8):
+                dgram_write(outfile, msg)
+            if index is not None:
+                index.add(msg, len(msg))
+            if streaming:
+                outfile.flush()
+
+        def write_compressed(msg, zd):
+            nonlocal dictionaries
+            for zdict in dictionaries:
+                write(zdict)
+            dictionaries = []
+            # zd is the complete datagram, with the zflags of RAZ datagrams after the length and part of the header
+            entry = None
+            if zd[4:7] == b'RAZ' and struct.unpack_from('<H', zd, 4 + ZFLAGS_OFFSETS[bytes(zd[4:8])])[0] & ZF_CONFIG:
+                entry = ping_config(msg, *ping_params(msg, params, level=level)[:2])
+            if entry is not None and entry['config_id'] not in configs:
+                low_date, high_date = struct.unpack_from('<LL', msg, 4)
+                table = {'type': 'ZCF0', 'low_date': low_date, 'high_date': high_date, 'entries': [entry]}
+                write(ZCF_PARSER.to_string(table)[4:-4])
+                configs.add(entry['config_id'])
+            write(memoryview(zd)[4:-4])
+
+        ungrouped = {}  # the pings of groups compressed one by one, by the date and channel_id of their placeholders
+        for dgram, zd in convert_datagrams(dgrams, kind, convert, jobs, context=dictionaries):
+            if dgram[0] != GROUP:
+                P.datagram(dgram[3])
+            if isinstance(zd, list):
+                ungrouped.update((bytes(msg[4:140]), (msg, z)) for msg, z in zip(dgram[3], zd))
+            elif dgram[0] == 'RZP3' and bytes(dgram[3][4:140]) in ungrouped:
+                write_compressed(*ungrouped.pop(bytes(dgram[3][4:140])))
+            elif zd is not None:   # replaced with compressed version
+                write_compressed(dgram[3], zd)
+            else:
+                write(dgram[3])
+            if latency is not None and dgram[0] != GROUP:
+                arrived = arrivals.popleft()
+                if dgram[0] in PING_TYPES or dgram[0] == 'RZP3':
+                    latency.add(time.perf_counter() - arrived)
+        if index is not None:
+            outfile.write(index.to_string())
+    if latency is not None:
+        latency.report()
+
+
+def follow(fname, **kwargs):
+    '''Compress a RAW file while it is being written, and then each following file in the
+       same directory as it appears (see next_file), until interrupted.'''
+    while fname is not None:
+        compress(fname, follow=True, **kwargs)
+        fname = next_file(fname)
+
+
+def decompress(fname, ofile=None, jobs=1, lod=0):
+    '''Process a RAW file and replace RAZx datagrams with RAWx uncompressed datagrams.
+       With lod > 0, the samples have reduced resolution, see raz2raw.
+       An output file only appears once complete.'''
+    if not ofile:
+        if fname == '-':
+            ofile = '-'
+        elif not fname.endswith('.ekz'):
+            raise ValueError(f'Unknown suffix of {fname}, expected .ekz')
+        elif os.path.exists(fname[:-4]):
+            raise FileExistsError(f'Output file {fname[:-4]} exists')
+        else:
+            ofile = fname[:-4]
+    streaming = ofile == '-'
+
+    grouped = {}  # the decompressed pings of RZG3 datagrams, by the date and channel_id of their placeholders
+    dgrams = datagrams(fname)
+    if P.PROFILE is not None:
+        dgrams = P.timed_datagrams(dgrams)
+    with open_output(ofile, atomic=True) as outfile, P.run():
+        for dgram, ndgram in convert_datagrams(dgrams, (*RAZ_TYPES, 'RZG3'), partial(decompress_dgram, lod=lod), jobs):
+            P.datagram(dgram[3])
+            with P.stage('write') as stage:
+                if dgram[0] == 'RZG3':
+                    for rdgram in ndgram:
+                        grouped[rdgram[8:144]] = rdgram
+                elif dgram[0] == 'RZP3':
+                    stage.nbytes = outfile.write(grouped.pop(bytes(dgram[3][4:140])))
+                elif ndgram is not None:
+                    stage.nbytes = outfile.write(ndgram)
+                elif dgram[0] not in EKZ_TYPES:
+                    dgram_write(outfile, dgram[3])
+                    stage.nbytes = len(dgram[3]) + 8
+            if streaming:
+                outfile.flush()
+
+
+class DatagramIndex():
+    '''Collects the offset, type, channel and time of the datagrams written to a file'''
+
+    def __init__(self):
+        self.channels = {}
+        self.entries = []
+        self.length = 0
+        self.date = (0, 0)
+
+    def add(self, header, length):
+        '''Add the datagram following the ones already indexed, given the start of its contents
+           (at least the type, date and channel_id) and the length of the contents'''
+        dtype = bytes(header[:4])
+        self.date = struct.unpack_from('<LL', header, 4)
+        channel = -1
+        if dtype.decode('latin_1') in CHANNEL_TYPES:
+            channel = self.channels.setdefault(msg_channel_id(header), len(self.channels))
+        self.entries.append((self.length, dtype, channel, *self.date))
+        self.length += length + 8
+
+    def to_dict(self):
+        '''Return the dict representing the index datagram'''
+        low_date, high_date = self.date
+        return {'type': 'EKX0', 'low_date': low_date, 'high_date': high_date, 'length': self.length,
+                'channels': list(self.channels), 'entries': np.array(self.entries, dtype=INDEX_ENTRY)}
+
+    def to_string(self, index_offset=None):
+        '''Return the index and trailer datagrams, by default for appending to the indexed file'''
+        low_date, high_date = self.date
+        if index_offset is None:
+            index_offset = self.length
+        trailer = {'type': 'EKT0', 'low_date': low_date, 'high_date': high_date, 'index_offset': index_offset}
+        return EKX_PARSER.to_string(self.to_dict()) + EKT_PARSER.to_string(trailer)
+
+
+def read_index(fname):
+    '''Read the index footer of an .ekz file, returns None if there is none'''
+    trailer_size = EKT_PARSER.size()
+    with open(fname, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < trailer_size:
+            return None
+        f.seek(-trailer_size, os.SEEK_END)
+        buf = f.read(trailer_size)
+        if buf[4:8] != b'EKT0' or struct.unpack_from('<l', buf)[0] != trailer_size - 8:
+            return None
+        trailer = EKT_PARSER.from_string(buf[4:-4], trailer_size - 8)
+        f.seek(trailer['index_offset'])
+        length, = struct.unpack('<l', f.read(4))
+        msg = f.read(length)
+        return EKX_PARSER.from_string(msg, length)
+
+
+def scan_index(fname):
+    '''Build an index by reading the datagram headers of a file, up to any index footer.  The context
+       datagrams (ZDI0 and ZCF0) are indexed like the others, for EkzFile to load them.'''
+    index = DatagramIndex()
+    with open(fname, 'rb') as f:
+        while len(buf := f.read(4)) == 4:
+            length, = struct.unpack('<l', buf)
+            header = f.read(min(length, 140))
+            if header[:4] in (b'EKX0', b'EKT0'):
+                break
+            index.add(header, length)
+            f.seek(length - len(header) + 4, os.SEEK_CUR)
+    return index
+
+
+class EkzFile():
+    '''Random access to the compressed sample datagrams of an .ekz file, e.g.:
+
+       for ping in EkzFile.open('D20230321-T082157.raw.ekz').select(channels=[...], start=..., end=...):
+           ...'''
+
+    def __init__(self, fname, index):
+        self.fname = fname
+        self.fhandle = open(fname, 'rb')
+        self.channels = index['channels']
+        self.entries = index['entries']
+        # NT dates are 100ns intervals since 1601-01-01
+        nt = (self.entries['high_date'].astype(np.int64) << 32) | self.entries['low_date']
+        self.timestamps = np.datetime64('1601-01-01', 'us') + (nt // 10).astype('timedelta64[us]')
+        for offset in self.entries['offset'][np.isin(self.entries['type'], [t.encode() for t in CONTEXT_TYPES])]:
+            load_context(self.read_msg(int(offset)))
+        # the entry of the group (RZG3) of each placeholder (RZP3), the last group of its channel before it
+        self.groups = {}
+        last = {}
+        for i in np.flatnonzero(np.isin(self.entries['type'], [b'RZG3', b'RZP3'])):
+            if self.entries['type'][i] == b'RZG3':
+                last[self.entries['channel'][i]] = i
+            else:
+                self.groups[i] = last.get(self.entries['channel'][i])
+
+    @classmethod
+    def open(cls, fname):
+        '''Open a file using its index footer, or else a cached index in a sidecar file,
+           which is built and written if it is missing or out of date'''
+        index = read_index(fname)
+        if index is None:
+            sidecar = fname + INDEX_SUFFIX
+            if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(fname):
+                index = read_index(sidecar)
+            if index is None or index['length'] != os.path.getsize(fname):
+                scanned = scan_index(fname)
+                try:
+                    with open(sidecar, 'wb') as f:
+                        f.write(scanned.to_string(index_offset=0))
+                except OSError:
+                    pass
+                index = scanned.to_dict()
+        return cls(fname, index)
+
+    def close(self):
+        self.fhandle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_msg(self, offset):
+        '''Read the contents of the datagram at the given offset'''
+        self.fhandle.seek(offset)
+        length, = struct.unpack('<l', self.fhandle.read(4))
+        return self.fhandle.read(length)
+
+    def read(self, offset):
+        '''Read and parse the RAZ datagram at the given offset'''
+        msg = self.read_msg(offset)
+        return RAZ_PARSER.from_string(msg, len(msg))
+
+    def find(self, channels=None, start=None, end=None):
+        '''The index entries of the pings from the given channel(s) with start <= timestamp < end, those of
+           RAZ datagrams and of the placeholders (RZP3) of pings compressed in groups'''
+        mask = np.isin(self.entries['type'], [t.encode() for t in (*RAZ_TYPES, 'RZP3')])
+        if channels is not None:
+            if isinstance(channels, str):
+                channels = [channels]
+            mask &= np.isin(self.entries['channel'], [i for i, c in enumerate(self.channels) if c in channels])
+        if start is not None:
+            mask &= self.timestamps >= np.datetime64(start, 'us')
+        if end is not None:
+            mask &= self.timestamps < np.datetime64(end, 'us')
+        return np.flatnonzero(mask)
+
+    def select(self, channels=None, start=None, end=None):
+        '''Decompress the pings from the given channel(s) with start <= timestamp < end,
+           yielding the dicts representing the RAW datagrams'''
+        selected = self.find(channels, start, end)
+        grouped = self._decode_groups(selected)
+        for i in selected:
+            yield grouped[i] if i in grouped else raz2raw(self.read(int(self.entries['offset'][i])))
+
+    def pings(self, channel, start=None, end=None, lod=0):
+        '''Decompress the pings of one channel with start <= timestamp < end directly into arrays,
+           returns a dict with timestamp and count (per ping), complex (pings × samples × sectors),
+           power (pings × samples) and angle (pings × samples × 2), or None for missing fields.
+           Pings shorter than the longest are padded with NaN (complex) or zero (power and angle).
+           With lod > 0, the pings have reduced resolution, see raz2raw.'''
+        return self._decode_pings(self.find(channel, start, end), lod)
+
+    def iter_pings(self, channel, start=None, end=None, chunk=256, lod=0):
+        '''Like pings, but yields the arrays for chunk pings at a time'''
+        selected = self.find(channel, start, end)
+        for i in range(0, len(selected), chunk):
+            yield self._decode_pings(selected[i:i + chunk], lod)
+
+    def _decode_groups(self, selected, lod=0):
+        # the pings of the placeholders among the selected entries, as dicts representing RAW3 datagrams
+        # by entry, decoded a group at a time
+        placeholders = [i for i in selected if i in self.groups]
+        pings = {}
+        for group in dict.fromkeys(self.groups[i] for i in placeholders):
+            if group is None:
+                continue
+            msg = self.read_msg(int(self.entries['offset'][group]))
+            for rdata in rzg2raw(RZG_PARSER.from_string(msg, len(msg)), lod=lod):
+                pings[group, rdata['low_date'], rdata['high_date']] = rdata
+        grouped = {}
+        for i in placeholders:
+            rdata = pings.get((self.groups[i], int(self.entries['low_date'][i]), int(self.entries['high_date'][i])))
+            if rdata is None:
+                raise ValueError(f'No group holds the ping of {self.channels[self.entries["channel"][i]]} '
+                                 f'at {self.timestamps[i]} in {self.fname}')
+            grouped[i] = rdata
+        return grouped
+
+    def _decode_pings(self, selected, lod=0):
+        # only the compressed datagrams are kept, each ping is decoded into its row of the arrays,
+        # except for the pings of groups, which are decoded a group at a time into RAW3 dicts
+        grouped = self._decode_groups(selected, lod)
+        zdata = [grouped[i] if i in grouped else self.read(int(self.entries['offset'][i])) for i in selected]
+        for d in zdata:
+            if d['type'] != 'RAW3':
+                check_lod(d, lod, wavelet_level(d))
+        counts = np.array([d['count'] if d['type'] == 'RAW3' else lod_count(d['count'], lod) for d in zdata],
+                          dtype=np.int32)
+        samples = int(counts.max(initial=0))
+        sectors = max((d['n_complex'] for d in zdata), default=0)
+        pings = {'timestamp': self.timestamps[selected], 'count': counts, 'complex': None, 'power': None, 'angle': None}
+        if sectors > 0:
+            pings['complex'] = np.full((len(zdata), samples, sectors), np.nan, dtype=np.complex64)
+        if any((d['power'] if d['type'] == 'RAW3' else d.get('zpower')) is not None for d in zdata):
+            pings['power'] = np.zeros((len(zdata), samples), dtype=np.int16)
+        if any(sample_type(d) & 0b10 and d['count'] > 0 for d in zdata):
+            pings['angle'] = np.zeros((len(zdata), samples, 2), dtype=np.int8)
+
+        for i, (d, count) in enumerate(zip(zdata, counts)):
+            if d['type'] == 'RAW3':
+                if d['complex'] is not None:
+                    pings['complex'][i, :count, :d['n_complex']] = d['complex']
+                if d['power'] is not None:
+                    pings['power'][i, :count] = d['power']
+                if d['angle'] is not None:
+                    pings['angle'][i, :count] = d['angle']
+                continue
+            if d['n_complex'] > 0:
+                decode_complex(d, out=pings['complex'][i, :count, :d['n_complex']], lod=lod)
+            if d.get('zpower') is not None:
+                decode_power(d, out=pings['power'][i, :count], lod=lod)
+            if sample_type(d) & 0b10 and count > 0:
+                decode_angle(d, out=pings['angle'][i, :count], lod=lod)
+        return pings
+
+
+def read_pings(fname, channel, start=None, end=None, lod=0):
+    '''Decompress the pings of one channel of an .ekz file into arrays, see EkzFile.pings'''
+    with EkzFile.open(fname) as f:
+        return f.pings(channel, start=start, end=end, lod=lod)
+
+
+def iter_pings(fname, channel, start=None, end=None, chunk=256, lod=0):
+    '''Decompress the pings of one channel of an .ekz file into arrays, chunk pings at a time'''
+    with EkzFile.open(fname) as f:
+        yield from f.iter_pings(channel, start=start, end=end, chunk=chunk, lod=lod)
+
+
+def channel_name(channel_id, taken=()):
+    '''A name for the group of a channel in a store, from its channel_id, different from those taken'''
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', channel_id).strip('_') or 'channel'
+    base, n = name, 1
+    while name in taken:
+        n += 1
+        name = f'{base}_{n}'
+    return name
+
+
+def export_zarr(fname, ofile=None, chunk=EXPORT_CHUNK, jobs=1, lod=0, level=Z.ZSTD_LEVEL):
+    '''Decompress the pings of each channel of an .ekz file into a Zarr (version 2) directory store, with a
+       group per channel holding the arrays complex (ping × range × sector), power (ping × range) and angle
+       (ping × range × 2), as present, in chunks of chunk pings, and the coordinates timestamp, count, offset
+       and data_type of the pings.  Samples beyond the count of a ping are NaN (complex) or zero.
+       The chunks are compressed with zstd at level, or stored as they are for level 0, see ekzarr.Array.
+       The file is read twice, first the headers only to lay out the arrays, and then to decompress it, with
+       jobs worker processes as for decompress.  With lod > 0, the pings have reduced resolution, see raz2raw.
+       The store only appears once complete.'''
+    if not ofile:
+        ofile = (fname[:-4] if fname.endswith('.ekz') else fname) + ZARR_SUFFIX
+    if os.path.exists(ofile):
+        raise FileExistsError(f'Output {ofile} exists')
+
+    # the date, data type, offset and count of the pings of each channel, in file order
+    pings = {}
+    grouped = {}  # the pings of groups, by their date and channel_id, until their placeholders
+    for dtype, length, timestamp, msg in datagrams(fname):
+        if dtype in RAZ_TYPES:
+            version = int(dtype[3])
+            header = dict(zip(RAZ_PARSER.header_fields(version), RAZ_PARSER.header_struct(version).unpack_from(msg)))
+            ping = (header['low_date'], header['high_date'], sample_type(header), header['offset'], header['count'])
+        elif dtype == 'RZG3':
+            _, _, _, _, data_type, _, count, _, _ = RZG_PARSER.header_struct(3).unpack_from(msg)
+            for p in RZG_PARSER.from_string(msg, len(msg))['pings']:
+                key = (int(p['low_date']), int(p['high_date']), msg_channel_id(msg))
+                grouped[key] = (*key[:2], data_type, int(p['offset']), count)
+            continue
+        elif dtype == 'RZP3':
+            ping = grouped.pop((*struct.unpack_from('<LL', msg, 4), msg_channel_id(msg)))
+        else:
+            continue
+        pings.setdefault(msg_channel_id(msg), []).append(ping)
+
+    part = ofile + PART_SUFFIX
+    if os.path.exists(part):
+        shutil.rmtree(part)
+    rows = {}     # the channel and row of each ping, by its date and channel_id
+    arrays = {}   # the sample arrays of each channel
+    names = {}
+    for channel_id, chpings in pings.items():
+        name = channel_name(channel_id, names)
+        names[name] = channel_id
+        group = os.path.join(part, name)
+        Z.create_group(group, {'channel_id': channel_id, 'lod': lod})
+        low_date, high_date, data_type, offset, count = (np.array(c) for c in zip(*chpings))
+        count = -(-count >> lod)  # as lod_count
+        n, samples, sectors = len(chpings), int(count.max()), int((data_type >> 8).max())
+        nt = (high_date.astype(np.int64) << 32) | low_date
+        coords = {'timestamp': np.datetime64('1601-01-01', 'us') + (nt // 10).astype('timedelta64[us]'),
+                  'count': count.astype(np.int32), 'offset': offset.astype(np.int32),
+                  'data_type': data_type.astype(np.int16)}
+        for coord, values in coords.items():
+            array = Z.Array.create(os.path.join(group, coord), (n,), (chunk,), values.dtype, dims=['ping'], level=level)
+            for i in range(0, n, chunk):
+                array.write_chunk((i // chunk,), values[i:i + chunk])
+        layout = {}
+        if sectors > 0:
+            layout['complex'] = ((samples, sectors), np.complex64, np.nan, ['ping', 'range', 'sector'])
+        if np.any(data_type & 0b1):
+            layout['power'] = ((samples,), np.int16, 0, ['ping', 'range'])
+        if np.any(data_type & 0b10):
+            layout['angle'] = ((samples, 2), np.int8, 0, ['ping', 'range', 'angle'])
+        arrays[channel_id] = {field: Z.Array.create(os.path.join(group, field), (n, *shape), (chunk, *shape), dtype,
+                                                    fill_value=fill, dims=dims, level=level)
+                              for field, (shape, dtype, fill, dims) in layout.items()}
+        for row, ping in enumerate(chpings):
+            rows.setdefault((*ping[:2], channel_id), deque()).append((channel_id, row))
+    Z.create_group(part, {'source': os.path.basename(fname), 'channels': names})
+
+    buffers = {}  # the chunks being filled, by channel and chunk number, and the number of pings in them
+
+    def flush(channel_id, i):
+        chunks, _ = buffers.pop((channel_id, i))
+        with P.stage('write'):
+            for field, array in arrays[channel_id].items():
+                array.write_chunk((i,) + (0,) * (len(array.shape) - 1), chunks[field])
+
+    dgrams = datagrams(fname)
+    if P.PROFILE is not None:
+        dgrams = P.timed_datagrams(dgrams)
+    with P.run():
+        for dgram, rdatas in convert_datagrams(dgrams, (*RAZ_TYPES, 'RZG3'), partial(decode_dgram, lod=lod), jobs):
+            for rdata in rdatas or ():
+                channel_id, row = rows[(rdata['low_date'], rdata['high_date'], data_channel_id(rdata))].popleft()
+                i, n = row // chunk, len(pings[channel_id])
+                if (channel_id, i) not in buffers:
+                    buffers[channel_id, i] = [{field: np.full(array.chunks, array.fill_value, dtype=array.dtype)
+                                               for field, array in arrays[channel_id].items()}, 0]
+                chunks = buffers[channel_id, i][0]
+                count = rdata['count']
+                if rdata.get('complex') is not None and 'complex' in chunks:
+                    chunks['complex'][row % chunk, :count, :rdata['n_complex']] = rdata['complex']
+                if rdata['power'] is not None and 'power' in chunks:
+                    chunks['power'][row % chunk, :count] = rdata['power']
+                if rdata['angle'] is not None and 'angle' in chunks:
+                    chunks['angle'][row % chunk, :count] = rdata['angle']
+                buffers[channel_id, i][1] += 1
+                if buffers[channel_id, i][1] == min(chunk, n - i * chunk):
+                    flush(channel_id, i)
+        for channel_id, i in list(buffers):
+            flush(channel_id, i)
+    os.replace(part, ofile)
+
+
+def split_name(ofile, n):
+    '''The name of the n'th file an output is split into, e.g. D20230321-T082157-0001.raw.ekz'''
+    suffix = '.ekz' if ofile.endswith('.ekz') else ''
+    root, ext = os.path.splitext(ofile[:len(ofile) - len(suffix)])
+    return f'{root}-{n:04d}{ext}{suffix}'
+
+
+def copy_datagrams(fnames, ofile, channels=None, types=None, start=None, end=None, split_time=None, split_size=None,
+                   write_index=False):
+    '''Copy the datagrams of .ekz (or RAW) files, in order as if concatenated, to ofile without decompressing
+       them, keeping only those of the given types, from the given channels, and with start <= timestamp < end.
+       Only the type, date and channel_id in the headers are read.  The context datagrams (ZDI0 and ZCF0) are
+       always kept, as decompression needs them, as are the datagrams before the first ping of each file, e.g.
+       the configuration, unless excluded by type.  A group (RZG3) is kept or dropped as a whole, together
+       with its placeholders (RZP3), by the channel and timestamp of its first ping.
+       With split_time (a timedelta) or split_size (in bytes), the output is split into numbered files (see
+       split_name), a new one starting once the current one spans split_time or has reached split_size, at the
+       first datagram where no group is incomplete.  Each file starts with the datagrams before the first ping
+       of its input and the context datagrams so far, so that it can be decompressed on its own.
+       The indexes of the inputs are dropped, and with write_index each output gets its own.
+       Returns the names of the files written.'''
+    splitting = split_time is not None or split_size is not None
+    names = []
+    header, contexts = [], []  # what each output file starts with
+    grouped = set()            # the date and channel_id of the pings of kept groups whose placeholders are to come
+    out = index = first = None
+    size = 0
+
+    def write(msg):
+        nonlocal size
+        dgram_write(out, msg)
+        size += len(msg) + 8
+        if index is not None:
+            index.add(msg, len(msg))
+
+    def selected(dtype, timestamp, msg):
+        '''Whether a datagram is of the given types, from the given channels and in the time range'''
+        if types is not None and dtype not in types:
+            return False
+        if channels is not None and dtype in CHANNEL_TYPES and msg_channel_id(msg) not in channels:
+            return False
+        return (start is None or timestamp >= start) and (end is None or timestamp < end)
+
+    def full(timestamp):
+        '''Whether the current output spans split_time at timestamp, or has reached split_size'''
+        if split_time is not None and timestamp - first >= split_time:
+            return True
+        return split_size is not None and size >= split_size
+
+    with ExitStack() as stack:
+
+        def open_next(timestamp):
+            nonlocal out, index, size, first
+            if out is not None:
+                if index is not None:
+                    out.write(index.to_string())
+                stack.close()
+            names.append(split_name(ofile, len(names) + 1) if splitting else ofile)
+            if names[-1] in fnames:
+                raise ValueError(f'Output file {names[-1]} is also an input')
+            out = stack.enter_context(open_output(names[-1], atomic=True))
+            index = DatagramIndex() if write_index else None
+            size, first = 0, timestamp
+            for msg in header + contexts:
+                write(msg)
+
+        for fname in fnames:
+            header = []
+            pinged = False  # whether the first ping of the file has been seen
+            for dtype, length, timestamp, msg in datagrams(fname):
+                if dtype in ('EKX0', 'EKT0'):
+                    continue
+                if dtype in CONTEXT_TYPES or (not pinged and dtype not in CHANNEL_TYPES):
+                    if dtype in CONTEXT_TYPES:
+                        contexts.append(msg)
+                    elif types is None or dtype in types:
+                        header.append(msg)
+                    else:
+                        continue
+                    if out is not None:
+                        write(msg)
+                    continue
+                pinged = pinged or dtype in CHANNEL_TYPES
+                whole = not grouped  # whether the output can be split before this datagram
+                if dtype == 'RZP3':
+                    # placeholders follow their group
+                    if bytes(msg[4:140]) not in grouped:
+                        continue
+                    grouped.remove(bytes(msg[4:140]))
+                elif not selected(dtype, timestamp, msg):
+                    continue
+                elif dtype == 'RZG3':
+                    channel_id = bytes(msg[12:140])
+                    grouped.update(struct.pack('<LL', ping['low_date'], ping['high_date']) + channel_id
+                                   for ping in RZG_PARSER.from_string(msg, len(msg))['pings'])
+                if out is None or whole and full(timestamp):
+                    open_next(timestamp)
+                write(msg)
+        if out is None:
+            open_next(None)
+        if index is not None:
+            out.write(index.to_string())
+    return names
+
+
+def batch_files(paths, decompress_mode=False, odir=None):
+    '''The (input, output) file names for the files given and the files in the directories given,
+       searched recursively for .raw files, or .ekz files when decompressing.  The outputs are next
+       to the inputs, or with odir in the same place relative to odir as the inputs to the directory
+       given (or as the files given by name to their own directory).'''
+    suffix = '.ekz' if decompress_mode else '.raw'
+    pairs = []
+    for path in paths:
+        if os.path.isdir(path):
+            top = path
+            found = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                found += [os.path.join(dirpath, f) for f in sorted(filenames) if f.lower().endswith(suffix)]
         else:
-            dgram_write(outfile, dgram[3])
-    if fname != '-': outfile.close()
+            top = os.path.dirname(path)
+            found = [path]
+        for fname in found:
+            ofile = fname[:-4] if decompress_mode else fname + '.ekz'
+            if odir is not None:
+                ofile = os.path.join(odir, os.path.relpath(ofile, top or '.'))
+            pairs.append((fname, ofile))
+    return pairs
+
+
+def is_done(fname, ofile):
+    '''Whether ofile is a complete output of fname: newer than it, and consisting of complete datagrams'''
+    if not os.path.exists(ofile) or os.path.getmtime(ofile) < os.path.getmtime(fname):
+        return False
+    return first_bad_datagram(ofile) is None
+
+
+def _batch_file(fname, ofile, args, decompress_mode, target, profile=False):
+    '''Process one file of a batch, returns the input and output size, seconds, and profile statistics.
+       A file without any datagrams fails, instead of giving an empty output.'''
+    if profile and P.PROFILE is None:
+        P.enable()
+    if not has_datagram(fname):
+        raise ValueError(f'No datagrams in {fname}')
+    os.makedirs(os.path.dirname(ofile) or '.', exist_ok=True)
+    start = time.perf_counter()
+    process(fname, args, decompress_mode, target, ofile=ofile)
+    seconds = time.perf_counter() - start
+    stats = P.PROFILE.take() if profile else None
+    return os.path.getsize(fname), os.path.getsize(ofile), seconds, stats
+
+
+def batch(pairs, args, decompress_mode, target, parallel=1):
+    '''Process (input, output) pairs from batch_files, up to parallel files at a time, skipping those
+       that are done (see is_done).  As outputs are renamed into place only when complete, running
+       again after an interruption resumes where it stopped.  Prints the throughput and any failures
+       to stderr, and returns the list of (file, error) failures.'''
+    todo = [(fname, ofile) for fname, ofile in pairs if not is_done(fname, ofile)]
+    skipped = len(pairs) - len(todo)
+    failures = []
+    insize = outsize = 0
+    start = time.perf_counter()
+
+    def done(fname, result):
+        nonlocal insize, outsize
+        isize, osize, seconds, stats = result
+        insize += isize
+        outsize += osize
+        if stats is not None:
+            P.PROFILE.merge(stats)
+        print(f'{fname}: {isize / 1e6:.1f} MB -> {osize / 1e6:.1f} MB in {seconds:.1f} s', file=sys.stderr)
+
+    profile = P.PROFILE is not None
+    if parallel > 1:
+        with ProcessPoolExecutor(max_workers=parallel) as pool:
+            futures = {pool.submit(_batch_file, fname, ofile, args, decompress_mode, target, profile): fname
+                       for fname, ofile in todo}
+            for future in as_completed(futures):
+                try:
+                    done(futures[future], future.result())
+                except Exception as e:
+                    failures.append((futures[future], f'{type(e).__name__}: {e}'))
+    else:
+        for fname, ofile in todo:
+            try:
+                done(fname, _batch_file(fname, ofile, args, decompress_mode, target))
+            except Exception as e:
+                failures.append((fname, f'{type(e).__name__}: {e}'))
+
+    seconds = time.perf_counter() - start
+    print(f'{len(todo) - len(failures)} files processed, {skipped} already done, {len(failures)} failed', file=sys.stderr)
+    if insize > 0:
+        raw = outsize if decompress_mode else insize
+        print(f'{insize / 1e6:.1f} MB -> {outsize / 1e6:.1f} MB in {seconds:.1f} s, '
+              f'{raw / seconds / 1e6:.1f} MB/s of RAW data', file=sys.stderr)
+    for fname, error in sorted(failures):
+        print(f'Failed: {fname}: {error}', file=sys.stderr)
+    return failures
+
+
+def test(fname):
+    '''Check the framing of the datagrams of a file, and the checksums of those that have them
+       (see compress_dgram), without decompressing anything.  Returns the number of datagrams,
+       the number with checksums, and the offset of the first corrupt datagram or None.'''
+    counts = [0, 0]
+
+    def check(msg):
+        counts[0] += 1
+        matches = checksum_matches(msg)
+        counts[1] += matches is not None
+        return matches is not False
+
+    bad = first_bad_datagram(fname, check)
+    return counts[0], counts[1], bad
+
+
+def test_files(fnames, parallel=1):
+    '''Test files (see test), up to parallel files at a time, printing the result for each in the
+       order given.  Returns the list of (file, error) failures.'''
+    failures = []
+    pool = ProcessPoolExecutor(max_workers=parallel) if parallel > 1 else None
+    try:
+        futures = [pool.submit(test, fname) for fname in fnames] if pool is not None else None
+        for i, fname in enumerate(fnames):
+            try:
+                count, checked, bad = futures[i].result() if pool is not None else test(fname)
+                error = None if bad is None else f'corrupt datagram at offset {bad}'
+            except (OSError, ValueError) as e:
+                error = f'{type(e).__name__}: {e}'
+            if error is None:
+                print(f'{fname}: OK, {count} datagrams, {checked} with checksums')
+            else:
+                failures.append((fname, error))
+                print(f'{fname}: {error}')
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return failures
+
+
+def values(convert, choices=None):
+    '''Argument type for a comma separated list of values'''
+    def parse(arg):
+        result = [convert(v) for v in arg.split(',')]
+        if choices is not None and any(v not in choices for v in result):
+            raise argparse.ArgumentTypeError(f'values must be in {list(choices)}')
+        return result
+    return parse
 
 
 def main():
     parser = argparse.ArgumentParser(description="Compress or decompress Simrad RAW files.")
     parser.add_argument('files', help="Files to process", nargs="*")
     parser.add_argument('-d', '--decompress', action='store_true', help="Decompress file")
-    parser.add_argument('-o', help="Output file name")
-    parser.add_argument('--statistics', action='store_true', help="Test execution and output statistics")
+    parser.add_argument('-t', '--test', action='store_true',
+                        help="Check the datagrams and checksums of the files, without decompressing them")
+    parser.add_argument('-o', help="Output file name, or output directory with --recursive")
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help="Process the .raw (or with -d the .ekz) files in the directories given and below, "
+                             "skipping files with complete outputs")
+    parser.add_argument('--parallel', type=int, default=1, metavar='N',
+                        help='Number of files processed at a time with --recursive or --test (default 1)')
+    parser.add_argument('--concat', action='store_true',
+                        help="Copy the datagrams of the files to -o without decompressing them, implied by "
+                             "--channel, --type, --start, --end, --split-time and --split-size")
+    parser.add_argument('--channel', action='append', metavar='ID',
+                        help='Keep only the pings of this channel_id, can be given several times')
+    parser.add_argument('--type', type=values(str), metavar='TYPES',
+                        help='Keep only the datagrams of these types, separated by commas, e.g. RAZ3,NME0')
+    parser.add_argument('--start', type=datetime.fromisoformat, metavar='TIME',
+                        help='Keep only the datagrams from this time on, e.g. 2023-03-21T08:30:00')
+    parser.add_argument('--end', type=datetime.fromisoformat, metavar='TIME',
+                        help='Keep only the datagrams before this time')
+    parser.add_argument('--split-time', type=float, metavar='S',
+                        help='Split the output into files of S seconds, named like the -o file (or the input) '
+                             'with a sequence number')
+    parser.add_argument('--split-size', type=float, metavar='MB', help='Split the output into files of MB megabytes')
+    parser.add_argument('--zarr', action='store_true',
+                        help='Decompress the pings of each channel into a Zarr directory store, -o or the file '
+                             'name with .zarr, in chunks that can be read in parallel')
+    parser.add_argument('--chunk', type=int, default=EXPORT_CHUNK, metavar='N',
+                        help=f'Pings per chunk with --zarr (default {EXPORT_CHUNK})')
+    parser.add_argument('--zarr-level', type=int, default=Z.ZSTD_LEVEL, metavar='L',
+                        help=f'zstd level of the chunks with --zarr, 0 to store them uncompressed for memory '
+                             f'mapping (default {Z.ZSTD_LEVEL})')
+    parser.add_argument('--statistics', action='store_true',
+                        help="Compress and decompress the files, and output error statistics per channel and field")
+    parser.add_argument('--stats-format', choices=['table', 'csv', 'json'], default='table',
+                        help='Format of the statistics, written to stdout or the -o file (default table)')
     # Compression level options:
-    parser.add_argument('--level', type=int, choices=range(2, 6), default=3, help='Compression wavelet levels, from 2 to 6')
-    parser.add_argument('--threshold', type=float, default=0.2, help='Compression threshold.')
+    parser.add_argument('--level', type=values(int, range(2, 6)), default=[3],
+                        help='Compression wavelet levels, from 2 to 5, several separated by commas for --statistics')
+    parser.add_argument('--threshold', type=values(float), default=[0.2],
+                        help='Compression threshold, several separated by commas for --statistics')
+    bound = parser.add_mutually_exclusive_group()
+    bound.add_argument('--max-error', type=float, metavar='E',
+                       help='Choose the threshold per ping and channel for a relative RMS error of at most E')
+    bound.add_argument('--target-psnr', type=float, metavar='DB',
+                       help='Choose the threshold per ping and channel for a peak signal to noise ratio of DB')
+    parser.add_argument('--dictionary', type=int, default=0, metavar='N',
+                        help='Train zstd dictionaries from the first N pings of each channel')
+    parser.add_argument('--auto', type=int, default=0, metavar='N',
+                        help='Choose the wavelet, level and threshold of each channel from its first N pings')
+    parser.add_argument('--follow', action='store_true',
+                        help='Compress a file while it is being written, and the files following it')
+    parser.add_argument('--index', action='store_true', help='Append an index of the datagrams to the output')
+    parser.add_argument('--checksum', action='store_true',
+                        help='End each compressed datagram with a CRC32 of its contents, checked by --test')
+    parser.add_argument('--hash-samples', action='store_true',
+                        help='Store a CRC32 of the decompressed samples of each ping, checked when decompressing')
+    parser.add_argument('--progressive', action='store_true',
+                        help='Store each wavelet band separately, for fast decompression with --lod')
+    parser.add_argument('--power-codec', choices=['wavelet', 'zstd', 'delta'], default='wavelet',
+                        help='Compression of power samples, zstd and delta are lossless (default wavelet)')
+    parser.add_argument('--angle-codec', choices=['raw', 'zstd', 'delta'], default='zstd',
+                        help='Compression of angle samples, all lossless (default zstd)')
+    parser.add_argument('--group', type=int, default=0, metavar='N',
+                        help='Compress the pings of each channel together in groups of up to N pings')
+    parser.add_argument('--lod', type=int, default=0, metavar='K',
+                        help='Decompress at 1/2^K resolution, K at most the compression --level')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes (default 1)')
+    parser.add_argument('--profile', action='store_true', help='Print the time spent in each stage to stderr')
+    parser.add_argument('--profile-json', metavar='FILE', help='Write the time spent in each stage as JSON to FILE')
 
     args = parser.parse_args()
     decompress_mode = args.decompress or 'unzip' in os.path.basename(sys.argv[0])
+    target = None
+    if args.max_error is not None:
+        target = ('error', args.max_error)
+    elif args.target_psnr is not None:
+        target = ('psnr', args.target_psnr)
+
+    splitting = args.split_time is not None or args.split_size is not None
+    copying = args.concat or splitting or any(v is not None for v in (args.channel, args.type, args.start, args.end))
 
     if not args.files: args.files = ['-']
-    if args.o and len(args.files) != 1:
+    if args.o and len(args.files) != 1 and not (args.statistics or args.recursive or copying):
         print('Error: refusing to compress multiple files when output file is specified')
         exit()
-    for f in args.files:
-        if decompress_mode:
-            decompress(f, args.o)
-        elif args.statistics:
-            comptest(f, args.level, args.threshold)
+    if (len(args.level) > 1 or len(args.threshold) > 1) and not args.statistics:
+        print('Error: several levels or thresholds can only be given with --statistics')
+        exit()
+    if args.follow and (decompress_mode or args.o or args.files == ['-'] or len(args.files) != 1):
+        print('Error: --follow compresses a single named file (and the files following it) to .ekz files')
+        exit()
+    if args.recursive and (args.follow or args.statistics or '-' in args.files):
+        print('Error: --recursive processes named files and directories, without --follow or --statistics')
+        exit()
+    if args.test and (args.statistics or args.follow or '-' in args.files):
+        print('Error: --test checks named files and directories, without --statistics or --follow')
+        exit()
+    if copying and (decompress_mode or args.test or args.statistics or args.follow or args.recursive):
+        print('Error: --concat and the options selecting or splitting datagrams work on .ekz files, '
+              'without -d, --test, --statistics, --follow or --recursive')
+        exit()
+    if copying and not (args.o or (splitting and args.files != ['-'])) or (splitting and args.o == '-'):
+        print('Error: --concat and the options selecting datagrams write to the -o file, '
+              'or when splitting to files named like the -o file or the first input')
+        exit()
+    if args.zarr and (copying or args.test or args.statistics or args.follow or args.recursive or '-' in args.files):
+        print('Error: --zarr exports named .ekz files, without --concat, --test, --statistics, --follow or --recursive')
+        exit()
+    if args.hash_samples and args.group > 1:
+        print('Error: --hash-samples is not supported with --group')
+        exit()
+    if args.profile or args.profile_json:
+        P.enable()
+    try:
+        if args.test:
+            fnames = [f for f, _ in batch_files(args.files, True)] if args.recursive else args.files
+            if test_files(fnames, args.parallel):
+                exit(1)
+        elif copying:
+            try:
+                copy_datagrams(args.files, args.o or args.files[0], channels=args.channel, types=args.type,
+                               start=args.start, end=args.end,
+                               split_time=None if args.split_time is None else timedelta(seconds=args.split_time),
+                               split_size=None if args.split_size is None else int(args.split_size * 1e6),
+                               write_index=args.index)
+            except (OSError, ValueError) as e:
+                print(f'Error: {e}', file=sys.stderr)
+                exit(1)
+        elif args.statistics and not decompress_mode:
+            with P.run():
+                results = comptest(args.files, [(level, threshold) for level in args.level for threshold in args.threshold],
+                                   jobs=args.jobs, target=target, power_codec=args.power_codec, angle_codec=args.angle_codec)
+            write_stats(results, args.o or '-', args.stats_format)
+        elif args.recursive:
+            if batch(batch_files(args.files, decompress_mode, args.o), args, decompress_mode, target, args.parallel):
+                exit(1)
         else:
-            compress(f, args.o, args.level, args.threshold)
+            failed = False
+            for f in args.files:
+                try:
+                    process(f, args, decompress_mode, target)
+                except (OSError, ValueError) as e:
+                    print(f'Error: {e}', file=sys.stderr)
+                    failed = True
+            if failed:
+                exit(1)
+    finally:
+        if args.profile:
+            P.PROFILE.report()
+        if args.profile_json:
+            P.PROFILE.write(args.profile_json)
+
+
+def process(f, args, decompress_mode, target, ofile=None):
+    '''Process one file as given by the command line arguments, to ofile if given instead of -o'''
+    ofile = ofile or args.o
+    if args.zarr:
+        export_zarr(f, ofile, chunk=args.chunk, jobs=args.jobs, lod=args.lod, level=args.zarr_level)
+    elif decompress_mode:
+        decompress(f, ofile, jobs=args.jobs, lod=args.lod)
+    elif args.follow:
+        follow(f, level=args.level[0], threshold=args.threshold[0], jobs=args.jobs, write_index=args.index,
+               dictionary=args.dictionary, progressive=args.progressive, group=args.group,
+               power_codec=args.power_codec, angle_codec=args.angle_codec, target=target, auto=args.auto,
+               checksum=args.checksum, hash_samples=args.hash_samples)
+    else:
+        compress(f, ofile, args.level[0], args.threshold[0], jobs=args.jobs, write_index=args.index,
+                 dictionary=args.dictionary, progressive=args.progressive, group=args.group,
+                 power_codec=args.power_codec, angle_codec=args.angle_codec, target=target, auto=args.auto,
+                 checksum=args.checksum, hash_samples=args.hash_samples)
 
 
 if __name__ == '__main__':
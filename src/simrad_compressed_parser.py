@@ -1,11 +1,74 @@
 # The RAW parser, only with data compression
 import struct
+import zlib
 import numpy as np
-from ektools.simrad_parsers import _SimradDatagramParser
+from ektools.simrad_parsers import _SimradDatagramParser, SimradRawParser
 from ektools.date_conversion import nt_to_unix
 
+# Bits of the zflags header field of RAZ datagrams, which replaces the spare field of RAW3/RAW4
+# and the last two bytes of spare0 of RAW0.  Files written before the field existed have it set to zero.
+ZF_BANDS = 0x1      # each band of wavelet coefficients is a separate zstd frame, see wavelets.join_bands
+ZF_CONFIG = 0x2     # the wavelet, level and band sizes are given by a ZCF0 entry, instead of in the datagram
+ZF_POWER_INT = 0x4  # power is compressed losslessly, see wavelets.compress_int
+ZF_ANGLE_INT = 0x8  # angle is compressed losslessly, instead of stored as is
+ZF_WAVELET = 0x10   # the name of the wavelet (zwavelet, 8 bytes) follows the header, instead of db4
+ZF_CHECKSUM = 0x20  # a CRC32 of the rest of the datagram (zcrc, 4 bytes) ends the datagram, also in RZG3
+ZF_SAMPLES = 0x40   # a CRC32 of the decompressed samples (zsamples, 4 bytes) follows zconfig and zwavelet
+ZF_POWER_WIDE = 0x80     # RZG3 only: the power coefficients are float32, as they exceed the range of float16
+ZF_COMPLEX_WIDE = 0x100  # RZG3 only: likewise the complex coefficients
 
-class SimradRawZParser(_SimradDatagramParser):
+# Offset of the zflags field in the contents of the datagrams that have it, by type
+ZFLAGS_OFFSETS = {b'RAZ0': 74, b'RAZ3': 142, b'RAZ4': 142, b'RZG3': 142}
+
+
+def checksum_matches(msg):
+    '''Whether the CRC32 (ZF_CHECKSUM) of the contents of a datagram matches them, or None for
+       datagrams without one.  Only the flags and the checksum are read, nothing is decompressed.'''
+    offset = ZFLAGS_OFFSETS.get(bytes(msg[:4]))
+    if offset is None or len(msg) < offset + 6:
+        return None
+    zflags, = struct.unpack_from('=H', msg, offset)
+    if not zflags & ZF_CHECKSUM:
+        return None
+    zcrc, = struct.unpack_from('=L', msg, len(msg) - 4)
+    return zlib.crc32(memoryview(msg)[:-4]) == zcrc
+
+
+class PrecompiledParser():
+    '''Mixin for datagram parsers that are reused for many datagrams: the header formats are compiled
+       to struct.Struct objects once, by compile_headers in the constructor, instead of rebuilt for
+       every datagram.  The contents of datagrams can be memoryviews, e.g. of an mmap, as well as bytes.'''
+
+    def compile_headers(self):
+        self._structs = {v: struct.Struct(_SimradDatagramParser.header_fmt(self, v)) for v in self._versions}
+        self._fields = {v: _SimradDatagramParser.header_fields(self, v) for v in self._versions}
+
+    def header_struct(self, version=0):
+        return self._structs[version]
+
+    def header_fmt(self, version=0):
+        return self._structs[version].format
+
+    def header_size(self, version=0):
+        return self._structs[version].size
+
+    def header_fields(self, version=0):
+        return self._fields[version]
+
+    def from_string(self, raw_string, bytes_read):
+        id_, version = self.validate_data_header(bytes(raw_string[:4]).decode('latin_1'))
+        return self._unpack_contents(raw_string, bytes_read, version=version)
+
+
+class PrecompiledRawParser(PrecompiledParser, SimradRawParser):
+    '''The RAW parser of ektools, with precompiled headers'''
+
+    def __init__(self):
+        SimradRawParser.__init__(self)
+        self.compile_headers()
+
+
+class SimradRawZParser(PrecompiledParser, _SimradDatagramParser):
     '''
     Sample Data Datagram parser operates on dictonaries with the following keys:
 
@@ -30,12 +93,17 @@ class SimradRawZParser(_SimradDatagramParser):
         temperature                     [float]
         heading                         [float]
         transmit_mode                   [short] 0 = Active, 1 = Passive, 2 = Test, -1 = Unknown
-        spare0                          [str]
+        spare0                          [str] The first 4 bytes of spare0 of the RAW0 datagram
+        zflags                          [short] ZF_ flags, as for RAZ3
         offset                          [long]
         count                           [long]
 
-        power                           [numpy array] Unconverted power values (if present)
-        angle                           [numpy array] Unconverted angle values (if present)
+        zpower                          [bytes] Compressed power values (if present)
+        zangle                          [bytes] Compressed angle values (if present and ZF_ANGLE_INT)
+        angle                           [numpy array] Unconverted angle values (if present otherwise)
+
+    The compressed samples are laid out as in RAZ3/RAZ4 datagrams, with the mode in place of
+    the data_type, whose power and angle bits it shares, and without complex samples.
 
     from_string(str):   parse a raw sample datagram
                         (with leading/trailing datagram size stripped)
@@ -64,7 +132,8 @@ class SimradRawZParser(_SimradDatagramParser):
                         ('temperature', 'f'),
                         ('heading', 'f'),
                         ('transmit_mode', 'h'),
-                        ('spare0', '6s'),
+                        ('spare0', '4s'),
+                        ('zflags', 'H'),
                         ('offset', 'l'),
                         ('count', 'l')
                         ],
@@ -73,7 +142,7 @@ class SimradRawZParser(_SimradDatagramParser):
                         ('high_date', 'L'),
                         ('channel_id', '128s'),
                         ('data_type', 'h'),
-                        ('spare', '2s'),
+                        ('zflags', 'H'),
                         ('offset', 'l'),
                         ('count', 'l')
                         ],
@@ -82,16 +151,17 @@ class SimradRawZParser(_SimradDatagramParser):
                         ('high_date', 'L'),
                         ('channel_id', '128s'),
                         ('data_type', 'h'),
-                        ('spare', '2s'),
+                        ('zflags', 'H'),
                         ('offset', 'l'),
                         ('count', 'l')
                         ]
                     }
         _SimradDatagramParser.__init__(self, 'RAZ', headers)
+        self.compile_headers()
 
     def _unpack_contents(self, raw_string, bytes_read, version):
 
-        header_values = struct.unpack(self.header_fmt(version), raw_string[:self.header_size(version)])
+        header_values = self.header_struct(version).unpack_from(raw_string)
 
         data = {}
 
@@ -109,62 +179,62 @@ class SimradRawZParser(_SimradDatagramParser):
         data['bytes_read'] = bytes_read
 
         if version == 0:
-
-            if data['count'] > 0:
-                block_size = data['count'] * 2
-                indx = self.header_size(version)
-
-                if int(data['mode']) & 0x1:
-                    data['power'] = np.frombuffer(raw_string[indx:indx + block_size], dtype='int16')
-                    indx += block_size
-                else:
-                    data['power'] = None
-
-                if int(data['mode']) & 0x2:
-                    data['angle'] = np.frombuffer(raw_string[indx:indx + block_size], dtype='int8')
-                    data['angle'].shape = (data['count'], 2)
-                else:
-                    data['angle'] = None
-
-            else:
-                data['power'] = np.empty((0,), dtype='int16')
-                data['angle'] = np.empty((0,), dtype='int8')
-
-        elif version == 3 or version == 4:
-
+            #  the power and angle bits of the mode are those of the data_type of RAW3
+            sample_type = data['mode']
+        else:
             #  clean up the channel ID
             data['channel_id'] = data['channel_id'].strip('\x00')
-
-            if data['count'] > 0:
-
-                #  set the initial block size and indx value.
-                block_size = data['count'] * 2
-                indx = self.header_size(version)
-
-                if data['data_type'] & 0b1:
-                    zpowershapes = struct.unpack('i', raw_string[indx:indx + 4])[0]
+            sample_type = data['data_type']
+
+        if data['count'] > 0:
+
+            #  set the initial block size and indx value.
+            block_size = data['count'] * 2
+            indx = self.header_size(version)
+            #  compressed data are returned as memoryview slices, not copies
+            view = memoryview(raw_string)
+
+            #  the ID of the ZCF0 entry replaces the level and shapes
+            if data['zflags'] & ZF_CONFIG:
+                data['zconfig'], = struct.unpack_from('=L', raw_string, indx)
+                indx += 4
+            if data['zflags'] & ZF_WAVELET:
+                data['zwavelet'] = bytes(raw_string[indx:indx + 8]).rstrip(b'\x00').decode('latin_1')
+                indx += 8
+            if data['zflags'] & ZF_SAMPLES:
+                data['zsamples'], = struct.unpack_from('=L', raw_string, indx)
+                indx += 4
+
+            if sample_type & 0b1:
+                if data['zflags'] & (ZF_CONFIG | ZF_POWER_INT):
+                    data['zpshapes'] = None
+                else:
+                    zpowershapes, = struct.unpack_from('=i', raw_string, indx)
                     indx += 4
-                    data['zpshapes'] = struct.unpack("%di" % zpowershapes, raw_string[indx:indx + 4 * zpowershapes])
+                    data['zpshapes'] = struct.unpack_from('=%di' % zpowershapes, raw_string, indx)
                     indx += 4 * zpowershapes
 
-                    zpowerlen = struct.unpack('i', raw_string[indx:indx + 4])[0]
-                    # print('..unpacked zplen:', zpowerlen, 'zpshapes:', data['zpshapes'])
-
-                    indx += 4
-                    data['zpower'] = raw_string[indx:indx + zpowerlen]
-                    indx += zpowerlen
-                    # data['power'] = np.frombuffer(raw_string[indx:indx + block_size], dtype='int16')
-                    # indx += block_size
-                else:
-                    data['power'] = None
-
-                if data['data_type'] & 0b10:
-                    data['angle'] = np.frombuffer(raw_string[indx:indx + block_size], dtype='int8')
-                    data['angle'].shape = (data['count'], 2)
-                    indx += block_size
-                else:
-                    data['angle'] = None
+                zpowerlen, = struct.unpack_from('=i', raw_string, indx)
+                indx += 4
+                data['zpower'] = view[indx:indx + zpowerlen]
+                indx += zpowerlen
+            else:
+                data['power'] = None
+
+            if sample_type & 0b10 and data['zflags'] & ZF_ANGLE_INT:
+                zanglelen, = struct.unpack_from('=i', raw_string, indx)
+                indx += 4
+                data['zangle'] = view[indx:indx + zanglelen]
+                data['angle'] = None
+                indx += zanglelen
+            elif sample_type & 0b10:
+                data['angle'] = np.frombuffer(raw_string, dtype='int8', count=block_size, offset=indx)
+                data['angle'].shape = (data['count'], 2)
+                indx += block_size
+            else:
+                data['angle'] = None
 
+            if version > 0:
                 #  determine the complex sample data type - this is contained in bits 2 and 3
                 #  of the datatype <short> value. I'm assuming the types are exclusive...
                 #  Note that Numpy doesn't support the complex32 type so both the full precision
@@ -176,131 +246,515 @@ class SimradRawZParser(_SimradDatagramParser):
                 else:
                     data['complex_dtype'] = np.float16
 
-                #  determine the number of complex samples
-                data['n_complex'] = data['data_type'] >> 8
+            #  determine the number of complex samples, RAW0 datagrams have none
+            data['n_complex'] = data['data_type'] >> 8 if version > 0 else 0
 
-                #  unpack the compressed complex samples
-                if (data['n_complex'] > 0):
+            #  unpack the compressed complex samples
+            if (data['n_complex'] > 0):
+                if data['zflags'] & ZF_CONFIG:
+                    data['zlevel'] = None
+                    data['zshapes'] = None
+                else:
                     # read level parameter and lenght of shapes array
-                    data['zlevel'], zshapelen = struct.unpack('ii', raw_string[indx:indx + 8])
+                    data['zlevel'], zshapelen = struct.unpack_from('=ii', raw_string, indx)
                     indx += 8
                     # read the zshapes array
-                    data['zshapes'] = struct.unpack("%di" % zshapelen, raw_string[indx:indx + 4 * zshapelen])
+                    data['zshapes'] = struct.unpack_from('=%di' % zshapelen, raw_string, indx)
                     indx += 4 * zshapelen
 
-                    # read zcomplex vectors (real and imag)
-                    zcomplex = []
-                    for i in range(data['n_complex']):
-                        zc = []
-                        for j in [0, 1]:
-                            zlen = struct.unpack('i', raw_string[indx:indx + 4])[0]
-                            indx += 4
-                            zc.append(raw_string[indx:indx + zlen])
-                            indx += zlen
-                        zcomplex.append((zc[0], zc[1]))
-                    data['zcomplex'] = zcomplex
-                else:
-                    data['zcomplex'] = None
-                    data['zlevel'] = None
-                    data['zshapes'] = None
+                # read zcomplex vectors (real and imag) as views into the datagram
+                zcomplex = []
+                for i in range(data['n_complex']):
+                    zc = []
+                    for j in [0, 1]:
+                        zlen, = struct.unpack_from('=i', raw_string, indx)
+                        indx += 4
+                        zc.append(view[indx:indx + zlen])
+                        indx += zlen
+                    zcomplex.append((zc[0], zc[1]))
+                data['zcomplex'] = zcomplex
             else:
-                # Does this make sense here?  If count is zero...then what?  Why not None, like above?
-                data['power'] = np.empty((0,), dtype='int16')
-                data['angle'] = np.empty((0,), dtype='int8')
                 data['zcomplex'] = None
                 data['zlevel'] = None
                 data['zshapes'] = None
-                data['n_complex'] = 0
+        else:
+            # Does this make sense here?  If count is zero...then what?  Why not None, like above?
+            data['power'] = np.empty((0,), dtype='int16')
+            data['angle'] = np.empty((0,), dtype='int8')
+            data['zcomplex'] = None
+            data['zlevel'] = None
+            data['zshapes'] = None
+            data['n_complex'] = 0
+
+        if data['zflags'] & ZF_CHECKSUM:
+            data['zcrc'], = struct.unpack_from('=L', raw_string, len(raw_string) - 4)
 
         return data
 
     def _pack_contents(self, data, version):
 
-        datagram_fmt = self.header_fmt(version)
         datagram_contents = []
 
         if version == 0:
-
             if data['count'] > 0 and data['mode'] == 0:
                 data['count'] = 0
+            #  the power and angle bits of the mode are those of the data_type of RAW3
+            sample_type = data['mode']
+        else:
+            sample_type = data['data_type']
+
+        # Flags describing the layout of the compressed data
+        data.setdefault('zflags', 0)
+
+        # work through the parameter dict and append data values to the
+        # packed datagram list.
+        for field in self.header_fields(version):
+            if isinstance(data[field], str):
+                data[field] = data[field].encode('latin_1')
+            datagram_contents.append(data[field])
+
+        # Pack the header in one go, and append the compressed blobs and sample
+        # arrays as buffers rather than going through struct one byte at a time.
+        datagram = bytearray(self.header_struct(version).pack(*datagram_contents))
+
+        # Check if we have data to write
+        if data['count'] > 0:
+
+            if data['zflags'] & ZF_CONFIG:
+                datagram += struct.pack('=L', data['zconfig'])
+            if data['zflags'] & ZF_WAVELET:
+                datagram += struct.pack('=8s', data['zwavelet'].encode('latin_1'))
+            if data['zflags'] & ZF_SAMPLES:
+                datagram += struct.pack('=L', data['zsamples'])
+
+            if sample_type & 0b0001:
+                if not data['zflags'] & (ZF_CONFIG | ZF_POWER_INT):
+                    zpowershapes = len(data['zpshapes'])
+                    datagram += struct.pack('=i%di' % zpowershapes, zpowershapes, *data['zpshapes'])
+                datagram += struct.pack('=i', len(data['zpower']))
+                datagram += data['zpower']
+
+            if sample_type & 0b0010 and data['zflags'] & ZF_ANGLE_INT:
+                datagram += struct.pack('=i', len(data['zangle']))
+                datagram += data['zangle']
+            elif sample_type & 0b0010:
+                # Add the angle data
+                datagram += data['angle'].tobytes()
+
+            if version > 0 and data['data_type'] & 0b1100:
+                # Write the compressed complex data
+                if data['data_type'] & 0b0100:
+                    # This shouldn't matter, our zcomplex field is written as it is.
+                    assert False, 'not implemented here'
+                else:
+                    # storing level, len shapes, and the shapes, unless given by the ZCF0 entry
+                    if not data['zflags'] & ZF_CONFIG:
+                        datagram += struct.pack('=ii%di' % len(data['zshapes']),
+                                                data['zlevel'], len(data['zshapes']), *data['zshapes'])
+                    for i in range(data['n_complex']):
+                        for zdata in data['zcomplex'][i]:  # real and imag
+                            datagram += struct.pack('=i', len(zdata))
+                            datagram += zdata
+
+        if data['zflags'] & ZF_CHECKSUM:
+            datagram += struct.pack('=L', zlib.crc32(datagram))
 
-            for field in self.header_fields(version):
-                if isinstance(data[field], str):
-                    data[field] = data[field].encode('latin_1')
-                datagram_contents.append(data[field])
+        return datagram
 
-            if data['count'] > 0:
 
-                if int(data['mode']) & 0x1:
-                    datagram_fmt += '%dh' % (data['count'])
-                    datagram_contents.append(data['power'])
+# Layout of the entries in the index datagram, one per datagram in the file
+INDEX_ENTRY = np.dtype([('offset', '<u8'),
+                        ('type', 'S4'),
+                        ('channel', '<i2'),
+                        ('low_date', '<u4'),
+                        ('high_date', '<u4')])
 
-                if int(data['mode']) & 0x2:
-                    n_angles = data['count'] * 2
-                    datagram_fmt += '%db' % (n_angles)
-                    #  reshape the angle array for writing
-                    data['angle'].shape = (n_angles,)
-                    datagram_contents.extend(data['angle'])
 
-        elif version == 3 or version == 4:
+class SimradIndexZParser(PrecompiledParser, _SimradDatagramParser):
+    '''
+    Index datagram written at the end of an .ekz file, operates on dictionaries with the following keys:
 
-            # Add the spare field
-            data['spare'] = ''
+        type:         string == 'EKX0'
+        low_date:     long uint representing LSBytes of 64bit NT date
+        high_date:    long uint representing MSBytes of 64bit NT date
+        timestamp:    datetime.datetime object of NT date, assumed to be UTC
 
-            # work through the parameter dict and append data values to the
-            # packed datagram list.
-            for field in self.header_fields(version):
-                if isinstance(data[field], str):
-                    data[field] = data[field].encode('latin_1')
-                datagram_contents.append(data[field])
+        length                          [long long] Number of bytes covered by the index
+        channels                        [list of str] Channel IDs referred to by the entries
+        entries                         [numpy array] One INDEX_ENTRY per datagram, with channel
+                                        the position in channels, or -1 for datagrams without one
+    '''
 
-            # Check if we have data to write
-            if data['count'] > 0:
+    def __init__(self):
+        headers = {0: [('type', '4s'),
+                       ('low_date', 'L'),
+                       ('high_date', 'L'),
+                       ('length', 'Q'),
+                       ('n_channels', 'L'),
+                       ('n_entries', 'L')
+                       ]
+                   }
+        _SimradDatagramParser.__init__(self, 'EKX', headers)
+        self.compile_headers()
 
-                if data['data_type'] & 0b0001:
-                    zpowershapes = len(data['zpshapes'])
-                    datagram_fmt += 'i%di' % zpowershapes
-                    for d in [zpowershapes, *data['zpshapes']]:
-                        datagram_contents.append(d)
-
-                    zpowerlen = len(data['zpower'])
-                    # print('..packing zplen:', zpowerlen, 'shapes:', data['zpshapes'])
-                    datagram_fmt += 'i%dB' % zpowerlen
-                    datagram_contents.append(zpowerlen)
-                    datagram_contents.extend(data['zpower'])
-
-                if data['data_type'] & 0b0010:
-                    # Add the angle data
-                    n_angles = data['count'] * 2
-                    datagram_fmt += '%db' % (n_angles)
-                    #  reshape the angle array for writing
-                    data['angle'].shape = (n_angles,)
-                    datagram_contents.extend(data['angle'])
-
-                if data['data_type'] & 0b1100:
-                    # Write the compressed complex data
-                    if data['data_type'] & 0b0100:
-                        # This shouldn't matter, our zcomplex field is written as it is.
-                        # pack as 16 bit floats - struct doesn't have support for
-                        # half floats so we use just pack them as bytes.
-                        # datagram_fmt += '%dB' % (data['complex'].shape[0] * 2 * 8)
-                        assert False, 'not implemented here'
-                    else:
-                        # storing level, len shapes, and the shapes
-                        datagram_fmt += 'ii%di' % len(data['zshapes'])
-                        for d in [data['zlevel'], len(data['zshapes']), *data['zshapes']]:
-                            datagram_contents.append(d)
-                        for i in range(data['n_complex']):
-                            zdata = data['zcomplex'][i]
-                            for j in [0, 1]:  # real and imag
-                                zlen = len(zdata[j])
-                                datagram_fmt += 'i%dB' % zlen
-                                datagram_contents.append(zlen)
-                                datagram_contents.extend(zdata[j])
-
-                        # datagram_fmt += '%dB' % (data['complex'].shape[0] * 4 * 8)
-                    # outbytes = data['complex'].tobytes()  # view(np.ubyte)
-                    # print('Packing, shape, size, len:', outbytes.shape, outbytes.size, len(outbytes))
-                    # datagram_contents.extend(outbytes)
-
-        return struct.pack(datagram_fmt, *datagram_contents)
+    def _unpack_contents(self, raw_string, bytes_read, version):
+
+        header_values = self.header_struct(version).unpack_from(raw_string)
+
+        data = {}
+
+        for indx, field in enumerate(self.header_fields(version)):
+            data[field] = header_values[indx]
+            if isinstance(data[field], bytes):
+                data[field] = data[field].decode("latin_1")
+
+        data['timestamp'] = nt_to_unix((data['low_date'], data['high_date']))
+        data['timestamp'] = data['timestamp'].replace(tzinfo=None)
+        data['bytes_read'] = bytes_read
+
+        indx = self.header_size(version)
+        channels = struct.unpack_from('=' + '128s' * data['n_channels'], raw_string, indx)
+        data['channels'] = [c.decode('latin_1').strip('\x00') for c in channels]
+        indx += 128 * data['n_channels']
+        data['entries'] = np.frombuffer(raw_string, dtype=INDEX_ENTRY, count=data['n_entries'], offset=indx)
+
+        return data
+
+    def _pack_contents(self, data, version):
+
+        data['n_channels'] = len(data['channels'])
+        data['n_entries'] = len(data['entries'])
+
+        datagram_contents = []
+        for field in self.header_fields(version):
+            if isinstance(data[field], str):
+                data[field] = data[field].encode('latin_1')
+            datagram_contents.append(data[field])
+
+        datagram = bytearray(self.header_struct(version).pack(*datagram_contents))
+        for c in data['channels']:
+            datagram += struct.pack('=128s', c.encode('latin_1'))
+        datagram += np.asarray(data['entries'], dtype=INDEX_ENTRY).tobytes()
+
+        return datagram
+
+
+class SimradTrailerZParser(PrecompiledParser, _SimradDatagramParser):
+    '''
+    Fixed size datagram ending an .ekz file with an index, operates on dictionaries with the following keys:
+
+        type:         string == 'EKT0'
+        low_date:     long uint representing LSBytes of 64bit NT date
+        high_date:    long uint representing MSBytes of 64bit NT date
+        timestamp:    datetime.datetime object of NT date, assumed to be UTC
+
+        index_offset                    [long long] File position of the index datagram
+    '''
+
+    def __init__(self):
+        headers = {0: [('type', '4s'),
+                       ('low_date', 'L'),
+                       ('high_date', 'L'),
+                       ('index_offset', 'Q')
+                       ]
+                   }
+        _SimradDatagramParser.__init__(self, 'EKT', headers)
+        self.compile_headers()
+
+    def size(self):
+        '''Size of the complete datagram, including the leading and trailing length fields'''
+        return self.header_size(0) + 8
+
+    def _unpack_contents(self, raw_string, bytes_read, version):
+
+        header_values = self.header_struct(version).unpack_from(raw_string)
+
+        data = {}
+
+        for indx, field in enumerate(self.header_fields(version)):
+            data[field] = header_values[indx]
+            if isinstance(data[field], bytes):
+                data[field] = data[field].decode("latin_1")
+
+        data['timestamp'] = nt_to_unix((data['low_date'], data['high_date']))
+        data['timestamp'] = data['timestamp'].replace(tzinfo=None)
+        data['bytes_read'] = bytes_read
+
+        return data
+
+    def _pack_contents(self, data, version):
+
+        datagram_contents = []
+        for field in self.header_fields(version):
+            if isinstance(data[field], str):
+                data[field] = data[field].encode('latin_1')
+            datagram_contents.append(data[field])
+
+        return self.header_struct(version).pack(*datagram_contents)
+
+
+class SimradDictionaryZParser(PrecompiledParser, _SimradDatagramParser):
+    '''
+    Trained zstd dictionary for one stream of a channel, operates on dictionaries with the following keys:
+
+        type:         string == 'ZDI0'
+        low_date:     long uint representing LSBytes of 64bit NT date
+        high_date:    long uint representing MSBytes of 64bit NT date
+        timestamp:    datetime.datetime object of NT date, assumed to be UTC
+
+        dict_id                         [long uint] zstd dictionary ID, as recorded in compressed frames
+        channel_id                      [str] Channel the dictionary was trained for
+        stream                          [str] 'real', 'imag' or 'power'
+        dictionary                      [bytes] The zstd dictionary
+    '''
+
+    def __init__(self):
+        headers = {0: [('type', '4s'),
+                       ('low_date', 'L'),
+                       ('high_date', 'L'),
+                       ('dict_id', 'L'),
+                       ('channel_id', '128s'),
+                       ('stream', '8s')
+                       ]
+                   }
+        _SimradDatagramParser.__init__(self, 'ZDI', headers)
+        self.compile_headers()
+
+    def _unpack_contents(self, raw_string, bytes_read, version):
+
+        header_values = self.header_struct(version).unpack_from(raw_string)
+
+        data = {}
+
+        for indx, field in enumerate(self.header_fields(version)):
+            data[field] = header_values[indx]
+            if isinstance(data[field], bytes):
+                #  first try to decode as utf-8 but fall back to latin_1 if that fails
+                try:
+                    data[field] = data[field].decode("utf-8")
+                except UnicodeDecodeError:
+                    data[field] = data[field].decode("latin_1")
+
+        data['timestamp'] = nt_to_unix((data['low_date'], data['high_date']))
+        data['timestamp'] = data['timestamp'].replace(tzinfo=None)
+        data['bytes_read'] = bytes_read
+
+        data['channel_id'] = data['channel_id'].strip('\x00')
+        data['stream'] = data['stream'].strip('\x00')
+        data['dictionary'] = memoryview(raw_string)[self.header_size(version):]
+
+        return data
+
+    def _pack_contents(self, data, version):
+
+        datagram_contents = []
+        for field in self.header_fields(version):
+            if isinstance(data[field], str):
+                data[field] = data[field].encode('latin_1')
+            datagram_contents.append(data[field])
+
+        datagram = bytearray(self.header_struct(version).pack(*datagram_contents))
+        datagram += data['dictionary']
+
+        return datagram
+
+
+# Layout of the entries in a configuration table datagram
+CONFIG_ENTRY = np.dtype([('config_id', '<u4'),
+                         ('channel_id', 'S128'),
+                         ('count', '<i4'),
+                         ('wavelet', 'S8'),
+                         ('level', '<i4')])
+
+
+class SimradConfigZParser(PrecompiledParser, _SimradDatagramParser):
+    '''
+    Table of the wavelet configurations used by RAZ3 datagrams with the ZF_CONFIG flag,
+    operates on dictionaries with the following keys:
+
+        type:         string == 'ZCF0'
+        low_date:     long uint representing LSBytes of 64bit NT date
+        high_date:    long uint representing MSBytes of 64bit NT date
+        timestamp:    datetime.datetime object of NT date, assumed to be UTC
+
+        n_entries                       [long uint] Number of entries
+        entries                         [numpy array] One CONFIG_ENTRY per configuration
+
+    A file can have several of these, each written before the first datagram using its entries.
+    '''
+
+    def __init__(self):
+        headers = {0: [('type', '4s'),
+                       ('low_date', 'L'),
+                       ('high_date', 'L'),
+                       ('n_entries', 'L')
+                       ]
+                   }
+        _SimradDatagramParser.__init__(self, 'ZCF', headers)
+        self.compile_headers()
+
+    def _unpack_contents(self, raw_string, bytes_read, version):
+
+        header_values = self.header_struct(version).unpack_from(raw_string)
+
+        data = {}
+
+        for indx, field in enumerate(self.header_fields(version)):
+            data[field] = header_values[indx]
+            if isinstance(data[field], bytes):
+                data[field] = data[field].decode('latin_1')
+
+        data['timestamp'] = nt_to_unix((data['low_date'], data['high_date']))
+        data['timestamp'] = data['timestamp'].replace(tzinfo=None)
+        data['bytes_read'] = bytes_read
+
+        data['entries'] = np.frombuffer(raw_string, dtype=CONFIG_ENTRY, count=data['n_entries'],
+                                        offset=self.header_size(version))
+
+        return data
+
+    def _pack_contents(self, data, version):
+
+        data['n_entries'] = len(data['entries'])
+
+        datagram_contents = []
+        for field in self.header_fields(version):
+            if isinstance(data[field], str):
+                data[field] = data[field].encode('latin_1')
+            datagram_contents.append(data[field])
+
+        return self.header_struct(version).pack(*datagram_contents) + np.asarray(data['entries'], dtype=CONFIG_ENTRY).tobytes()
+
+
+# Layout of the per ping entries in a group datagram
+GROUP_PING = np.dtype([('low_date', '<u4'),
+                       ('high_date', '<u4'),
+                       ('offset', '<i4')])
+
+
+class SimradGroupZParser(PrecompiledParser, _SimradDatagramParser):
+    '''
+    Group of compressed sample datagrams from one channel, with the same data type and count,
+    operates on dictionaries with the following keys:
+
+        type:         string == 'RZG3'
+        low_date:     long uint representing LSBytes of 64bit NT date
+        high_date:    long uint representing MSBytes of 64bit NT date
+        timestamp:    datetime.datetime object of NT date, assumed to be UTC
+
+        channel_id                      [str] Channel of the pings
+        data_type                       [short] As in RAW3
+        zflags                          [short uint] As in RAZ3
+        count                           [long] Number of samples in every ping
+        n_pings                         [long] Number of pings in the group
+        zlevel                          [long] Levels of the wavelet transform along range
+        zwavelet                        [str] The wavelet along range, with ZF_WAVELET, else db4
+        pings                           [numpy array] One GROUP_PING per ping
+        zpower                          [bytes] Compressed power samples (if present), with
+                                        ZF_POWER_INT as in RAZ3, else by wavelets.compress_group1,
+                                        from float32 coefficients with ZF_POWER_WIDE
+        zangle                          [bytes] Angle samples (if present), by wavelets.compress_int
+        zcomplex                        [list] (real, imag) compressed complex samples per sector (if present),
+                                        from float32 coefficients with ZF_COMPLEX_WIDE
+        zcrc                            [long uint] CRC32 of the datagram before it, with ZF_CHECKSUM
+
+    Each ping is written as an RZP3 placeholder datagram in its original position, after the group.
+    A placeholder holds only the type, low_date, high_date and channel_id of the ping, as in RAW3.
+    '''
+
+    def __init__(self):
+        headers = {3: [('type', '4s'),
+                       ('low_date', 'L'),
+                       ('high_date', 'L'),
+                       ('channel_id', '128s'),
+                       ('data_type', 'h'),
+                       ('zflags', 'H'),
+                       ('count', 'l'),
+                       ('n_pings', 'l'),
+                       ('zlevel', 'l')
+                       ]
+                   }
+        _SimradDatagramParser.__init__(self, 'RZG', headers)
+        self.compile_headers()
+
+    def _unpack_contents(self, raw_string, bytes_read, version):
+
+        header_values = self.header_struct(version).unpack_from(raw_string)
+
+        data = {}
+
+        for indx, field in enumerate(self.header_fields(version)):
+            data[field] = header_values[indx]
+            if isinstance(data[field], bytes):
+                #  first try to decode as utf-8 but fall back to latin_1 if that fails
+                try:
+                    data[field] = data[field].decode("utf-8")
+                except UnicodeDecodeError:
+                    data[field] = data[field].decode("latin_1")
+
+        data['timestamp'] = nt_to_unix((data['low_date'], data['high_date']))
+        data['timestamp'] = data['timestamp'].replace(tzinfo=None)
+        data['bytes_read'] = bytes_read
+
+        data['channel_id'] = data['channel_id'].strip('\x00')
+        data['n_complex'] = data['data_type'] >> 8
+
+        indx = self.header_size(version)
+        if data['zflags'] & ZF_WAVELET:
+            data['zwavelet'] = bytes(raw_string[indx:indx + 8]).rstrip(b'\x00').decode('latin_1')
+            indx += 8
+        data['pings'] = np.frombuffer(raw_string, dtype=GROUP_PING, count=data['n_pings'], offset=indx)
+        indx += GROUP_PING.itemsize * data['n_pings']
+
+        #  compressed data are returned as memoryview slices, not copies
+        view = memoryview(raw_string)
+
+        # the compressed power, angle and complex samples follow in that order, each preceded by its length
+        blobs = []
+        for _ in range(bool(data['data_type'] & 0b1) + bool(data['data_type'] & 0b10) + 2 * data['n_complex']):
+            zlen, = struct.unpack_from('=i', raw_string, indx)
+            indx += 4
+            blobs.append(view[indx:indx + zlen])
+            indx += zlen
+        blobs = iter(blobs)
+
+        data['zpower'] = next(blobs) if data['data_type'] & 0b1 else None
+        data['zangle'] = next(blobs) if data['data_type'] & 0b10 else None
+        data['zcomplex'] = list(zip(blobs, blobs)) if data['n_complex'] > 0 else None
+
+        if data['zflags'] & ZF_CHECKSUM:
+            data['zcrc'], = struct.unpack_from('=L', raw_string, indx)
+
+        return data
+
+    def _pack_contents(self, data, version):
+
+        data.setdefault('zflags', 0)
+        data['n_pings'] = len(data['pings'])
+
+        datagram_contents = []
+        for field in self.header_fields(version):
+            if isinstance(data[field], str):
+                data[field] = data[field].encode('latin_1')
+            datagram_contents.append(data[field])
+
+        datagram = bytearray(self.header_struct(version).pack(*datagram_contents))
+        if data['zflags'] & ZF_WAVELET:
+            datagram += struct.pack('=8s', data['zwavelet'].encode('latin_1'))
+        datagram += np.asarray(data['pings'], dtype=GROUP_PING).tobytes()
+
+        zdata = []
+        if data['data_type'] & 0b1:
+            zdata.append(data['zpower'])
+        if data['data_type'] & 0b10:
+            zdata.append(data['zangle'])
+        if data['data_type'] >> 8 > 0:
+            zdata.extend(z for zc in data['zcomplex'] for z in zc)
+        for z in zdata:
+            datagram += struct.pack('=i', len(z))
+            datagram += z
+
+        if data['zflags'] & ZF_CHECKSUM:
+            datagram += struct.pack('=L', zlib.crc32(datagram))
+
+        return datagram
@@ -1,32 +1,363 @@
+import struct
 import numpy as np
 import pywt
-import zstd
+import zstandard
+import ekprof as P
 
 CAST = np.float16
 
+# zstd compression level, the same as the default of the zstd command line tool
+ZLEVEL = 3
+
+
+class Codec():
+    '''zstd compression that reuses its compressor and decompressor contexts.
+       Dictionaries can be added for streams identified by a key, e.g. (channel_id, 'real'),
+       data compressed for a key with a dictionary use it, others are compressed without one.
+       Decompression picks the dictionary from the ID recorded in each zstd frame.'''
+
+    def __init__(self, level=ZLEVEL):
+        self.level = level
+        self.clear()
+
+    def clear(self):
+        '''Forget all dictionaries'''
+        self.dictionaries = {}
+        self.compressors = {None: zstandard.ZstdCompressor(level=self.level)}
+        self.decompressors = {0: zstandard.ZstdDecompressor()}
+
+    def add_dictionary(self, key, dict_data):
+        '''Use the dictionary (as bytes) for the stream with the given key'''
+        zdict = zstandard.ZstdCompressionDict(bytes(dict_data))
+        self.dictionaries[key] = zdict
+        self.compressors[key] = zstandard.ZstdCompressor(level=self.level, dict_data=zdict)
+        self.decompressors[zdict.dict_id()] = zstandard.ZstdDecompressor(dict_data=zdict)
+
+    def compress(self, data, key=None):
+        '''Compress bytes, or any contiguous buffer such as an array, without copying it'''
+        compressor = self.compressors.get(key)
+        if compressor is None:
+            compressor = self.compressors[None]
+        with P.stage('zstd', memoryview(data).nbytes):
+            return compressor.compress(data)
+
+    def decompress(self, data):
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        with P.stage('unzstd') as stage:
+            data = self.decompressors[dict_id].decompress(data)
+            stage.nbytes = len(data)
+        return data
+
+
+# The codec used by the functions below
+CODEC = Codec()
+
+# The thresholds last chosen by error_threshold, by stream key, where the search for the next ping starts.
+# Cleared by ekzip.convert_datagrams at the start of each batch of datagrams.
+THRESHOLDS = {}
+
+# Rounds of error_threshold in transform_group, each shrinking the budget of a group by the ratio of
+# the error of its worst ping to the error that ping allows
+GROUP_ROUNDS = 8
+
+# Workspaces by channel and stream, sample count, wavelet and level, see workspace
+WORKSPACES = {}
+
+# Number of workspaces kept, the least recently used are dropped beyond this
+WORKSPACE_LIMIT = 64
+
+# The wavelets tried by tune, all orthogonal so that the error can be computed from the coefficients
+WAVELETS = ('haar', 'db2', 'db4', 'db6', 'sym4', 'coif2')
+
+
+class Workspace():
+    '''Buffers for the pings of one channel and stream, sample count, wavelet and level, allocated for
+       the first ping and reused for the following ones, see workspace.  Each buffer is allocated on
+       first use by buffer, with the given shape and dtype.'''
+
+    def __init__(self):
+        self.buffers = {}
+
+    def buffer(self, name, shape, dtype):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self.buffers[name] = np.empty(shape, dtype=dtype)
+        return buf
+
+
+def workspace(key, *config):
+    '''The Workspace for the stream with the given key, e.g. (channel_id, 'complex'), and configuration,
+       e.g. the sample count, wavelet and level.  Without a key, a new Workspace is returned.'''
+    if key is None:
+        return Workspace()
+    ws = WORKSPACES.pop((key, *config), None)
+    if ws is None:
+        ws = Workspace()
+        if len(WORKSPACES) >= WORKSPACE_LIMIT:
+            del WORKSPACES[next(iter(WORKSPACES))]
+    WORKSPACES[key, *config] = ws  # most recently used last
+    return ws
+
+
+def train_dictionary(samples, dict_size=16384):
+    '''Train a zstd dictionary from a list of sample buffers, returns the dictionary
+       as bytes, or None if there are too few samples.  The dictionary ID is derived
+       from the contents, so dictionaries from different files are unlikely to clash.'''
+    try:
+        return zstandard.train_dictionary(dict_size, samples, level=ZLEVEL).as_bytes()
+    except zstandard.ZstdError:
+        return None
+
+
+def join_bands(frames):
+    '''Concatenate the compressed bands of a coefficient vector, each preceded by its length,
+       so that the coarse bands can be decompressed without the finer ones'''
+    return b''.join(struct.pack('=i', len(frame)) + frame for frame in frames)
+
+
+def split_bands(data, n):
+    '''The first n compressed bands stored by join_bands'''
+    frames = []
+    offset = 0
+    for _ in range(n):
+        length, = struct.unpack_from('=i', data, offset)
+        frames.append(data[offset + 4:offset + 4 + length])
+        offset += 4 + length
+    return frames
+
+
+def encode(coeffs, sizes, key=None, bands=False):
+    '''Compress a vector of coefficients, as a single zstd frame or as one frame per band'''
+    if not bands:
+        return CODEC.compress(coeffs, key=key)
+    return join_bands([CODEC.compress(band, key=key) for band in np.split(coeffs, np.cumsum(sizes)[:-1])])
+
+
+def decode(data, sizes, bands=False, n=None):
+    '''Decompress the coefficients of the first n bands (default all) of a vector compressed by encode'''
+    n = len(sizes) if n is None else n
+    if bands:
+        return np.concatenate([np.frombuffer(CODEC.decompress(frame), dtype=CAST) for frame in split_bands(data, n)])
+    return np.frombuffer(CODEC.decompress(data), dtype=CAST)[:sum(sizes[:n])]
+
+
+def reconstruct(coeffs, wavelet, lod=0, axis=-1):
+    '''Inverse wavelet transform of the coefficient bands, with the lod finest detail bands left out.
+       The result then has 1/2^lod of the resolution, and is scaled to keep the amplitude of the signal.'''
+    with P.stage('waverec'):
+        recon = pywt.waverec(coeffs, wavelet, mode='periodic', axis=axis)
+    if lod > 0:
+        recon *= 2 ** (-lod / 2)
+    return recon
+
+
+def compress_int(samples, delta=False, key=None):
+    '''Lossless compression of integer samples of shape (count,) or (count, k).  With delta, each column
+       is delta coded along range first.  The bytes are grouped by significance, which zstd compresses better.'''
+    columns = samples.reshape(len(samples), -1).T.copy()
+    if delta:
+        columns[:, 1:] = columns[:, 1:] - columns[:, :-1]  # wraps around, cumsum restores the samples
+    planes = columns.view(np.uint8).reshape(*columns.shape, -1).transpose(0, 2, 1)
+    return bytes([delta]) + CODEC.compress(planes.tobytes(), key=key)
+
+
+def decompress_int(data, dtype, shape):
+    '''Decompress the integer samples compressed by compress_int to an array of the given dtype and shape'''
+    dtype = np.dtype(dtype)
+    count = shape[0]
+    planes = np.frombuffer(CODEC.decompress(data[1:]), dtype=np.uint8).reshape(-1, dtype.itemsize, count)
+    columns = np.ascontiguousarray(planes.transpose(0, 2, 1)).view(dtype).reshape(-1, count)
+    if data[0]:
+        columns = np.cumsum(columns, axis=-1, dtype=dtype)
+    return np.ascontiguousarray(columns.T).reshape(shape)
+
+
+def quantile(values, q):
+    '''The q quantile (0 <= q <= 1) along the last axis of values, linearly interpolated between
+       the closest ranks like np.percentile does by default.  Partitions values in place, which
+       takes linear time and needs no temporary copies.'''
+    n = values.shape[-1]
+    index = q * (n - 1)
+    below = int(index)
+    above = min(below + 1, n - 1)
+    values.partition((below, above), axis=-1)
+    low = values[..., below]
+    high = values[..., above]
+
+    # interpolate as np.percentile, to get exactly the same result
+    gamma = index - below
+    diff = high - low
+    if gamma >= 0.5:
+        return high - diff * (1 - gamma)
+    return low + diff * gamma
+
+
+def error_budget(parts, target, rows=1):
+    '''The squared error allowed for each block of rows consecutive rows of parts (e.g. the real and
+       imaginary parts of a complex signal), for the target ('error', e), a relative RMS error of e,
+       or ('psnr', p), a peak signal to noise ratio of p dB'''
+    blocks = parts.reshape(len(parts) // rows, rows, -1)
+    energy = np.square(blocks, dtype=np.float64).sum(axis=1)  # per sample
+    metric, value = target
+    if metric == 'psnr':
+        return energy.shape[-1] * energy.max(axis=-1) * 10 ** (-value / 10)
+    return value ** 2 * energy.sum(axis=-1)
+
+
+def error_threshold(magnitudes, budget, key=None, tolerance=0.01, work=None):
+    '''The largest soft threshold for each row of coefficient magnitudes, to within tolerance, for which
+       the squared error of thresholding stays within budget.  As the wavelets are orthogonal, this is
+       also the error of the reconstructed signal, apart from the rounding to CAST.  The thresholds are
+       found by bisection, starting from the previous ones for the same key if there are any.
+       The work array, like magnitudes, is used for the clipped magnitudes if given.'''
+    clipped = np.empty_like(magnitudes) if work is None else work
+
+    def within(t):
+        # coefficients below t are zeroed, the others shrink by t
+        np.minimum(magnitudes, t.astype(magnitudes.dtype)[:, None], out=clipped)
+        return np.einsum('ij,ij->i', clipped, clipped) <= budget
+
+    def narrow(t):
+        ok = within(t)
+        lo[ok] = t[ok]
+        hi[~ok] = t[~ok]
+        return ok
+
+    hi = magnitudes.max(axis=-1).astype(np.float64)
+    lo = np.where(within(hi), hi, 0.0)
+    start = THRESHOLDS.get(key)
+    if start is not None and start.shape == lo.shape:
+        # the thresholds change little from ping to ping, bracket the previous ones
+        start = np.clip(start, lo, hi)
+        ok = narrow(start)
+        narrow(np.clip(np.where(ok, start * 1.1, start / 1.1), lo, hi))
+    for _ in range(64):
+        if np.all(hi - lo <= tolerance * hi):
+            break
+        narrow((lo + hi) / 2)
+    if key is not None:
+        THRESHOLDS[key] = lo
+    return lo
 
-def compress1(signal, wavelet='db4', level=4, threshold_ratio=0.10):
-    '''Apply wavelet compression to a real-valued vector'''
-    coeffs = pywt.wavedec(signal, wavelet, level=level, mode='periodic')
-    cshapes = [c.shape for c in coeffs]
-    coeffs_flat = np.concatenate([c for c in coeffs])
-    threshold = np.percentile(np.abs(coeffs_flat), 100 * (1 - threshold_ratio))
-    comp = [pywt.threshold(c, threshold, mode='soft') for c in coeffs]
-    compressed_data = zstd.compress(np.concatenate(comp).astype(CAST).tobytes())
+
+def coefficients(parts, wavelet, level):
+    '''The wavelet coefficients of each row of parts, concatenated in the order of wavedec'''
+    return np.concatenate(pywt.wavedec(parts, wavelet, level=level, mode='periodic', axis=-1), axis=-1)
+
+
+def tune(blocks, levels, wavelet='db4', level=4, threshold_ratio=0.10, target=None, rows=1, wavelets=WAVELETS,
+         headroom=1.0):
+    '''Choose the wavelet and level giving the smallest compressed size for a list of sample blocks, of
+       shape (m, samples) like the interleaved real and imaginary parts in transform_batch, with one
+       threshold for every rows consecutive rows.  The error allowed for each block is that of the given
+       wavelet, level and threshold_ratio, or else by the target (see error_budget), and the threshold
+       meeting it is found for each candidate with error_threshold.  The wavelet is chosen at the given
+       level first, and then the level for that wavelet.  Candidates with coefficients that would
+       overflow CAST when multiplied by headroom, e.g. by a further transform, are skipped.
+       Returns the wavelet, the level, and the fraction of coefficients kept, to use as threshold_ratio.'''
+    budgets = []
+    for parts in blocks:
+        if target is None:
+            magnitudes = np.abs(coefficients(parts, wavelet, level)).reshape(len(parts) // rows, -1)
+            threshold = quantile(magnitudes.copy(), (100 * (1 - threshold_ratio)) / 100)
+            clipped = np.minimum(magnitudes, threshold[:, None])
+            budgets.append(np.einsum('ij,ij->i', clipped, clipped))
+        else:
+            budgets.append(error_budget(parts, target, rows))
+
+    def evaluate(wl, lv):
+        '''The compressed size of the blocks and the fraction of coefficients kept, or None on overflow'''
+        size = kept = total = 0
+        for parts, budget in zip(blocks, budgets):
+            comp = coefficients(parts, wl, lv)
+            magnitudes = np.abs(comp).reshape(len(parts) // rows, -1)
+            if magnitudes.max() * headroom > np.finfo(CAST).max:
+                return None
+            threshold = error_threshold(magnitudes, budget, key=('tune', wl, lv, rows))
+            kept += np.count_nonzero(magnitudes > threshold[:, None])
+            total += magnitudes.size
+            comp = pywt.threshold(comp, np.repeat(threshold, rows)[:, None], mode='soft').astype(CAST)
+            size += len(CODEC.compress(comp.tobytes()))
+        return size, kept / total
+
+    results = {}
+    for wl in wavelets:
+        results[wl, level] = evaluate(wl, level)
+    sizes = {key: r[0] for key, r in results.items() if r is not None}
+    best = min(sizes, key=sizes.get)[0] if sizes else wavelet
+    for lv in levels:
+        if (best, lv) not in results:
+            results[best, lv] = evaluate(best, lv)
+
+    sizes = {key: r[0] for key, r in results.items() if r is not None}
+    if not sizes:
+        return wavelet, level, threshold_ratio
+    best = min(sizes, key=sizes.get)
+    return best[0], best[1], results[best][1]
+
+
+def transform_rows(parts, wavelet='db4', level=4, threshold_ratio=0.10, rows=1, target=None, key=None):
+    '''Wavelet transform the rows of parts, of shape (m, samples), and soft threshold the coefficients with
+       one threshold for every rows consecutive rows, by threshold_ratio or to meet the target as in transform1.
+       The coefficients, their magnitudes and the result are kept in the Workspace of the key, so that
+       the pings of a channel need no temporary copies of them, and the result is only valid until the
+       next call for the same key.  Returns the CAST coefficients and the sizes of the bands.'''
+    m, count = parts.shape
+    ws = workspace(key, count, wavelet, level)
+    sizes = band_sizes(count, wavelet, level)
+    dtype = parts.dtype if parts.dtype.kind == 'f' else np.dtype(np.float64)  # as from wavedec
+    coeffs = ws.buffer('coeffs', (m, sum(sizes)), dtype)
+    magnitudes = ws.buffer('magnitudes', coeffs.shape, dtype)
+    work = ws.buffer('work', coeffs.shape, dtype)
+    comp = ws.buffer('comp', coeffs.shape, CAST)
+
+    with P.stage('wavedec', parts.nbytes):
+        np.concatenate(pywt.wavedec(parts, wavelet, level=level, mode='periodic', axis=-1), axis=-1, out=coeffs)
+    with P.stage('threshold'):
+        np.abs(coeffs, out=magnitudes)
+        blocks = magnitudes.reshape(m // rows, -1)
+        if target is None:
+            np.copyto(work, magnitudes)  # quantile reorders the values
+            threshold = quantile(work.reshape(m // rows, -1), (100 * (1 - threshold_ratio)) / 100)
+        else:
+            threshold = error_threshold(blocks, error_budget(parts, target, rows), key=key,
+                                        work=work.reshape(m // rows, -1))
+        # soft thresholding: the magnitudes shrink by the threshold, down to zero, and get their signs back
+        np.subtract(blocks, threshold.astype(dtype)[:, None], out=blocks)
+        np.maximum(magnitudes, 0, out=magnitudes)
+        np.copysign(magnitudes, coeffs, out=magnitudes)
+        np.copyto(comp, magnitudes, casting='same_kind')
+    return comp, sizes
+
+
+def transform1(signal, wavelet='db4', level=4, threshold_ratio=0.10, target=None, key=None):
+    '''Wavelet transform and threshold a real-valued vector, returns the coefficients and their shapes.
+       With a target (see error_budget), the threshold is chosen to meet it, instead of by threshold_ratio.
+       The coefficients are only valid until the next call with the same key, see transform_rows.'''
+    comp, sizes = transform_rows(signal[None], wavelet, level, threshold_ratio, target=target, key=key)
+    return comp[0], [(s,) for s in sizes]
+
+
+def compress1(signal, wavelet='db4', level=4, threshold_ratio=0.10, key=None, bands=False, target=None):
+    '''Apply wavelet compression to a real-valued vector, with bands each band is compressed separately'''
+    comp, cshapes = transform1(signal, wavelet=wavelet, level=level, threshold_ratio=threshold_ratio,
+                               target=target, key=(key, 'power'))
+    compressed_data = encode(comp, [s[0] for s in cshapes], key=(key, 'power'), bands=bands)
 
     return compressed_data, wavelet, level, cshapes
 
 
-def decompress1(compressed_data, wavelet, level, shapes):
-    '''Decompress data to a real-valued vector'''
-    compr_flat = np.frombuffer(zstd.decompress(compressed_data), dtype=CAST)
-    comp = []
-    start = 0
-    for shape in shapes:
-        comp.append(compr_flat[start:start + shape].reshape(shape))
-        start += shape
+def decompress1(compressed_data, wavelet, level, shapes, out=None, bands=False, lod=0):
+    '''Decompress data to a real-valued vector, or into the first len(out) elements of out.
+       With lod > 0 the vector has reduced resolution, see reconstruct.'''
+    n = len(shapes) - lod
+    compr_flat = decode(compressed_data, shapes, bands=bands, n=n)
+    comp = np.split(compr_flat, np.cumsum(shapes[:n])[:-1])
 
-    recon = pywt.waverec(comp, wavelet, mode='periodic')
+    recon = reconstruct(comp, wavelet, lod)
+    if out is not None:
+        out[...] = recon[:len(out)]
+        return out
     return recon
 
 
@@ -49,16 +380,16 @@ def compress(signal, wavelet='db4', level=4, threshold_ratio=0.10):
     comp_real_flat = np.concatenate(comp_real).astype(CAST)
     comp_imag_flat = np.concatenate(comp_imag).astype(CAST)
     compressed_data = [
-        zstd.compress(comp_real_flat.tobytes()),
-        zstd.compress(comp_imag_flat.tobytes())
+        CODEC.compress(comp_real_flat.tobytes()),
+        CODEC.compress(comp_imag_flat.tobytes())
     ]
 
     return compressed_data, wavelet, level, coeffs_shapes
 
 
 def decompress(compressed_data, wavelet, level, shapes):
-    comp_real_flat = np.frombuffer(zstd.decompress(compressed_data[0]), dtype=CAST)
-    comp_imag_flat = np.frombuffer(zstd.decompress(compressed_data[1]), dtype=CAST)
+    comp_real_flat = np.frombuffer(CODEC.decompress(compressed_data[0]), dtype=CAST)
+    comp_imag_flat = np.frombuffer(CODEC.decompress(compressed_data[1]), dtype=CAST)
 
     # Reshape flattened coefficients back into lists of arrays
     comp_real = []
@@ -77,3 +408,180 @@ def decompress(compressed_data, wavelet, level, shapes):
     # Combine into complex signal
     return recon_real + 1j * recon_imag
 
+
+def transform_batch(signals, wavelet='db4', level=4, threshold_ratio=0.10, target=None, key=None):
+    '''Wavelet transform and threshold every column of a complex matrix at once.
+       The real and imaginary parts of the columns are interleaved as rows and transformed
+       together, using one threshold per column as in compress, or to meet the target as in transform1.
+       Returns the coefficients, with the real and imaginary parts of column i in rows 2i and 2i+1,
+       and their shapes.  The coefficients are only valid until the next call with the same key,
+       see transform_rows.'''
+    count, n = signals.shape
+    signals = np.ascontiguousarray(signals)
+    parts = workspace(key, count, wavelet, level).buffer('parts', (2 * n, count), signals.real.dtype)
+    np.copyto(parts, signals.view(signals.real.dtype).T)
+
+    # Threshold each column over the coefficients of both its real and imaginary parts
+    comp, sizes = transform_rows(parts, wavelet, level, threshold_ratio, rows=2, target=target, key=key)
+    return comp, [(s,) for s in sizes]
+
+
+def compress_batch(signals, wavelet='db4', level=4, threshold_ratio=0.10, key=None, bands=False, target=None):
+    '''Apply wavelet compression to every column of a complex matrix at once.
+       Returns a list of (real, imag) compressed data pairs, one per column.'''
+    comp, coeffs_shapes = transform_batch(signals, wavelet=wavelet, level=level, threshold_ratio=threshold_ratio,
+                                          target=target, key=(key, 'complex'))
+    sizes = [s[0] for s in coeffs_shapes]
+    compressed_data = [(encode(real, sizes, key=(key, 'real'), bands=bands),
+                        encode(imag, sizes, key=(key, 'imag'), bands=bands))
+                       for real, imag in zip(comp[0::2], comp[1::2])]
+
+    return compressed_data, wavelet, level, coeffs_shapes
+
+
+def decompress_batch(compressed_data, wavelet, level, shapes, out=None, bands=False, lod=0):
+    '''Decompress a list of (real, imag) compressed data pairs to the columns of a complex matrix.
+       If out is given the first len(out) rows are written into it instead of a new matrix.
+       With lod > 0 the columns have reduced resolution, see reconstruct.'''
+    n = len(compressed_data)
+    sizes = [shape[0] for shape in shapes][:len(shapes) - lod]
+    comp = workspace('decode', 2 * n, sum(sizes)).buffer('comp', (2 * n, sum(sizes)), CAST)
+    for i, (zreal, zimag) in enumerate(compressed_data):
+        comp[2 * i] = decode(zreal, sizes, bands=bands)
+        comp[2 * i + 1] = decode(zimag, sizes, bands=bands)
+
+    coeffs = np.split(comp, np.cumsum(sizes)[:-1], axis=1)
+    recon = reconstruct(coeffs, wavelet, lod, axis=-1)
+    signals = out
+    if signals is None:
+        signals = np.empty((recon.shape[1], n), dtype=np.result_type(recon.dtype, np.complex64))
+    signals.real = recon[0::2, :len(signals)].T
+    signals.imag = recon[1::2, :len(signals)].T
+    return signals
+
+
+def band_sizes(n, wavelet, level):
+    '''The lengths of the bands of a wavelet transform of n samples, coarsest first, as from wavedec'''
+    filter_len = pywt.Wavelet(wavelet).dec_len
+    sizes = [n]
+    for _ in range(level):
+        sizes.append(pywt.dwt_coeff_len(sizes[-1], filter_len, 'periodic'))
+    return sizes[-1:] + sizes[:0:-1]
+
+
+def ping_levels(pings):
+    '''The number of levels of the Haar transform across a group of pings'''
+    return pywt.dwt_max_level(pings, 2)
+
+
+def transform_group(parts, wavelet='db4', level=4, threshold_ratio=0.10, rows=1, target=None, key=None):
+    '''Wavelet transform and threshold a stack of pings × samples blocks, of shape (m, pings, samples).
+       Each ping is transformed along range as in transform_batch, and the coefficients then
+       with a Haar transform across the pings, i.e. a hierarchical ping to ping difference.
+       There is one threshold for every rows consecutive blocks, by threshold_ratio or to meet
+       the target for every ping, see group_threshold.  Returns the coefficients, as CAST unless
+       they exceed its range, as the sums across pings of power samples can, then as float32.'''
+    m, pings = parts.shape[:2]
+    with P.stage('wavedec', parts.nbytes):
+        comp = np.concatenate(pywt.wavedec(parts, wavelet, level=level, mode='periodic', axis=-1), axis=-1)
+        comp = np.concatenate(pywt.wavedec(comp, 'haar', level=ping_levels(pings), mode='periodic', axis=1), axis=1)
+
+    with P.stage('threshold'):
+        magnitudes = np.abs(comp).reshape(m // rows, -1)
+        if target is not None:
+            return group_threshold(comp, magnitudes, parts, wavelet, level, rows, target, key)
+        threshold = quantile(magnitudes, (100 * (1 - threshold_ratio)) / 100)
+        return cast_group(pywt.threshold(comp, np.repeat(threshold, rows)[:, None, None], mode='soft'))
+
+
+def cast_group(comp):
+    '''The coefficients from transform_group as CAST, or as float32 if they exceed its range'''
+    if np.abs(comp).max(initial=0) > np.finfo(CAST).max:
+        return comp.astype(np.float32)
+    return comp.astype(CAST)
+
+
+def group_threshold(comp, magnitudes, parts, wavelet, level, rows, target, key=None):
+    '''Threshold the coefficients of transform_group so that every ping meets the target, as in
+       transform1 for a single ping.  The threshold is first chosen for the error of the whole group,
+       which the Haar transform spreads unevenly over the pings, so the pings are reconstructed and
+       the budget shrunk by the worst ratio of the error of a ping to its own, for up to GROUP_ROUNDS
+       rounds.  Returns the thresholded coefficients.'''
+    m, pings, count = parts.shape
+    # the error allowed for each ping of each block, and for the block
+    allowed = error_budget(parts.transpose(1, 0, 2).reshape(-1, count), target, rows).reshape(pings, -1).T
+    budget = allowed.sum(axis=-1)
+    for _ in range(GROUP_ROUNDS):
+        threshold = error_threshold(magnitudes, budget, key=key)
+        result = cast_group(pywt.threshold(comp, np.repeat(threshold, rows)[:, None, None], mode='soft'))
+        recon = inverse_group(result, wavelet, level, pings, count)[..., :count]
+        if np.issubdtype(parts.dtype, np.integer):
+            recon = np.trunc(recon)  # as the samples are decoded to integers
+        errors = np.square(recon - parts, dtype=np.float64).sum(axis=-1).reshape(m // rows, rows, pings).sum(axis=1)
+        ratio = np.max(errors / np.maximum(allowed, np.finfo(np.float64).tiny), axis=-1)
+        if np.all(ratio <= 1):
+            break
+        budget = np.where(ratio > 1, budget / ratio, budget)
+    return result
+
+
+def inverse_group(comp, wavelet, level, pings, count, lod=0):
+    '''Reconstruct the blocks transformed by transform_group, at 1/2^lod resolution along range'''
+    sizes = band_sizes(count, wavelet, level)[:level + 1 - lod]
+    psizes = band_sizes(pings, 'haar', ping_levels(pings))
+    comp = comp[..., :sum(sizes)]
+    with P.stage('waverec'):
+        comp = pywt.waverec(np.split(comp, np.cumsum(psizes)[:-1], axis=1), 'haar', mode='periodic', axis=1)[:, :pings]
+    return reconstruct(np.split(comp, np.cumsum(sizes)[:-1], axis=-1), wavelet, lod, axis=-1)
+
+
+def group_shape(pings, count, wavelet, level):
+    '''The shape of the coefficients of one pings × count block from transform_group'''
+    return sum(band_sizes(pings, 'haar', ping_levels(pings))), sum(band_sizes(count, wavelet, level))
+
+
+def compress_group(signals, wavelet='db4', level=4, threshold_ratio=0.10, key=None, target=None):
+    '''Apply wavelet compression to a group of pings of complex samples, of shape (pings, count, sectors).
+       Returns a list of (real, imag) compressed data pairs, one per sector, the wavelet, the level
+       and the type of the coefficients, see transform_group.'''
+    n = signals.shape[-1]
+    parts = np.ascontiguousarray(np.moveaxis(np.ascontiguousarray(signals).view(signals.real.dtype), -1, 0))
+    comp = transform_group(parts, wavelet=wavelet, level=level, threshold_ratio=threshold_ratio, rows=2,
+                           target=target, key=(key, 'group'))
+    compressed_data = [(CODEC.compress(comp[2 * i].tobytes(), key=(key, 'real')),
+                        CODEC.compress(comp[2 * i + 1].tobytes(), key=(key, 'imag')))
+                       for i in range(n)]
+    return compressed_data, wavelet, level, comp.dtype
+
+
+def decompress_group(compressed_data, wavelet, level, pings, count, lod=0, dtype=CAST):
+    '''Decompress a list of (real, imag) compressed data pairs to a (pings, count, sectors) complex array,
+       from coefficients of the given type'''
+    n = len(compressed_data)
+    shape = group_shape(pings, count, wavelet, level)
+    comp = np.empty((2 * n, *shape), dtype=dtype)
+    for i, (zreal, zimag) in enumerate(compressed_data):
+        comp[2 * i] = np.frombuffer(CODEC.decompress(zreal), dtype=dtype).reshape(shape)
+        comp[2 * i + 1] = np.frombuffer(CODEC.decompress(zimag), dtype=dtype).reshape(shape)
+
+    recon = inverse_group(comp, wavelet, level, pings, count, lod)
+    m = -(-count >> lod)
+    signals = np.empty((pings, m, n), dtype=np.result_type(recon.dtype, np.complex64))
+    signals.real = np.moveaxis(recon[0::2, :, :m], 0, -1)
+    signals.imag = np.moveaxis(recon[1::2, :, :m], 0, -1)
+    return signals
+
+
+def compress_group1(signals, wavelet='db4', level=4, threshold_ratio=0.10, key=None, target=None):
+    '''Apply wavelet compression to a group of pings of real samples, of shape (pings, count).
+       Returns the compressed data, the wavelet, the level and the type of the coefficients.'''
+    comp = transform_group(signals[None], wavelet=wavelet, level=level, threshold_ratio=threshold_ratio,
+                           target=target, key=(key, 'gpower'))
+    return CODEC.compress(comp[0].tobytes(), key=(key, 'power')), wavelet, level, comp.dtype
+
+
+def decompress_group1(compressed_data, wavelet, level, pings, count, lod=0, dtype=CAST):
+    '''Decompress data to a (pings, count) array of real samples, from coefficients of the given type'''
+    shape = group_shape(pings, count, wavelet, level)
+    comp = np.frombuffer(CODEC.decompress(compressed_data), dtype=dtype).reshape(1, *shape)
+    return inverse_group(comp, wavelet, level, pings, count, lod)[0, :, :-(-count >> lod)]
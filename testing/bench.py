@@ -0,0 +1,178 @@
+# Benchmarks of the compression stages on synthetic EK80 data (see synthetic.py), with the results
+# written as JSON to compare runs across commits.  With src on the PYTHONPATH:
+#   python bench.py -o $(git rev-parse --short HEAD).json
+#   python bench.py --compare before.json after.json
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+import pywt
+import zstandard
+import ekzip
+import ekzio
+import wavelets as W
+import synthetic
+
+
+def timed(fn, repeat):
+    '''The shortest time of repeat calls of fn, and the result of the last call'''
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        value = fn()
+        best = min(best, time.perf_counter() - t)
+    return best, value
+
+
+def result(name, seconds, nbytes, pings, **extra):
+    '''The JSON record of one benchmark, nbytes is the size of the uncompressed data'''
+    return {'name': name, 'seconds': seconds, 'bytes': nbytes, 'pings': pings,
+            'mb_per_s': nbytes / seconds / 1e6, 'pings_per_s': pings / seconds, **extra}
+
+
+def rel_error(xs, ys):
+    '''Relative RMS error over all the pings of a field'''
+    err = sum(np.sum(np.abs(x.astype(np.complex128) - y) ** 2) for x, y in zip(xs, ys))
+    return float(np.sqrt(err / sum(np.sum(np.abs(x.astype(np.complex128)) ** 2) for x in xs)))
+
+
+def bench_wavelets(datas, level, threshold, repeat):
+    '''wavelets.compress and decompress, one sector of complex samples at a time'''
+    signals = [d['complex'][:, i] for d in datas if d['n_complex'] > 0 for i in range(d['n_complex'])]
+    nbytes = sum(s.nbytes for s in signals)
+    pings = sum(1 for d in datas if d['n_complex'] > 0)
+    tc, comp = timed(lambda: [W.compress(s, level=level, threshold_ratio=threshold) for s in signals], repeat)
+    td, recon = timed(lambda: [W.decompress(*c)[:len(s)] for c, s in zip(comp, signals)], repeat)
+    size = sum(len(c[0][0]) + len(c[0][1]) for c in comp)
+    return [result('wavelets.compress', tc, nbytes, pings, ratio=nbytes / size, error=rel_error(signals, recon)),
+            result('wavelets.decompress', td, nbytes, pings)]
+
+
+def bench_datagrams(datas, level, threshold, repeat):
+    '''raw2raz and raz2raw, and packing and parsing the RAW3 and RAZ3 datagrams'''
+    raw_msgs = [ekzip.RAW_PARSER.to_string(dict(d)) for d in datas]
+    nbytes = sum(len(m) for m in raw_msgs)
+    pings = len(datas)
+    results = []
+
+    t, parsed = timed(lambda: [ekzip.RAW_PARSER.from_string(m[4:-4], len(m) - 8) for m in raw_msgs], repeat)
+    results.append(result('parse RAW3', t, nbytes, pings))
+    t, _ = timed(lambda: [ekzip.RAW_PARSER.to_string(dict(d)) for d in parsed], repeat)
+    results.append(result('pack RAW3', t, nbytes, pings))
+
+    t, zdatas = timed(lambda: [ekzip.raw2raz(d, level=level, threshold_ratio=threshold) for d in parsed], repeat)
+    t_pack, zmsgs = timed(lambda: [ekzip.RAZ_PARSER.to_string(dict(z)) for z in zdatas], repeat)
+    size = sum(len(m) for m in zmsgs)
+    t_parse, zparsed = timed(lambda: [ekzip.RAZ_PARSER.from_string(m[4:-4], len(m) - 8) for m in zmsgs], repeat)
+    t_raz, decoded = timed(lambda: [ekzip.raz2raw(z) for z in zparsed], repeat)
+
+    errors = {}
+    for field in ('complex', 'power'):
+        pairs = [(d[field], r[field]) for d, r in zip(parsed, decoded) if d[field] is not None and d['count'] > 0]
+        if pairs:
+            errors[field] = rel_error(*zip(*pairs))
+    results.append(result('raw2raz', t, nbytes, pings, ratio=nbytes / size, error=errors))
+    results.append(result('pack RAZ3', t_pack, nbytes, pings))
+    results.append(result('parse RAZ3', t_parse, nbytes, pings))
+    results.append(result('raz2raw', t_raz, nbytes, pings))
+    return results
+
+
+def bench_read(fname, kind, parser, repeat):
+    '''Reading the datagrams of a file, and reading them and parsing those of the given kind'''
+    nbytes = os.path.getsize(fname)
+    t, count = timed(lambda: sum(1 for _ in ekzio.datagrams(fname)), repeat)
+    t_parse, _ = timed(lambda: [parser.from_string(d[3], d[1]) for d in ekzio.datagrams(fname) if d[0] == kind], repeat)
+    return [result(f'read {kind}', t, nbytes, count, datagrams_per_s=count / t),
+            result(f'read+parse {kind}', t_parse, nbytes, count, datagrams_per_s=count / t_parse)]
+
+
+def bench_files(n, seed, level, threshold, jobs, repeat):
+    '''compress and decompress of a synthetic RAW file, and reading it and the compressed file'''
+    with tempfile.TemporaryDirectory() as tmp:
+        raw = os.path.join(tmp, 'bench.raw')
+        nbytes = synthetic.write_raw(raw, n, seed=seed)
+        pings = n * len(synthetic.CHANNELS)
+        ekz, out = raw + '.ekz', os.path.join(tmp, 'out.raw')
+        tc, _ = timed(lambda: ekzip.compress(raw, ekz, level, threshold, jobs=jobs), repeat)
+        td, _ = timed(lambda: ekzip.decompress(ekz, out, jobs=jobs), repeat)
+        size = os.path.getsize(ekz)
+        reads = bench_read(raw, 'RAW3', ekzip.RAW_PARSER, repeat) + bench_read(ekz, 'RAZ3', ekzip.RAZ_PARSER, repeat)
+    return [result('compress', tc, nbytes, pings, ratio=nbytes / size, jobs=jobs),
+            result('decompress', td, nbytes, pings, jobs=jobs)] + reads
+
+
+def environment():
+    '''The commit and versions the benchmarks were run with'''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(ekzip.__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'pywavelets': pywt.__version__,
+            'zstandard': zstandard.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def print_results(results, file=sys.stderr):
+    print(f'{"benchmark":<20}  {"seconds":>8}  {"MB/s":>8}  {"pings/s":>8}  {"ratio":>6}', file=file)
+    for r in results:
+        ratio = f'{r["ratio"]:6.2f}' if 'ratio' in r else ''
+        print(f'{r["name"]:<20}  {r["seconds"]:8.3f}  {r["mb_per_s"]:8.1f}  {r["pings_per_s"]:8.1f}  {ratio}', file=file)
+
+
+def compare(before, after):
+    '''Print the throughput and ratio of the benchmarks in two result files'''
+    old = {r['name']: r for r in before['results']}
+    print(f'{before["environment"]["commit"]} -> {after["environment"]["commit"]}')
+    print(f'{"benchmark":<20}  {"MB/s":>8}  {"MB/s":>8}  {"speedup":>7}  {"ratio":>6}  {"ratio":>6}')
+    for r in after['results']:
+        o = old.get(r['name'])
+        if o is None:
+            continue
+        ratios = f'{o["ratio"]:6.2f}  {r["ratio"]:6.2f}' if 'ratio' in r and 'ratio' in o else ''
+        print(f'{r["name"]:<20}  {o["mb_per_s"]:8.1f}  {r["mb_per_s"]:8.1f}  {r["mb_per_s"] / o["mb_per_s"]:6.2f}x  {ratios}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ekzip on synthetic EK80 data.')
+    parser.add_argument('--pings', type=int, default=50, help='Pings per channel (default 50)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+    parser.add_argument('--level', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark, the fastest is reported')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Worker processes for compress and decompress')
+    parser.add_argument('-o', default='-', help='Output JSON file (default stdout)')
+    parser.add_argument('--compare', nargs=2, metavar='JSON', help='Compare two result files instead')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as a, open(args.compare[1]) as b:
+            compare(json.load(a), json.load(b))
+        return
+
+    datas = synthetic.pings(args.pings, seed=args.seed)
+    results = bench_wavelets(datas, args.level, args.threshold, args.repeat)
+    results += bench_datagrams(datas, args.level, args.threshold, args.repeat)
+    results += bench_files(args.pings, args.seed, args.level, args.threshold, args.jobs, args.repeat)
+    print_results(results)
+
+    report = {'environment': environment(),
+              'parameters': {k: v for k, v in vars(args).items() if k not in ('o', 'compare')},
+              'results': results}
+    if args.o == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.o, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Compare per ping compression (raw2raz) with grouped compression (raw2rzg) for different group sizes,
+# on the pings of a RAW file given as argument, or on synthetic pings with slowly varying layers.
+# Then check that compressing the file (or the EK80 data of synthetic.py) with --group is not larger
+# than without, as groups that do not shrink are compressed ping by ping.
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from ekzio import datagrams
+import ekzip
+from synthetic import write_raw
+
+LEVEL = 3
+THRESHOLD = 0.2
+GROUPS = [4, 8, 16, 32]
+
+
+def synthetic(pings=256, count=4000, sectors=4, seed=0):
+    '''RAW3 dicts for one channel, with a seabed and a layer drifting slowly from ping to ping'''
+    rng = np.random.default_rng(seed)
+    r = np.arange(count)
+    datas = []
+    for p in range(pings):
+        amp = 1e-3 * np.exp(-r / 800) + 2e-6 * rng.standard_normal(count)
+        bottom = int(3000 + 50 * np.sin(p / 20))
+        amp[bottom:bottom + 20] += 5e-3
+        amp[1500 + p % 100:1600 + p % 100] += 2e-4
+        # the phase follows range, with a small ping to ping variation
+        phase = 0.3 * r[:, None] + np.arange(sectors) + 0.05 * rng.standard_normal((count, sectors))
+        cplx = (amp[:, None] * np.exp(1j * phase)).astype(np.complex64)
+        power = (1000 * np.log10(np.abs(amp) + 1e-9)).astype(np.int16)
+        datas.append({'type': 'RAW3', 'low_date': p, 'high_date': 0, 'channel_id': 'synthetic', 'offset': 0,
+                      'data_type': 0b1001 | (sectors << 8), 'count': count, 'n_complex': sectors,
+                      'complex': cplx, 'power': power, 'angle': None})
+    return datas
+
+
+def from_file(fname):
+    '''RAW3 dicts for the channel with the most pings in a file, of its most common sample count'''
+    pings = {}
+    for dgram in datagrams(fname):
+        if dgram[0] == 'RAW3':
+            data = ekzip.RAW_PARSER.from_string(dgram[3], len(dgram[3]))
+            if data['count'] > 0:
+                pings.setdefault((data['channel_id'], data['data_type'], data['count']), []).append(data)
+    return max(pings.values(), key=len)
+
+
+def error(datas, decoded):
+    '''Relative RMS error of the complex (or else power) samples'''
+    field = 'complex' if datas[0]['n_complex'] > 0 else 'power'
+    x = np.stack([d[field] for d in datas]).astype(np.complex128)
+    y = np.stack([d[field] for d in decoded]).astype(np.complex128)
+    return np.linalg.norm(x - y) / np.linalg.norm(x)
+
+
+datas = from_file(sys.argv[1]) if len(sys.argv) > 1 else synthetic()
+raw_size = sum(len(ekzip.RAW_PARSER.to_string(dict(d))) for d in datas)
+print(f'{len(datas)} pings of {datas[0]["count"]} samples, {raw_size} bytes')
+print(f'{"mode":>8}  {"size":>9}  {"ratio":>6}  {"compress":>9}  {"decompress":>10}  rel.err')
+
+t = time.perf_counter()
+zdatas = [ekzip.raw2raz(d, level=LEVEL, threshold_ratio=THRESHOLD) for d in datas]
+tc = time.perf_counter() - t
+msgs = [ekzip.RAZ_PARSER.to_string(z) for z in zdatas]
+t = time.perf_counter()
+decoded = [ekzip.raz2raw(ekzip.RAZ_PARSER.from_string(m[4:-4], len(m) - 8)) for m in msgs]
+td = time.perf_counter() - t
+size = sum(len(m) for m in msgs)
+print(f'{"ping":>8}  {size:9d}  {raw_size / size:6.2f}  {tc:8.2f}s  {td:9.2f}s  {error(datas, decoded):.4f}')
+
+for n in GROUPS:
+    t = time.perf_counter()
+    zdatas = [ekzip.raw2rzg(datas[i:i + n], level=LEVEL, threshold_ratio=THRESHOLD) for i in range(0, len(datas), n)]
+    tc = time.perf_counter() - t
+    msgs = [ekzip.RZG_PARSER.to_string(z) for z in zdatas]
+    t = time.perf_counter()
+    decoded = [d for m in msgs for d in ekzip.rzg2raw(ekzip.RZG_PARSER.from_string(m[4:-4], len(m) - 8))]
+    td = time.perf_counter() - t
+    # each ping also has a placeholder datagram
+    size = sum(len(m) for m in msgs) + ekzip.PLACEHOLDER_SIZE * len(datas)
+    print(f'{"group " + str(n):>8}  {size:9d}  {raw_size / size:6.2f}  {tc:8.2f}s  {td:9.2f}s  {error(datas, decoded):.4f}')
+
+with tempfile.TemporaryDirectory() as tmp:
+    raw = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tmp, 'synthetic.raw')
+    if len(sys.argv) == 1:
+        write_raw(raw)
+    sizes = {}
+    for n in [0] + GROUPS:
+        ekz = os.path.join(tmp, f'group{n}.ekz')
+        ekzip.compress(raw, ekz, level=LEVEL, threshold=THRESHOLD, group=n)
+        sizes[n] = os.path.getsize(ekz)
+    print('file: ' + ', '.join(f'{"ping" if n == 0 else "group " + str(n)} {size}' for n, size in sizes.items()))
+    for n in GROUPS:
+        assert sizes[n] <= sizes[0], f'--group {n} gives {sizes[n]} bytes, {sizes[0]} without'
@@ -0,0 +1,59 @@
+# Check that every ping of every channel meets the --max-error and --target-psnr bounds, per ping and
+# also with --group, for synthetic data:  python error_bound.py [pings]
+import os
+import sys
+import tempfile
+import numpy as np
+from ekzio import datagrams
+import ekzip
+import synthetic
+
+# The bounds checked, as (option, target)
+TARGETS = [('--max-error 0.05', ('error', 0.05)), ('--target-psnr 30', ('psnr', 30.0))]
+
+
+def pings(fname):
+    '''The dicts of the RAW3 pings of a RAW file, in file order'''
+    return [ekzip.RAW_PARSER.from_string(msg, length)
+            for dtype, length, timestamp, msg in datagrams(fname) if dtype == 'RAW3']
+
+
+def meets(original, decoded, target):
+    '''The worst ratio of the error of a ping to the error allowed by the target, per field'''
+    worst = {}
+    for field in ('complex', 'power'):
+        if original[field] is None:
+            continue
+        x = np.asarray(original[field], dtype=np.complex128 if field == 'complex' else np.float64)
+        error = np.square(np.abs(x - decoded[field])).sum()
+        energy = np.square(np.abs(x)).reshape(len(x), -1).sum(axis=-1)  # per sample
+        metric, value = target
+        allowed = value ** 2 * energy.sum() if metric == 'error' else len(x) * energy.max() * 10 ** (-value / 10)
+        worst[field] = error / allowed
+    return worst
+
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+failed = False
+with tempfile.TemporaryDirectory() as tmp:
+    raw = os.path.join(tmp, 'a.raw')
+    synthetic.write_raw(raw, n)
+    originals = pings(raw)
+    for option, target in TARGETS:
+        for group in (0, 8):
+            ekz = os.path.join(tmp, f'a{group}.raw.ekz')
+            if os.path.exists(ekz):
+                os.remove(ekz)
+            ekzip.compress(raw, ekz, group=group, target=target)
+            ekzip.decompress(ekz, os.path.join(tmp, 'b.raw'))
+            worst = {}
+            for original, decoded in zip(originals, pings(os.path.join(tmp, 'b.raw'))):
+                for field, ratio in meets(original, decoded, target).items():
+                    worst[field] = max(worst.get(field, 0), ratio)
+            os.remove(os.path.join(tmp, 'b.raw'))
+            ok = all(ratio <= 1 for ratio in worst.values())
+            failed |= not ok
+            ratios = ', '.join(f'{field} {ratio:.3f}' for field, ratio in worst.items())
+            print(f'{option} --group {group}: worst error / allowed {ratios}' + ('' if ok else '  FAILED'))
+if failed:
+    sys.exit(1)
@@ -0,0 +1,67 @@
+# Check that the pings read with EkzFile are those decompressed with ekzip -d, for synthetic data
+# compressed with the default options, with and without an index footer, with --group, and for the
+# outputs of concatenating and splitting without an index:  python roundtrip.py [pings]
+import os
+import sys
+import tempfile
+import numpy as np
+from ekzio import datagrams
+import ekzip
+import synthetic
+
+
+def decompressed(fname):
+    '''The dicts of the RAW3 pings of a decompressed file, by channel_id'''
+    pings = {}
+    for dtype, length, timestamp, msg in datagrams(fname):
+        if dtype == 'RAW3':
+            data = ekzip.RAW_PARSER.from_string(msg, length)
+            pings.setdefault(data['channel_id'], []).append(data)
+    return pings
+
+
+def check(ekz, pings):
+    '''Compare the arrays from read_pings with the decompressed pings of each channel'''
+    for channel_id, datas in pings.items():
+        read = ekzip.read_pings(ekz, channel_id)
+        assert len(read['count']) == len(datas), f'{channel_id}: {len(read["count"])} pings, expected {len(datas)}'
+        for i, data in enumerate(datas):
+            count = data['count']
+            assert read['count'][i] == count
+            for field in ('complex', 'power', 'angle'):
+                if data[field] is not None:
+                    assert np.array_equal(read[field][i, :count, ...][..., :data[field].shape[-1]]
+                                          if field == 'complex' else read[field][i, :count], data[field]), field
+
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+with tempfile.TemporaryDirectory() as tmp:
+    raw = os.path.join(tmp, 'a.raw')
+    synthetic.write_raw(raw, n)
+    for write_index in (False, True):
+        ekz = os.path.join(tmp, f'a{int(write_index)}.raw.ekz')
+        ekzip.compress(raw, ekz, write_index=write_index)
+        ekzip.decompress(ekz, ekz[:-4])
+        check(ekz, decompressed(ekz[:-4]))
+        # the second open uses the sidecar index, if there is no footer
+        check(ekz, decompressed(ekz[:-4]))
+        print(f'{os.path.basename(ekz)}: OK' + ('' if write_index else
+              f', sidecar {os.path.getsize(ekz + ekzip.INDEX_SUFFIX)} bytes'))
+
+    # the RAW3 pings of groups are read through their placeholders
+    grouped = os.path.join(tmp, 'g.raw.ekz')
+    ekzip.compress(raw, grouped, group=8)
+    ekzip.decompress(grouped, grouped[:-4])
+    assert any(dgram[0] == 'RZG3' for dgram in datagrams(grouped))
+    pings = decompressed(grouped[:-4])
+    assert sum(map(len, pings.values())) == sum(map(len, decompressed(ekz[:-4]).values()))
+    check(grouped, pings)
+    print(f'{os.path.basename(grouped)}: OK')
+
+    # the copies start with the context datagrams of their inputs
+    copies = ekzip.copy_datagrams([ekz, ekz], os.path.join(tmp, 'cat.raw.ekz'))
+    copies += ekzip.copy_datagrams([ekz], os.path.join(tmp, 'split.raw.ekz'), split_time=ekzip.timedelta(seconds=n // 3))
+    for copy in copies:
+        ekzip.decompress(copy, copy[:-4])
+        check(copy, decompressed(copy[:-4]))
+        print(f'{os.path.basename(copy)}: OK')
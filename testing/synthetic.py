@@ -0,0 +1,119 @@
+# Synthetic EK80 data for the benchmarks: RAW3 pings from several channels, with a noise floor,
+# volume backscatter decaying with range, a few drifting layers and a seabed echo, reproducible
+# from a seed, or EK60 data with RAW0 pings of power and angle samples from the same channels.
+# Run as a script to write a RAW file:  python synthetic.py out.raw [pings] [ek60]
+import sys
+import struct
+from datetime import datetime, timedelta
+import numpy as np
+from ektools.simrad_parsers import SimradRawParser
+
+# channel_id, sectors of complex samples (0 for power and angle), and the sample counts used
+CHANNELS = [('WBT 545612-15 ES38-7_ES', 4, (2500, 3000)),
+            ('WBT 545613-15 ES70-7C_ES', 4, (4000, 4500)),
+            ('WBT 545614-15 ES200-7C_ES', 4, (6000, 5000)),
+            ('GPT  18 kHz 009072034fa5 1-1 ES18', 0, (1500, 2000))]
+
+# Frequencies of the CHANNELS, for the EK60 pings
+FREQUENCIES = (38000.0, 70000.0, 200000.0, 18000.0)
+
+# Pings between changes of the range, and so of the sample count
+RANGE_PINGS = 50
+
+# Power in dB per unit of the int16 power samples
+POWER_DB = 10 * np.log10(2) / 256
+
+# Time between pings
+PING_INTERVAL = timedelta(seconds=1)
+
+
+def nt_date(t):
+    '''The (low_date, high_date) of a datetime, in 100ns intervals since 1601-01-01'''
+    nt = (t - datetime(1601, 1, 1)) // timedelta(microseconds=1) * 10
+    return nt & 0xffffffff, nt >> 32
+
+
+def echo(rng, ping, count, channel):
+    '''The amplitude of one ping, of count samples'''
+    r = np.arange(count)
+    amp = 2e-6 * np.abs(rng.standard_normal(count))                    # noise floor
+    amp += 1e-3 * np.exp(-r / (0.3 * count)) * (1 + 0.5 * rng.standard_normal(count))
+    for k, depth in enumerate((0.2, 0.45)):                             # layers
+        centre = int(count * (depth + 0.02 * np.sin(ping / (30 + 10 * k) + channel)))
+        amp[centre:centre + count // 50] += 2e-4 * (1 + rng.standard_normal(count // 50) ** 2)
+    bottom = int(count * (0.8 + 0.05 * np.sin(ping / 40)))              # seabed
+    amp[bottom:bottom + 20] += 5e-2 * np.exp(-np.arange(len(amp[bottom:bottom + 20])) / 5)
+    amp[bottom + 20:] *= 0.1
+    return np.abs(amp), bottom
+
+
+def ping(rng, ping, channel, start=datetime(2023, 3, 21, 8, 21, 57), ek60=False):
+    '''The dict representing the RAW3 datagram of a ping from one of the CHANNELS,
+       or with ek60 the RAW0 datagram, with power and angle samples'''
+    channel_id, sectors, counts = CHANNELS[channel]
+    count = counts[(ping // RANGE_PINGS) % len(counts)]
+    low_date, high_date = nt_date(start + ping * PING_INTERVAL + channel * timedelta(milliseconds=10))
+    amp, bottom = echo(rng, ping, count, channel)
+    data = {'type': 'RAW3', 'low_date': low_date, 'high_date': high_date, 'channel_id': channel_id,
+            'offset': 0, 'count': count, 'n_complex': sectors, 'complex': None, 'power': None, 'angle': None}
+    if ek60:
+        sectors = 0
+        data = {'type': 'RAW0', 'low_date': low_date, 'high_date': high_date, 'channel': channel + 1, 'mode': 3,
+                'transducer_depth': 5.0, 'frequency': FREQUENCIES[channel],
+                'transmit_power': 1000.0, 'pulse_length': 1.024e-3, 'bandwidth': 2425.0, 'sample_interval': 2.56e-4,
+                'sound_velocity': 1480.0, 'absorption_coefficient': 0.01, 'heave': 0.0, 'roll': 0.0, 'pitch': 0.0,
+                'temperature': 8.0, 'heading': 0.0, 'transmit_mode': 0, 'spare0': '', 'offset': 0, 'count': count}
+    if sectors > 0:
+        # the phase progresses along range, with an offset between the sectors of a split beam
+        phase = 0.3 * np.arange(count)[:, None] + 0.5 * np.arange(sectors) + 0.1 * rng.standard_normal((count, sectors))
+        data['data_type'] = 0b1000 | (sectors << 8)
+        data['complex'] = (amp[:, None] * np.exp(1j * phase)).astype(np.complex64)
+    else:
+        if not ek60:
+            data['data_type'] = 0b11
+        data['power'] = np.round(20 * np.log10(amp + 1e-9) / POWER_DB).astype(np.int16)
+        # the angles are noise, except at the seabed
+        angle = rng.integers(-60, 61, (count, 2))
+        angle[bottom:bottom + 20] = (5, -3)
+        data['angle'] = angle.astype(np.int8)
+    return data
+
+
+def pings(n=100, channels=None, seed=0, ek60=False):
+    '''Dicts for n pings of each of the channels (by default all the CHANNELS), in time order'''
+    rng = np.random.default_rng(seed)
+    channels = range(len(CHANNELS)) if channels is None else channels
+    return [ping(rng, p, c, ek60=ek60) for p in range(n) for c in channels]
+
+
+def text_dgram(dtype, date, text):
+    '''The contents of an XML0 or NME0 datagram'''
+    return dtype.encode('latin_1') + struct.pack('<LL', *date) + text.encode('latin_1')
+
+
+def raw_datagrams(n=100, channels=None, seed=0, ek60=False):
+    '''The contents of the datagrams of a RAW file with n pings of each channel,
+       a configuration datagram first and an NMEA position after each ping'''
+    datas = pings(n, channels, seed, ek60)
+    yield text_dgram('XML0', (datas[0]['low_date'], datas[0]['high_date']), '<Configuration/>')
+    for data in datas:
+        first = data.get('channel_id') == CHANNELS[0][0] or data.get('channel') == 1
+        yield SimradRawParser().to_string(data)[4:-4]
+        if first:
+            yield text_dgram('NME0', (data['low_date'], data['high_date']),
+                             '$GPGGA,082157.00,6024.0000,N,00519.0000,E,1,10,0.9,10.0,M,,,,*00')
+
+
+def write_raw(fname, n=100, channels=None, seed=0, ek60=False):
+    '''Write a RAW file with n pings of each channel, returns its size'''
+    size = 0
+    with open(fname, 'wb') as f:
+        for msg in raw_datagrams(n, channels, seed, ek60):
+            hdr = struct.pack('<l', len(msg))
+            f.write(hdr + msg + hdr)
+            size += len(msg) + 8
+    return size
+
+
+if __name__ == '__main__':
+    write_raw(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 100, ek60=sys.argv[3:4] == ['ek60'])
@@ -1,15 +1,18 @@
+import sys
 import ektools
 import wavelets as W
 import numpy as np
+import synthetic
 
-# Get a RAW3 datagram
+# Get a RAW3 datagram, from the RAW file given as argument or else a synthetic one
 INDEX = 108
-ix = ektools.index('../CRIMAC-KoronaScript/cr_out/2023001004-D20230321-T082157.raw')
-assert ix[INDEX][1] == 'RAW3', f'Wrong datagram? {ix[INDEX][:3]}'
-dg = ektools.parse(ix[INDEX][3])
+if len(sys.argv) > 1:
+    ix = ektools.index(sys.argv[1])
+    assert ix[INDEX][1] == 'RAW3', f'Wrong datagram? {ix[INDEX][:3]}'
+    dg = ektools.parse(ix[INDEX][3])
+else:
+    dg = synthetic.ping(np.random.default_rng(0), INDEX, 0)
 
-HPSEARCH = False
-PRINT = False
 PLOT = True
 TIME = False
 CLIP = True
@@ -28,31 +31,13 @@ if CLIP:
 print('Input shape:', mydata.shape, ' size:', mydatasize)
 
 
-if HPSEARCH:
-  for level in [1, 2, 3, 4, 5, 6, 8, 10]:
-    # print('level:', level)
-    for thresh in [0.005, 0.01, 0.025, 0.033, 0.05, 0.1, 0.15, 0.2]:
-        # print('thresh:', thresh)
-        compressed, wvl, lev, shp = W.compress(mydata, level=level, threshold_ratio=thresh)
-        compsize = len(compressed[0]) + len(compressed[1])
-        # print(compsize)
+# For a search over levels and thresholds on whole files, use the statistics mode, e.g.
+#   ekzip --statistics --level 2,3,4,5 --threshold 0.01,0.025,0.05,0.1,0.2 --stats-format csv -j 8 *.raw
 
-        reconstructed = W.decompress(compressed, wvl, lev, shp)[:mydata.shape[0]]
-        if PRINT:
-            print(mydata[PRINT:PRINT + 10])
-            print(reconstructed[PRINT:PRINT + 10])
-
-        err = np.abs(mydata - reconstructed)
-        mse = np.mean(err ** 2)
-        relerr = np.mean(err / np.abs(mydata))
-        print(f'level={level:<2d} thresh={thresh:.3f} size={compsize / 1000:3.1f}k reduction={(1 - compsize / mydatasize) * 100:.1f}% mse={mse:.3e} rel={relerr:.2f}')
-    print()
-
-
-import numpy as np
-import matplotlib.pyplot as plt
 
 if PLOT:
+    import matplotlib.pyplot as plt
+
     # Plot it
     r1, r2, r3 = 0.20, 0.10, 0.05
     compressed, wvl, lev, shp = W.compress(mydata, level=3, threshold_ratio=r1)